@@ -0,0 +1,310 @@
+# (python3)
+import functools
+import jpl
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+"""
+Benchmarks for jpl
+
+Standard prolog benchmarks that fit jpl's dialect (see the .jpl files next to this),
+plus generated ones: transitive closure over a random graph, and lookups in a big
+fact base. Each is run on every engine, reporting:
+- answers: how many the query had (checked against what it should have)
+- steps: steps attempted (jpl.Program.steps), and inferences: ones that made progress
+- LIPS: logical inferences per second
+- seconds: wall time of the query (best of --repeat runs; parsing isn't included)
+- peakMemory: peak bytes allocated while running the query (tracemalloc, separate run)
+
+Results can be saved as JSON, and compared against an earlier run (e.g. from another
+commit) to spot regressions. Run it from the repo root:
+    python -m bench [--engine ENGINE] [--out results.json] [--compare old.json]
+
+With --check, nothing's timed: instead each engine's answers are cross-checked against plain
+top-down search on the tree engine (see jpl.crossCheck), for the benchmarks plus CHECKS.
+With --parallel N, they're answered OR-parallel first (on N workers, see jpl.OrParallel),
+or AND-parallel with --and-parallel too (see jpl.AndParallel)
+    python -m bench --check [--engine ENGINE] [--parallel N [--and-parallel]]
+"""
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RESULTS_VERSION = 1
+
+
+class Benchmark:
+    " A query to time, against a program (from a file in BENCH_DIR, or generated) "
+
+    def __init__(self, name, query, answers, fname=None, generate=None, description=""):
+        " answers is how many answers query should have, generate() returns source text "
+        self.name = name
+        self.query = query
+        self.answers = answers
+        self.fname = fname
+        self.generate = generate
+        self.description = description
+        self._source = None
+
+
+    def source(self):
+        " The program's source text (generated sources only get generated once) "
+        if self._source is None:
+            if self.generate is not None:
+                self._source = self.generate()
+            else:
+                with open(os.path.join(BENCH_DIR, self.fname)) as f:
+                    self._source = f.read()
+        return self._source
+
+
+    def load(self, engine):
+        " Parses a fresh Program (so nothing's left over from another run, e.g. tables) "
+        return jpl.Program.ParseString(self.source(), engine)
+
+
+
+# ============================================================
+#
+#                    GENERATED PROGRAMS
+#
+# ============================================================
+
+def _errorSource():
+    " A query that has answers, then hits an error partway through its search "
+    lines = ["p({}).".format(i) for i in range(1, 7)]
+    lines.append("q(X, Y) :- r(Y).")
+    lines.append("q(X, Y) :- is(Y, +(X, a)).")
+    lines.append("r(a). r(b).")
+    return "\n".join(lines) + "\n"
+
+
+def _graphSource(nodes=100, edges=200, seed=1):
+    """ Transitive closure over a random directed graph (fixed seed, so it's the same every time)
+    path/2 is left recursive, so it's tabled (or evaluated bottom-up, with the datalog engine)
+    """
+    rng = random.Random(seed)
+    lines = [":- table path/2.",
+            "path(X, Y) :- path(X, Z), edge(Z, Y).",
+            "path(X, Y) :- edge(X, Y)."]
+
+    pairs = set()
+    while len(pairs) < edges:
+        pairs.add((rng.randrange(nodes), rng.randrange(nodes)))
+    lines.extend("edge(n{}, n{}).".format(a, b) for a, b in sorted(pairs))
+    return "\n".join(lines) + "\n"
+
+
+def _factsSource(facts=20000):
+    """ A big fact base keyed on integers, plus a loop doing lookups into it
+    probe(N) looks up N keys, spread over the whole base (by first-argument indexing)
+    """
+    lines = ["f({}, v{}).".format(i, i) for i in range(facts)]
+    lines.append("probe(0) :- !.")
+    lines.append("probe(N) :- is(K, mod(*(N, 7919), {})), f(K, V), is(N1, -(N, 1)), probe(N1)."
+            .format(facts))
+    return "\n".join(lines) + "\n"
+
+
+BENCHMARKS = [
+    Benchmark("nrev", "bench(30, 30).", 1, fname="nrev.jpl",
+            description="naive reverse of a 30 element list, 30 times"),
+    Benchmark("queens", "queens(7, Qs).", 40, fname="queens.jpl",
+            description="every solution to 7 queens"),
+    Benchmark("zebra", "zebra(Owner, Drinker).", 1, fname="zebra.jpl",
+            description="the zebra puzzle"),
+    Benchmark("peano", "toPeano(6, N), fact(N, F), fromPeano(F, X).", 1, fname="peano.jpl",
+            description="6! in Peano arithmetic"),
+    Benchmark("tc", "path(X, Y).", 6878, generate=_graphSource,
+            description="tabled transitive closure of a random 100 node, 200 edge graph"),
+    Benchmark("facts", "probe(5000).", 1, generate=_factsSource,
+            description="5000 lookups in 20000 facts"),
+]
+
+# Only cross-checked (with --check), not timed: random graphs of other sizes & seeds,
+# the queries suggested in test_progs/tabling.jpl, errors after some answers, and
+# queries with independent goals (for AND-parallelism)
+CHECKS = [Benchmark("tc-{}".format(seed), "path(X, Y).", None,
+            generate=functools.partial(_graphSource, 10 * seed, 20 * seed, seed))
+        for seed in range(2, 7)]
+CHECKS += [Benchmark(name, query, None, fname=os.path.join("..", "test_progs", "tabling.jpl"))
+        for name, query in [("path-a", "path(a, X)."), ("path", "path(X, Y)."),
+                ("fib", "fib(30, F)."), ("sameGen", "sameGen(X, d).")]]
+CHECKS += [Benchmark("error", "p(X), q(X, Y).", None, generate=_errorSource),
+        Benchmark("indep-queens", "queens(5, Qs), range(1, 3, L), queens(4, Rs).", None,
+                fname="queens.jpl"),
+        Benchmark("indep-peano", "toPeano(3, N), add(X, Y, N), toPeano(2, M), add(P, Q, M).", None,
+                fname="peano.jpl"),
+        Benchmark("indep-error", "p(X), r(Y), q(1, Z).", None, generate=_errorSource),
+        Benchmark("indep-none", "p(Y), r(Y), q(1, Z).", None, generate=_errorSource)]
+
+BENCHMARKS_BY_NAME = {b.name: b for b in BENCHMARKS + CHECKS}
+
+
+
+# ============================================================
+#
+#                          RUNNING
+#
+# ============================================================
+
+def countAnswers(program, queryRule):
+    """ Runs queryRule to completion, returning how many answers it had
+    With the datalog engine, Datalog queries are answered bottom-up (see jpl.queryAnswers)
+    """
+    return sum(1 for _ in jpl.queryAnswers(program, queryRule))
+
+
+def runBenchmark(bench, engine, repeat=1, memory=True):
+    " Runs bench on engine, returns its results (a dict, see the module docstring) "
+
+    best = None
+    for _ in range(repeat):
+        program = bench.load(engine)
+        queryRule = jpl.parseQuery(bench.query)
+
+        start = time.perf_counter()
+        answers = countAnswers(program, queryRule)
+        seconds = time.perf_counter() - start
+
+        if best is None or seconds < best:
+            best = seconds
+
+    peak = None
+    if memory:
+        program = bench.load(engine)
+        queryRule = jpl.parseQuery(bench.query)
+        tracemalloc.start()
+        try:
+            countAnswers(program, queryRule)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "benchmark": bench.name,
+        "engine": engine,
+        "answers": answers,
+        "ok": bench.answers is None or answers == bench.answers,
+        "steps": program.steps,
+        "inferences": program.inferences,
+        "lips": program.inferences / best if best > 0 and program.inferences else None, # (none bottom-up)
+        "seconds": best,
+        "peakMemory": peak,
+    }
+
+
+def runAll(benchmarks, engines, repeat=1, memory=True, log=None):
+    " Runs every benchmark on every engine, returns the results document (see saveResults) "
+
+    results = []
+    for bench in benchmarks:
+        for engine in engines:
+            result = runBenchmark(bench, engine, repeat, memory)
+            results.append(result)
+            if log is not None:
+                log(formatResult(result))
+
+    return {
+        "version": RESULTS_VERSION,
+        "commit": _gitCommit(),
+        "python": sys.version.split()[0],
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+def crossCheckAll(benchmarks, engines, log=None, workers=None, andParallel=False):
+    """ Checks each benchmark's query gets the same answers on every engine as by plain top-down
+    search on the tree engine (see jpl.crossCheck). Returns how many didn't
+    If workers isn't None, queries are answered OR-parallel on that many (0: one per CPU),
+    and the answers have to come in the same order too. Or AND-parallel, if andParallel
+    """
+
+    different = 0
+    for bench in benchmarks:
+        reference = bench.load(jpl.ENGINE_TREE)
+        for engine in engines:
+            program = bench.load(engine)
+            if workers is not None and andParallel:
+                program.parallel = jpl.AndParallel(program, workers or None, source=bench.source())
+            elif workers is not None:
+                program.parallel = jpl.OrParallel(program, workers or None, source=bench.source())
+            try:
+                diffs = jpl.crossCheck(program, bench.query, reference,
+                        inOrder=workers is not None and not andParallel)
+            finally:
+                if program.parallel is not None:
+                    program.parallel.close()
+
+            different += bool(diffs)
+            if log is not None:
+                log("{:<10} {:<9} {}".format(bench.name, engine, "DIFFERENT" if diffs else "ok"))
+                for line in diffs:
+                    log("    " + line)
+
+    return different
+
+
+def _gitCommit():
+    " The checked out commit, if we're in a git repo (else None) "
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+# ============================================================
+#
+#                    REPORTING/COMPARING
+#
+# ============================================================
+
+def formatResult(r):
+    " One line for a result "
+    lips = "-" if r["lips"] is None else "{:.0f}".format(r["lips"])
+    mem = "-" if r["peakMemory"] is None else "{:.1f}MB".format(r["peakMemory"] / 2**20)
+    return "{:<8} {:<9} {:>8.3f}s {:>9} LIPS {:>9} steps {:>9} inferences {:>9} peak, {} answers{}".format(
+            r["benchmark"], r["engine"], r["seconds"], lips, r["steps"], r["inferences"],
+            mem, r["answers"], "" if r["ok"] else " (WRONG)")
+
+
+def saveResults(doc, fname):
+    with open(fname, "w") as f:
+        json.dump(doc, f, indent=1)
+        f.write("\n")
+
+
+def loadResults(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+
+def compareResults(old, new):
+    """ Returns lines comparing two results documents: the time of each benchmark/engine
+    in both, and new time as a ratio of old (above 1 is slower)
+    """
+
+    oldTimes = {(r["benchmark"], r["engine"]): r["seconds"] for r in old["results"]}
+
+    lines = ["comparing against {} ({})".format(old.get("commit"), old.get("time"))]
+    for r in new["results"]:
+        key = (r["benchmark"], r["engine"])
+        if key not in oldTimes:
+            lines.append("{:<8} {:<9} {:>8.3f}s   (new)".format(key[0], key[1], r["seconds"]))
+            continue
+
+        ratio = r["seconds"] / oldTimes[key] if oldTimes[key] > 0 else float("inf")
+        lines.append("{:<8} {:<9} {:>8.3f}s -> {:>8.3f}s  x{:.2f}".format(
+                key[0], key[1], oldTimes[key], r["seconds"], ratio))
+
+    return lines
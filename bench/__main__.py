@@ -0,0 +1,70 @@
+# (python3)
+import bench
+import jpl
+import argparse
+import sys
+
+
+" Command line for the benchmarks: python -m bench --help "
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench",
+            description="Runs jpl's benchmarks on each engine (LIPS, steps, peak memory, wall time)")
+    parser.add_argument("names", nargs="*", metavar="BENCHMARK",
+            help="benchmarks to run (default: all of them: {})"
+                 .format(", ".join(b.name for b in bench.BENCHMARKS)))
+    parser.add_argument("--engine", action="append", choices=jpl.ENGINES, dest="engines",
+            help="engine to run on, can be given more than once (default: every engine)")
+    parser.add_argument("--repeat", type=int, default=1,
+            help="time each benchmark this many times, keeping the best (default: %(default)s)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+            help="don't measure peak memory (saves a run of each benchmark under tracemalloc)")
+    parser.add_argument("--out", metavar="FILE",
+            help="save the results to FILE, as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+            help="compare times against results saved earlier (with --out)")
+    parser.add_argument("--check", action="store_true",
+            help="don't time anything: check every engine gets the same answers as plain top-down "
+                 "search on the tree engine, for the benchmarks plus some extra generated graphs & "
+                 "test_progs/tabling.jpl (default: all of those)")
+    parser.add_argument("--parallel", type=int, metavar="N",
+            help="with --check: answer OR-parallel on N worker processes (0: one per CPU), "
+                 "checking the answers come in the same order too")
+    parser.add_argument("--and-parallel", action="store_true",
+            help="with --check --parallel: answer AND-parallel instead")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parseArgs(sys.argv[1:])
+
+    for name in args.names:
+        if name not in bench.BENCHMARKS_BY_NAME:
+            print("Unknown benchmark '{}'".format(name))
+            exit(1)
+
+    engines = args.engines or jpl.ENGINES
+
+    if args.check:
+        benchmarks = ([bench.BENCHMARKS_BY_NAME[n] for n in args.names]
+                or bench.BENCHMARKS + bench.CHECKS)
+        different = bench.crossCheckAll(benchmarks, engines, log=print, workers=args.parallel,
+                andParallel=args.and_parallel)
+        print("{} different".format(different))
+        exit(1 if different else 0)
+
+    benchmarks = [bench.BENCHMARKS_BY_NAME[n] for n in args.names] or bench.BENCHMARKS
+
+    results = bench.runAll(benchmarks, engines, args.repeat, args.memory, log=print)
+
+    if args.out is not None:
+        bench.saveResults(results, args.out)
+        print("Saved results to {}".format(args.out))
+
+    if args.compare is not None:
+        print("\n".join(bench.compareResults(bench.loadResults(args.compare), results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 # 
 # (python3)
 import re
+import sys
 
 
 """
@@ -20,17 +21,24 @@ TODO:
 
 
 A Term is a variable or a functor (with children or without (if atom))
-Variables are a string key and a context (either the parent rule or a CTX object)
+Numbers are atoms whose token is an int instead of a string (e.g. Functor(3, []))
+Each functor also carries its symbol: a small int id for its name/arity (see symbolId),
+so comparing two functors is a single compare (a number's symbol is its value, not an id)
+Variables are a string key, a slot number, and a context (the parent rule)
 A clause is just a term
 
 A rule is a head clause, followed by a list of body clauses
 + a context (which stores variables defined in that rule's clauses)
+The context is an array of bindings, indexed by var slot:
+each distinct var name in a rule gets a slot (each '_' gets its own)
 
 NOTE: Creation conventions:
-- Variables are created WITHOUT A CONTEXT
+- Variables are created WITHOUT A CONTEXT (by the parser)
 - HOWEVER: if a variable is derefed or bound without a context, we raise an exception
 - Rules must be created with terms already made,
-- Rule constructor binds all vars in its clauses
+- Rule constructor binds all vars in its clauses, and numbers their slots
+- Copies of a rule are the exception: their vars are created straight into
+  the new rule's context, with the same slots as the original (see Rule.copy)
 """
 
 
@@ -39,6 +47,57 @@ VERBOSE=False  #it's the default for the Term safestr method
 class ParseError(Exception):
     pass
 
+# ============================================================
+#
+#                        SYMBOL TABLE
+#
+# ============================================================
+
+# Every functor name/arity (e.g. foo/2) gets a small integer id, the first time it's seen.
+# Ids are only good for this process (see progcache.py)
+#
+# Numbers aren't interned, since arithmetic can make any number of them (and the table
+# is never freed): a number's symbol is (NUMBER, value) instead, so two numbers' symbols
+# are still equal iff the numbers are, and never equal to a name's id (or a variantKey's vars)
+
+_symbolIds = {}   # (token, arity) -> id
+symbolNames = []  # id -> (token, arity)
+
+NUMBER = "number"
+
+
+def isNumberKey(token, arity):
+    " Whether token/arity is a number (numbers are int tokens with no subterms) "
+    return arity == 0 and type(token) is int
+
+
+def symbolId(token, arity):
+    " Returns the symbol for token/arity, interning it if it's new (and not a number) "
+    key = (token, arity)
+    sid = _symbolIds.get(key)
+    if sid is None:
+        if isNumberKey(token, arity):
+            return (NUMBER, token)
+        sid = _symbolIds[key] = len(symbolNames)
+        symbolNames.append(key)
+    return sid
+
+
+def symbolIds(keys):
+    " Returns the symbols for a list of distinct (token, arity) pairs, interning the new ones (all at once) "
+    new = [key for key in keys if key not in _symbolIds and not isNumberKey(*key)]
+    _symbolIds.update(zip(new, range(len(symbolNames), len(symbolNames) + len(new))))
+    symbolNames.extend(new)
+    return [(NUMBER, key[0]) if isNumberKey(*key) else _symbolIds[key] for key in keys]
+
+
+def symbolName(sym):
+    " Returns (token, arity) for symbol sym "
+    if type(sym) is tuple:
+        return (sym[1], 0)
+    return symbolNames[sym]
+
+
 # ============================================================
 #
 #                 OBJECTS (Terms/Rules)
@@ -50,10 +109,15 @@ class Term:
 Vars should be bound to a rule instance (that's the binding context)
     ABSTRACT: don't instantiate
     """
+    __slots__ = ()
 
     def isVar(self):
         return isinstance(self, Var)
 
+    def isNumber(self):
+        " numbers are functor/0 with an int token "
+        return isinstance(self, Functor) and isinstance(self.token, int)
+
 
     # applies function to self & each subterm within self
     # applies to vars but doesn't deref them
@@ -62,8 +126,10 @@ Vars should be bound to a rule instance (that's the binding context)
         mapfun(self) # functor overrides this to recurse on children
 
 
-    def copy(self):
-        " Copies tree, stops at vars (copy's vars are unbound)"
+    def copy(self, context=None):
+        """ Copies tree, stops at vars (copy's vars are unbound)
+        If context is given, var copies are put straight into it (keeping their slots)
+        """
         assert False, "Don't call copy on Term class"
 
 
@@ -81,44 +147,64 @@ Vars should be bound to a rule instance (that's the binding context)
 
 
 class Functor(Term):
+    __slots__ = ("token", "subterms", "sym", "ground")
 
-    def __init__(self, token, subterms):
+    def __init__(self, token, subterms, sym=None):
+        " sym is the symbolId of token/arity (looked up if not given) "
         super().__init__()
         self.token = token
         self.subterms = list(subterms)
+        if sym is None:
+            sym = _symbolIds.get((token, len(self.subterms))) # (inlined fast path of symbolId, for names)
+            if sym is None:
+                sym = symbolId(token, len(self.subterms))
+        self.sym = sym
 
-    # applies function to self & each subterm within self
+        # True if known to have no vars (see markGround): then copies can just share it
+        self.ground = False
+
+    # applies function to self & each subterm within self (preorder)
     # applies to vars but doesn't deref them
     # doesn't return anything rn
+    # (uses an explicit stack, so deep terms don't hit the recursion limit)
     def shallowMap(self, mapfun):
-        mapfun(self)
-        for child in self.subterms:
-            child.shallowMap(mapfun)
+        stack = [self]
+        while stack:
+            term = stack.pop()
+            mapfun(term)
+            if not term.isVar():
+                stack.extend(reversed(term.subterms))
 
 
-    def copy(self):
-        " Copies tree, stops at vars (copy's vars are unbound)"
-        childCopies = [s.copy() for s in self.subterms]
-        return Functor(self.token, childCopies)
+    def copy(self, context=None):
+        " Copies tree, stops at vars (copy's vars are unbound). Ground subterms are shared, not copied "
 
+        if self.ground:
+            return self
 
-    def __repr__(self):
-        return self.safeStr()
+        # Each new functor starts with a copy of the old subterms list (see __init__),
+        # then we replace its entries with copies, one level at a time
+        top = Functor(self.token, self.subterms, self.sym)
+        stack = [top]
+        while stack:
+            subs = stack.pop().subterms
+            for i in range(len(subs)):
+                s = subs[i]
+                if s.isVar():
+                    subs[i] = Var(s.token, s.slot, context)
+                elif not s.ground:
+                    subs[i] = Functor(s.token, s.subterms, s.sym)
+                    stack.append(subs[i])
 
+        return top
 
-    def safeStr(self, verbose=VERBOSE, depth=10):
-        if depth == 0:
-            return "..."
 
-        if len(self.subterms) == 0:
-            return self.token
+    def __repr__(self):
+        return self.safeStr()
 
-        subtermstr = ", ".join(x.safeStr(verbose, depth-1) for x in self.subterms)
 
-        if verbose:
-            return "{}/{}({})".format(self.token, len(self.subterms), subtermstr)
-        else:
-            return "{}({})".format(self.token, subtermstr)
+    def safeStr(self, verbose=VERBOSE, depth=10):
+        return _termStr(self, verbose, depth)
 
 
     def shortname(self):
@@ -127,38 +213,41 @@ class Functor(Term):
 
 
 class Var(Term):
-    def __init__(self, token):
-        " token is var name "
+    __slots__ = ("token", "slot", "context")
+
+    def __init__(self, token, slot=None, context=None):
+        " token is var name, slot is index into context's bindings (both set by Rule) "
         super().__init__()
         self.token = token
 
-        self.context = None #Starts uninitialized
+        self.slot = slot
+        self.context = context #Starts uninitialized
 
 
-    def copy(self):
+    def copy(self, context=None):
         " Copies tree, stops at vars (copy's vars are unbound)"
-        return Var(self.token)
+        return Var(self.token, self.slot, context)
 
     def deref(self):
-        " Recursively dereferences self until reach nonvar or unbound var "
+        " Dereferences self (loops down the chain) until reach nonvar or unbound var "
         " If unbound, returned value is var"
+        # NOTE: doesn't compress the chain: shortcutting bindings would need trailing too
 
         assert isinstance(self.context, Rule), "ERROR: deref context-less Var"
 
-        if self.token not in self.context.bindings:
-            return self # we're deepest unbound, return self
+        var = self
+        while True:
+            binding = var.context.bindings[var.slot]
+            if binding is None:
+                return var # we're deepest unbound, return var
 
-        # we're bound, deref once
-        binding = self.context.bindings[self.token]
+            # we're bound, deref once
+            if not binding.isVar(): # hit a concrete value, done
+                return binding
 
-
-        if not binding.isVar(): # hit a concrete value, done
-            return binding
-        else:
             # If hit var, continue
-            assert binding != self #this shouldn't happen, also we shouldn't get loops
-
-            return binding.deref()
+            assert binding is not var #this shouldn't happen, also we shouldn't get loops
+            var = binding
 
 
 
@@ -179,7 +268,7 @@ class Var(Term):
         assert deepvar.isVar(), "Can't re-bind an already-bound var"
 
         # make binding & return the var that was updated
-        deepvar.context.bindings[deepvar.token] = term
+        deepvar.context.bindings[deepvar.slot] = term
         return deepvar 
 
 
@@ -191,9 +280,9 @@ class Var(Term):
             return
 
         # We don't have to be bound to a concrete value, but we shouldn't be a root unbound
-        assert self.token in self.context.bindings, "ERROR: unbinding root unbound var"
+        assert self.context.bindings[self.slot] is not None, "ERROR: unbinding root unbound var"
 
-        del self.context.bindings[self.token]
+        self.context.bindings[self.slot] = None
 
 
     def __repr__(self):
@@ -215,50 +304,125 @@ class Var(Term):
         
 
     def safeStr(self, verbose=VERBOSE, depth=10):
-        if depth == 0:
-            return "..."
+        return _termStr(self, verbose, depth)
 
-        # show context-less vars
-        if not isinstance(self.context, Rule):
-            return "(${}!!)".format(self.token)
 
+def _termStr(term, verbose, depth):
+    """ Stringifies term (for Functor/Var.safeStr), limits depth
+    Works off an explicit stack of pending (term, depth) pairs and literal strings
+    """
 
-        # Show unbound vars
-        boundval = self.deref()
-        if isinstance(boundval, Var):
+    out = []
+    stack = [(term, depth)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+
+        term, depth = item
+        if depth == 0:
+            out.append("...")
+            continue
+
+        if term.isVar():
+            # show context-less vars (e.g. from resolveCopy), flagged when verbose
+            if not isinstance(term.context, Rule):
+                out.append("(${}!!)".format(term.token) if verbose else term.token)
+                continue
+
+            # Show unbound vars
+            boundval = term.deref()
+            if boundval.isVar():
+                if verbose:
+                    out.append("(${}={})".format(term.nameWithId(), boundval.nameWithId()))
+                else:
+                    out.append(boundval.nameWithId()) #TODO: add depth indicator?
+                continue
+
+            # Else, we have a functor
             if verbose:
-                return "(${}={})".format(self.nameWithId(), boundval.nameWithId())
-            else:
-                return boundval.nameWithId() #TODO: add depth indicator?
+                out.append("(${}=".format(term.nameWithId()))
+                stack.append(")")
+            stack.append((boundval, depth-1))
+            continue
+
+        # Functor
+        subs = term.subterms
+        if len(subs) == 0:
+            out.append(str(term.token)) # (might be a number)
+            continue
 
-        # Else, we have a functor
         if verbose:
-            return "(${}={})".format(self.nameWithId(), boundval.safeStr(verbose, depth-1))
+            out.append("{}/{}(".format(term.token, len(subs)))
         else:
-            return boundval.safeStr(verbose, depth-1)
+            out.append("{}(".format(term.token))
+
+        # push children in reverse, so they pop in order
+        stack.append(")")
+        for i in reversed(range(len(subs))):
+            stack.append((subs[i], depth-1))
+            if i > 0:
+                stack.append(", ")
+
+    return "".join(out)
 
 
 class Rule:
     " Represents an instance of a rule (e.g. multiple invocations make multiple rule objs) "
 
     def __init__(self, headClause, bodyClauses):
-        self.bindings = {}
         self.head = headClause
         self.body = bodyClauses
 
+        self.varNames = [] # var name for each slot
+        slots = {}
+
         def reparent(term):
             if term.isVar():
                 term.context = self
 
+                # number the vars: each name gets one slot, each '_' gets its own
+                if term.token == "_":
+                    term.slot = len(self.varNames)
+                    self.varNames.append(term.token)
+                else:
+                    if term.token not in slots:
+                        slots[term.token] = len(self.varNames)
+                        self.varNames.append(term.token)
+                    term.slot = slots[term.token]
+
         # Set self as context for all vars in head & body clauses
-        self.head.shallowMap(reparent)
+        # (head can be None for a bare instance context, see wam.py)
+        if self.head is not None:
+            self.head.shallowMap(reparent)
         for bclause in self.body:
             bclause.shallowMap(reparent)
 
+        # Mark ground subterms, so copies of this rule share them
+        if self.head is not None:
+            markGround(self.head)
+        for bclause in self.body:
+            markGround(bclause)
+
+        self.bindings = [None] * len(self.varNames) # slot -> bound term, or None
 
         self.instanceId = -1 #Can be set to other values to distinguish among copies of vars
 
 
+    @classmethod
+    def Instance(_class, varNames):
+        " Makes an empty rule with room for varNames, to be filled in by a copier "
+        # (skips __init__: there are no terms to number the vars of)
+        inst = _class.__new__(_class)
+        inst.head = None
+        inst.body = []
+        inst.varNames = varNames # shared with the source rule, never changed
+        inst.bindings = [None] * len(varNames)
+        inst.instanceId = -1
+        return inst
+
+
     def setInstanceId(self,i):
         " Is called by consumers of Rules (i.e. prolog executor)"
         self.instanceId = i
@@ -267,10 +431,16 @@ class Rule:
     def copy(self):
         " Makes a copy: all variables in copy are unbound "
 
-        h2 = self.head.copy()
-        b2 = [b.copy() for b in self.body]
+        inst = Rule.Instance(self.varNames)
+        inst.head = self.head.copy(inst)
+        inst.body = [b.copy(inst) for b in self.body]
 
-        return Rule(h2, b2)
+        return inst
+
+
+    def boundVars(self):
+        " Returns list of (name, binding) for each bound var, in order of appearance "
+        return [(self.varNames[i], b) for i, b in enumerate(self.bindings) if b is not None]
 
 
     def __repr__(self):
@@ -278,9 +448,104 @@ class Rule:
         msg += "<Rule:\n"
         msg += "  HD: {}\n".format(str(self.head))
         msg += "  BODY: {}\n".format(", ".join(str(b) for b in self.body))
-        msg += "  Vars:{}>".format(self.bindings)
+        msg += "  Vars:{}>".format(dict(self.boundVars()))
         return msg
 
+
+def markGround(term):
+    """ Sets .ground on each functor in term (without following bindings)
+    Returns whether term is ground (has no vars at all)
+    """
+
+    if term.isVar():
+        return False
+
+    # Postorder, with an explicit stack: a functor is pushed again (in a tuple) after its subterms
+    stack = [term]
+    while stack:
+        t = stack.pop()
+        if isinstance(t, tuple):
+            t = t[0]
+            t.ground = all(not s.isVar() and s.ground for s in t.subterms)
+        elif not t.isVar():
+            stack.append((t,))
+            stack.extend(t.subterms)
+
+    return term.ground
+
+
+def _varKey(var):
+    " Identifies an (unbound) var: copies of a var share context & slot "
+    return (id(var.context), var.slot)
+
+
+def variantKey(term):
+    """ Returns a hashable key for term (following bindings), which is equal for two terms
+    iff they're variants: the same up to renaming of their unbound vars
+    Vars are numbered by first occurrence (as 1-tuples), functors are their symbols
+    """
+
+    key = []
+    varNums = {}
+    stack = [term]
+    while stack:
+        t = stack.pop()
+        if t.isVar():
+            t = t.deref()
+            if t.isVar():
+                key.append((varNums.setdefault(_varKey(t), len(varNums)),))
+                continue
+
+        key.append(t.sym)
+        stack.extend(reversed(t.subterms))
+
+    return tuple(key)
+
+
+def resolveCopy(term, varMap=None):
+    """ Copies term with all its bindings followed, so it no longer refers to any Rule
+    Unbound vars become fresh context-less Vars, named _G0, _G1, ... by first occurrence
+    (varMap maps old vars to new ones: pass the same dict to copy several terms consistently)
+    """
+
+    if varMap is None:
+        varMap = {}
+
+    def fresh(var):
+        key = _varKey(var)
+        if key not in varMap:
+            varMap[key] = Var("_G{}".format(len(varMap)))
+        return varMap[key]
+
+    if term.isVar():
+        term = term.deref()
+        if term.isVar():
+            return fresh(term)
+
+    # Same scheme as Functor.copy, but derefing as we go
+    if term.ground:
+        return term
+
+    top = Functor(term.token, term.subterms, term.sym)
+    stack = [top]
+    while stack:
+        subs = stack.pop().subterms
+        for i in range(len(subs)):
+            s = subs[i]
+            if s.isVar():
+                s = s.deref()
+                if s.isVar():
+                    subs[i] = fresh(s)
+                    continue
+
+            if s.ground:
+                subs[i] = s
+            else:
+                subs[i] = Functor(s.token, s.subterms, s.sym)
+                stack.append(subs[i])
+
+    return top
+
 # ============================================================
 #
 #                        UNIFICATION 
@@ -289,7 +554,55 @@ class Rule:
 
 
 # NOTE: How do we store undo entries?
-# (boundVar, "nice string")
+# Just the var that got bound: that's all unbind needs
+# (a description for debug output can be made later, by bindingStr)
+# They go on a Trail, shared by a whole execution
+
+
+class Trail:
+    """ Stack of bound vars, for undoing bindings when backtracking
+    Consumers take a mark() before trying something, and undoTo(mark) to take it back
+
+    Conditional trailing: vars from rule instances numbered >= boundary are newer
+    than anything we could backtrack to (they get thrown away along with their rule),
+    so bindings on them are never undone, and don't need to be trailed
+    """
+
+    def __init__(self):
+        self.vars = []
+        self.boundary = 0 # set by executor, compared against Rule.instanceId
+
+
+    def mark(self):
+        return len(self.vars)
+
+
+    def bind(self, var, term):
+        " Binds var <= term, trailing it if needed "
+        var.bindTo(term)
+        if var.context.instanceId < self.boundary:
+            self.vars.append(var)
+
+
+    def undoTo(self, mark):
+        " Unbinds all vars trailed since mark "
+        vars = self.vars
+        while len(vars) > mark:
+            vars.pop().unbind()
+
+
+    def since(self, mark, end=None):
+        " Returns list of vars trailed between mark and end (default: now) "
+        return self.vars[mark:end]
+
+
+def bindingStr(var):
+    " Describes the binding on var, for debug output: like 'X@2 <= foo(Y@3)' "
+    binding = var.context.bindings[var.slot]
+    if binding is None:
+        return "{} (unbound)".format(var.nameWithId())
+
+    return "{} <= {}".format(var.nameWithId(), binding)
 
 
 def unify(c1, c2):
@@ -305,60 +618,99 @@ MUST ONLY BE CALLED ON INITIALIZED TERMS
 
 
 
-def _tryUnify(c1, c2):
+def couldUnify(head, goal):
+    """
+Cheap pre-check: could head possibly unify with goal?
+Compares name/arity (symbols) of the two terms, and of each pair of their arguments
+Doesn't bind, copy, or allocate anything, so it's safe to call on an un-copied rule head
+Returns False only if unification would definitely fail
+    """
+
+    if goal.isVar():
+        goal = goal.deref()
+        if goal.isVar(): # unbound goal matches anything
+            return True
+
+    if head.sym != goal.sym:
+        return False
+
+    hargs, gargs = head.subterms, goal.subterms
+    for i in range(len(hargs)):
+        h, g = hargs[i], gargs[i]
+        if h.isVar():
+            continue
+
+        if g.isVar():
+            g = g.deref()
+            if g.isVar():
+                continue
+
+        if h.sym != g.sym:
+            return False
+
+    return True
+
+
+
+def _tryUnify(c1, c2, trail):
     """
 Helper: attempts to unify clause1 onto clause2
-Returns (success, bindingsMade)
+Returns success, bindings made are pushed onto trail
 Doesn't attempt to undo
 
 #c1 is the newer clause, will be bound to c2 if both are vars
+(works off an explicit stack of term pairs, left to right, so deep terms are fine)
     """
 
+    stack = [c1, c2] # pairs, flattened
+    while stack:
+        c2 = stack.pop()
+        c1 = stack.pop()
 
-    #C is for clause, d is for dereferenced, b is for bound?
+        #C is for clause, d is for dereferenced, b is for bound?
 
-    #dereference them (if we bind them, we want to work with the deepest level of var pointer)
-    d1, d2 = c1, c2
-    if d1.isVar():
-        d1 = d1.deref()
-    if d2.isVar():
-        d2 = d2.deref()
+        #dereference them (if we bind them, we want to work with the deepest level of var pointer)
+        d1, d2 = c1, c2
+        if d1.isVar():
+            d1 = d1.deref()
+        if d2.isVar():
+            d2 = d2.deref()
 
 
-    # Check if theyre bound (var is bound if it derefs to a nonvar)
-    b1, b2 = not d1.isVar(), not d2.isVar()
+        # Same term (e.g. a shared ground subterm, or the same unbound var): nothing to do
+        # (binding a var to itself would make a loop)
+        if d1 is d2:
+            continue
 
+        # Check if theyre bound (var is bound if it derefs to a nonvar)
+        b1, b2 = not d1.isVar(), not d2.isVar()
 
-    # ======== Switch on functor/var
 
-    if b1 and b2: #===== both are bound (functors):
-        if d1.token != d2.token:
-            #print("Unify failed: {} & {} name mismatch".format(d1.shortname(), d2.shortname()))
-            return (False, [])
+        # ======== Switch on functor/var
 
-        if len(d1.subterms) != len(d2.subterms):
-            #print("Unify failed: {} & {} arity mismatch".format(d1.shortname(), d2.shortname()))
-            return (False, [])
+        if b1 and b2: #===== both are bound (functors):
+            if d1.sym != d2.sym:
+                #print("Unify failed: {} & {} name/arity mismatch".format(d1.shortname(), d2.shortname()))
+                return False
 
-        else: #recursively unify children
-            bindings = []
-            for a,b in zip(d1.subterms, d2.subterms):
-                (succ, sub_binds) = _tryUnify(a,b)
-                bindings += sub_binds
+            #unify children next (pushed in reverse so they pop left to right)
+            s1, s2 = d1.subterms, d2.subterms
+            for i in reversed(range(len(s1))):
+                stack.append(s1[i])
+                stack.append(s2[i])
 
-                if not succ:
-                    return False, bindings
+            continue
 
-            return True, bindings
-                    
 
-    else: #=== At least one is a variable, need to do a binding
+        #=== At least one is a variable, need to do a binding
 
         # '_' var is special-cased, always succeeds, dont' need to unbind
         if d1.token == "_" or d2.token == "_":
-            return (True, [])
+            continue
 
         if    not b1 and not b2: #both unbound, bind newer clause to older
+            if d1.context is d2.context and d1.slot == d2.slot:
+                continue # same var (copies of a var are separate objects)
             bindee, target = d1, d2
 
         elif  not b2 and b1: #only b2 is var, bind it
@@ -370,13 +722,10 @@ Doesn't attempt to undo
             raise Exception("ERROR: SHOULDNT GET HERE")
 
 
-        #Need to store which var the binding was made on,
-        #Also want to have a descriptive string for it
-        binding = ( bindee, "{} <= {}".format(str(bindee), str(target)))
-
-        bindee.bindTo(target) # (it'll do the deref chain twice, but whatever)
+        #Need to store which var the binding was made on
+        trail.bind(bindee, target) # (it'll do the deref chain twice, but whatever)
 
-        return (True, [binding])
+    return True
 
 
 
@@ -388,36 +737,104 @@ Doesn't attempt to undo
 # ============================================================
 
 
+# The source is split into tokens by one compiled regex (TOKEN_RE), matched in place
+# against the input: a str, or a bytes-like object of utf-8 text (like an mmap'd file),
+# where only the tokens themselves get decoded. Whitespace & comments are skipped.
+#
+# Token kinds:
+#   neck    ':-'
+#   ite     '->' (as an infix operator: '->(' is an ident followed by '(', see _parseIte)
+#   neg     '\+' (as a prefix operator: '\+(' is an ident followed by '(')
+#   punct   one of ( ) , . ; !
+#   ident   a run of identifier chars [-=?+*<>/\A-Za-z0-9_], or ':' between two '='
+#           (just so the comparison `=:=` is one: `a:b` isn't an identifier)
+#           names of functors & vars, and numbers
+#
+# NOTE: '->' and '\+' are made of identifier chars too, but an identifier never runs
+# into one: `a->b` is `a -> b`, an if-then, whatever the spacing. They're only part of an
+# identifier when they're all of it, as a functor's name (`->(a, b)`), and where a term
+# is expected they're just atoms (like `f(->)`)
+
+SKIP_RE = r"(?:\s+|%[^\n]*)*"
+
+TOKEN_RE = SKIP_RE + r"""
+    (?:
+    (?P<neck>  :- )
+  | (?P<ite>   ->(?!\() )
+  | (?P<neg>   \\\+(?!\() )
+  | (?P<punct> [(),.;!] )
+  | (?P<ident> (?:->|\\\+)(?=\() | (?:[=?+<>/*A-Za-z0-9_]|-(?!>)|\\(?!\+)|(?<==):(?==))+ )
+  | (?P<end>   \Z )
+    )
+"""
+_STR_RES = (re.compile(TOKEN_RE, re.VERBOSE), re.compile(SKIP_RE))
+_BYTES_RES = (re.compile(TOKEN_RE.encode(), re.VERBOSE), re.compile(SKIP_RE.encode()))
+
+
 class ParseStream:
-    " Represents state of the parser through its input "
+    """ Represents state of the parser through its input: a stream of tokens
+    peek() is the text of the current token (None at end of input), drop() moves past it
+    """
 
     def __init__(self, instr):
         self.str = instr
-        self.offset = 0
-        self.lineno = 1
-        self.colno = 1
+        self.binary = not isinstance(instr, str)
+        self.tokenRe, self.skipRe = _BYTES_RES if self.binary else _STR_RES
+
+        self.offset = 0  # where the current token starts
+        self.end = 0     # where it ends (where to look for the next one)
+        self.kind = None # kind of current token (None at end of input)
+        self.text = None
+        self.atoms = {}  # ident -> atom, so the same atom is one shared object throughout
+        self.drop() # read the first token
+
 
     def peek(self):
-        " returns next char or None "
-        off = self.offset
-        return self.str[off] if off < len(self.str) else None
+        " returns text of current token, or None at end of input "
+        return self.text
+
 
     def drop(self):
-        if self.peek() == '\n':
-            self.lineno += 1
-            self.colno = 1
+        " moves on to the next token "
+        m = self.tokenRe.match(self.str, self.end)
+        if m is None:
+            self.offset = self.skipRe.match(self.str, self.end).end()
+            self.raiseErr("Unexpected character")
+
+        kind = m.lastgroup
+        self.offset = m.start(kind)
+        self.end = m.end()
+        if kind == "end":
+            self.kind = self.text = None
+            return
+
+        self.kind = kind
+        self.text = m.group(kind).decode("utf-8") if self.binary else m.group(kind)
+
+
+    @property
+    def lineno(self):
+        " line of the current token (worked out from scratch: only needed for errors) "
+        newline = b'\n' if self.binary else '\n'
+        return self.str[:self.offset].count(newline) + 1
+
+    @property
+    def colno(self):
+        newline = b'\n' if self.binary else '\n'
+        return self.offset - (self.str[:self.offset].rfind(newline) + 1) + 1
 
-        self.offset += 1
 
     def assertNext(self, c):
-        if self.peek() != c:
-            raise ParseError("ERROR: expected next char '{}', at {}".format(c, str(self)))
+        if self.text != c:
+            raise ParseError("ERROR: expected '{}', at {}".format(c, str(self)))
 
     def raiseErr(self, error=""):
         raise ParseError("ERROR: {}, at {}".format(error, str(self)))
 
     def __repr__(self):
         context = self.str[self.offset: self.offset + 20]
+        if self.binary:
+            context = bytes(context).decode("utf-8", errors="replace")
         if(len(self.str) >= self.offset + 20):
             context += "..."
 
@@ -427,188 +844,225 @@ class ParseStream:
 
 
 
+NUMBER_RE = re.compile(r'-?[0-9]+')
 
-def _chomp(strm):
-    while strm.peek() in [' ', '\r', '\n', '\t']:
-        strm.drop()
 
-    if strm.peek() == '%':
-        _chompComment(strm)
-        _chomp(strm) #keep chomping after a comment, there might be more whitespace
+def _parseTerm(strm):
+    " We're expecting a term "
 
+    if strm.kind != "ident":
+        if strm.kind is None:
+            strm.raiseErr("expecting Term, got end of input")
+        if strm.kind not in ("ite", "neg"): # (operators are atoms here, see TOKEN_RE)
+            strm.raiseErr("expecting Term")
+        return _parseFunctor(strm)
 
-def _chompComment(strm):
-    " call at %, chomps to \n "
-    strm.assertNext('%')
-    strm.drop()
+    c = strm.text[0]
+    if c.isupper() or c =='_':
+        return _parseVar(strm)
+    else:
+        return _parseFunctor(strm)
 
-    # chomp to newline
-    while strm.peek() not in ['\n', None]:
-        strm.drop()
 
-    strm.drop() #drop newline
+def _parseVar(strm):
+    " We're at an ident starting with an uppercase letter (or '_') "
 
+    var = Var(sys.intern(strm.text))
+    strm.drop()
+    return var
 
 
-def _parseIdentChar(strm):
-    "Consumes one char of identifier of [=?+*<>/A-Za-z0-9_], else return None"
-    # DOESNT CHOMP
-    c = strm.peek()
-    if ((c is not None)) and re.match(r'[\-=?+<>/\*A-Za-z0-9_]', c):
-        strm.drop()
-        return c
+def _parseFunctor(strm):
+    " We're at any other ident: parse off a functor and subterms "
 
-    else:
-        return None
+    head_ident = strm.text
+    strm.drop()
 
-def _parseIdent(strm):
-    "Snags an identifier of identChars, or None if doesn't match"
-    # DOESNT CHOMP
+    # if not '(', is atom (numeric literals are atoms with an int token)
+    if strm.text != '(':
+        atom = strm.atoms.get(head_ident)
+        if atom is None:
+            token = int(head_ident) if NUMBER_RE.fullmatch(head_ident) else sys.intern(head_ident)
+            atom = strm.atoms[head_ident] = Functor(token, [])
+        return atom
 
-    result = ""
+    if NUMBER_RE.fullmatch(head_ident):
+        strm.raiseErr("Numbers can't have arguments")
+    head_ident = sys.intern(head_ident) # (so all parsed terms share name strings)
+
+
+    children = []
+    # Else: we're in the child subterms
+    strm.drop() # drop the '('
     while True:
-        c = _parseIdentChar(strm)
-        if c is None:
+        children.append(_parseTerm(strm))
+
+        #Now: check if continue ',' or end ')'
+        c = strm.text
+
+        if c == ',':
+            strm.drop() # drop the ','
+            continue
+
+        if c == ')':
+            strm.drop() # drop the ')'
             break
 
-        result += c
+        strm.raiseErr("Parsing functor subterms, expected ',' or ')'")
 
-    if result == "":
-        return None
+    # We've parsed all children
+    return Functor(head_ident, children)
 
-    return result
 
+# === Goal parser (for rule bodies)
+# Bodies can use control constructs, with the usual precedence (',' binds tightest):
+#   disj := ite [';' disj]
+#   ite  := conj ['->' conj]
+#   conj := goal [',' conj]
+#   goal := '(' disj ')' | '!' | '\+' goal | TERM
+# These all parse into ordinary terms: ;/2, ->/2, ','/2, \+/1 and !/0
 
-def _parseTerm(strm):
-    " We're expecting a term "
 
-    _chomp(strm)
+def _parseDisj(strm):
+    " Parses a disjunction (or anything tighter) "
+    left = _parseIte(strm)
 
-    #TODO:
-    # parens?
+    if strm.text == ';':
+        strm.drop() # drop the ';'
+        return Functor(";", [left, _parseDisj(strm)])
 
-    c = strm.peek()
+    return left
 
-    if c.isupper() or c =='_':
-        return _parseVar(strm)
-    else:
-        return _parseFunctor(strm)
 
+def _parseIte(strm):
+    " Parses an if-then (or anything tighter) "
+    cond = _parseConj(strm)
 
-    # Else: neither
-    strm.raiseErr("expecting Term, got non-alpha char")
+    # ('->(' right after a goal is still an if-then: it tokenizes as an ident there)
+    if strm.kind == "ite" or (strm.kind == "ident" and strm.text == "->"):
+        strm.drop() # drop the '->'
+        return Functor("->", [cond, _parseConj(strm)])
 
+    return cond
 
-def _parseVar(strm):
-    " We're at an uppercase letter: parse off a char"
 
-    ident = _parseIdent(strm)
-    if ident is None:
-        strm.raiseErr("Failed to get ident in _parseVar")
+def _parseConj(strm):
+    " Parses a conjunction of goals, into right-nested ','/2 "
+    goals = [_parseGoal(strm)]
+    while strm.text == ',':
+        strm.drop() # drop the ','
+        goals.append(_parseGoal(strm))
 
-    return Var(ident)
+    result = goals[-1]
+    for g in reversed(goals[:-1]):
+        result = Functor(",", [g, result])
 
-def _parseFunctor(strm):
-    " We're at a lowercase letter: parse off a functor and subterms "
+    return result
 
-    head_ident = _parseIdent(strm)
-    if head_ident is None:
-        strm.raiseErr("Failed to get ident in _parseFunctor")
 
+def _parseGoal(strm):
+    " Parses a single goal: a parenthesized body, a cut, a negation, or a plain term "
 
-    # now need to parse subterms
-    _chomp(strm)
+    if strm.kind == "punct":
+        if strm.text == '(':
+            strm.drop() # drop the '('
+            goal = _parseDisj(strm)
+            strm.assertNext(')')
+            strm.drop() # drop the ')'
+            return goal
 
-    c = strm.peek()
+        if strm.text == '!':
+            strm.drop() # drop the '!'
+            return Functor("!", [])
 
-    # if '(', parse subterms, else is atom
-    if c != '(':
-        return Functor(head_ident, [])
+    if strm.kind == "neg":
+        strm.drop() # drop the '\+'
+        return Functor("\\+", [_parseGoal(strm)])
 
+    return _parseTerm(strm)
 
-    children = []
-    # Else: we're in the child subterms
-    strm.drop() # drop the '('
-    while True:
-        _chomp(strm)
 
-        child = _parseTerm(strm)
-        children.append(child)
+def _flattenConj(goal):
+    " Splits a ','/2 conjunction into a list of goals "
+    goals = []
+    while not goal.isVar() and goal.token == "," and len(goal.subterms) == 2:
+        goals.append(goal.subterms[0])
+        goal = goal.subterms[1]
 
-        #Now: check if continue ',' or end ')'
-        _chomp(strm)
-        c = strm.peek()
+    goals.append(goal)
+    return goals
 
-        if c == ',':
-            strm.drop() # drop the ','
-            continue
 
-        if c == ')':
-            strm.drop() # drop the ')'
-            break
+# === Rule parser
 
-        strm.raiseErr("Parsing functor subterms, expected ',' or ')'")
+def _parseDirective(strm):
+    """ Parses the rest of a ':- GOAL.' directive (after the ':-'), into a Rule with no head
+    There are no prefix operators, but ':- table p/2, q/3.' is special-cased
+    (p/2 is just an identifier, so it parses as an atom)
+    """
 
-    # We've parsed all children
-    return Functor(head_ident, children)
+    goal = _parseTerm(strm)
 
+    if not goal.isVar() and goal.token == "table" and len(goal.subterms) == 0 and strm.text != '.':
+        specs = [_parseTerm(strm)]
+        while strm.text == ',':
+            strm.drop() # drop the ','
+            specs.append(_parseTerm(strm))
+        goal = Functor("table", specs)
 
-# === Rule parser
+    if strm.text != '.':
+        strm.raiseErr("Expected '.' after directive")
+    strm.drop() # drop the '.'
+
+    return Rule(None, [goal])
 
 
 def _parseRule(strm):
     """ Parse a rule of the form TERM. or TERM:- BODY, BODY, ... , .
+    or a directive :- GOAL. (which has no head)
     returns None if at EOF
     """
 
     # check if has head
-    _chomp(strm)
-    c = strm.peek()
-    if c is None:
+    if strm.kind is None:
         return None
-    
 
-    head = _parseTerm(strm)
+    if strm.kind == "neck":
+        strm.drop() # drop the ':-'
+        return _parseDirective(strm)
 
-    # check if has body
-    _chomp(strm)
-    c = strm.peek()
+    head = _parseTerm(strm)
 
     # if '.' then it's a fact, if ":-" then it has a body
-    if c == '.':
+    if strm.text == '.':
         strm.drop()
         return Rule(head,[])
 
-    elif c != ':':
+    elif strm.kind != "neck":
         strm.raiseErr("Expected '.' or ':-' after rule head")
 
     #else: we're in a "head :- b1, ..., bn ." rule
-    body = []
-    strm.drop() # drop the ':'
-    strm.assertNext('-')
-    strm.drop() # drop the '-'
+    strm.drop() # drop the ':-'
 
-    while True:
-        _chomp(strm)
-        b = _parseTerm(strm)
-        body.append(b)
+    # top-level conjunction becomes the body list
+    body = _flattenConj(_parseDisj(strm))
 
-        #Now: check if continue ',' or end '.'
-        _chomp(strm)
-        c = strm.peek()
+    #Now: should be at end '.'
+    if strm.text != '.':
+        strm.raiseErr("Parsing rule body clauses, expected ',', ';', '->' or '.'")
+    strm.drop() # drop the '.'
 
-        if c == ',':
-            strm.drop() # drop the ','
-            continue
 
-        if c == '.':
-            strm.drop() # drop the '.'
-            break
-
-        strm.raiseErr("Parsing rule body clauses, expected ',' or '.'")
+    return Rule(head, body)
 
 
-    return Rule(head, body)
+def iterRules(strm):
+    " Yields each rule (or headless directive) parsed from strm, in order, as it's parsed "
+    while True:
+        rule = _parseRule(strm)
+        if rule is None:
+            return
+        yield rule
 
 
 
@@ -676,9 +1130,10 @@ def testUnify1():
     s2= "f(l(H1, l(H2, Tl)), Tl)."
     r2 = _parseRule(ParseStream(s2))
 
-    succ, bindings = _tryUnify(r1.head, r2.head)
+    trail = Trail()
+    succ = _tryUnify(r1.head, r2.head, trail)
     print(succ)
-    print("\n".join(b[1] for b in bindings))
+    print("\n".join(bindingStr(b) for b in trail.since(0)))
 
     print()
     print(r2)
@@ -691,9 +1146,10 @@ def testUnify2():
     s2= "f(l(a, l(H2, Tl)), Tl)."
     r2 = _parseRule(ParseStream(s2))
 
-    succ, bindings = _tryUnify(r1.head, r2.head)
+    trail = Trail()
+    succ = _tryUnify(r1.head, r2.head, trail)
     print(succ)
-    print("\n".join(b[1] for b in bindings))
+    print("\n".join(bindingStr(b) for b in trail.since(0)))
 
     print()
     print(r2)
@@ -711,22 +1167,22 @@ def testUnifyUndo():
     r3 = _parseRule(ParseStream(s3))
 
 
-    succ, bindings = _tryUnify(r1.head, r2.head)
+    trail = Trail()
+    succ = _tryUnify(r1.head, r2.head, trail)
     print(succ)
-    print("\n".join(b[1] for b in bindings))
+    print("\n".join(bindingStr(b) for b in trail.since(0)))
 
     print("undoing...")
 
-    for b in reversed(bindings):
-        b[0].unbind()
+    trail.undoTo(0)
 
     print(r1)
     print(r2)
     print(r3)
 
-    succ, bindings = _tryUnify(r1.head, r3.head)
+    succ = _tryUnify(r1.head, r3.head, trail)
     print(succ)
-    print("\n".join(b[1] for b in bindings))
+    print("\n".join(bindingStr(b) for b in trail.since(0)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,456 @@
+# (python3)
+import clause as cls
+import operator
+
+
+"""
+Bottom-up evaluation for jpl, for programs that are plain Datalog
+
+Instead of resolving goals top-down (jpl.TakeStep), every relation the query needs
+is computed in full, from the facts up (materialized), and the query is answered
+by looking it up. This only works for Datalog: no compound terms, no builtins
+other than comparisons, and every var in a rule head shows up in its body.
+
+- Predicates are split into strongly connected components (mutually recursive groups),
+  and evaluated in dependency order
+- Each group is iterated to a fixpoint semi-naively: after the first round, each
+  rule only gets run with (at least) one body literal reading the facts that are
+  new since the last round (the "delta"). Literals before that one read the facts
+  from before the last round, so nothing is derived twice the same way
+- Body literals are joined left to right, with hash indexes on whichever argument
+  positions are already known
+
+Only the predicates reachable from a query need to be Datalog, so this works on
+programs which also have non-Datalog parts (like a user-defined =/2).
+Answers are sets: same as top-down (jpl.outerInterp) but without duplicates, and sorted.
+
+Used by jpl.Program when its engine is ENGINE_DATALOG
+"""
+
+
+class NotDatalog(Exception):
+    " Query (or a rule it needs) isn't Datalog-safe, so can't be evaluated bottom-up "
+    pass
+
+class DatalogError(Exception):
+    " Runtime error during evaluation (e.g. comparing an atom) "
+    pass
+
+
+# Comparison builtins (same as jpl's), allowed in bodies between vars and integers
+COMPARISONS = {
+    ("<", 2): operator.lt,
+    (">", 2): operator.gt,
+    ("=<", 2): operator.le,
+    (">=", 2): operator.ge,
+    ("=:=", 2): operator.eq,
+    ("=\\=", 2): operator.ne,
+}
+
+# Builtins that do nothing
+SKIPPED = {("true", 0)}
+
+# Other builtins/control constructs in jpl: not Datalog
+# (anything here isn't looked up as a relation)
+NOT_DATALOG = {("is", 2), ("fail", 0), ("false", 0),
+        ("!", 0), (",", 2), (";", 2), ("->", 2), ("\\+", 1)}
+
+# The same, keyed by symbol id (predicates are keyed by their symbol everywhere below)
+_COMPARISONS_BY_SYM = {cls.symbolId(*key): op for key, op in COMPARISONS.items()}
+_SKIPPED_SYMS = {cls.symbolId(*key) for key in SKIPPED}
+_NOT_DATALOG_SYMS = {cls.symbolId(*key) for key in NOT_DATALOG}
+
+
+# ============================================================
+#
+#                  RELATIONS AND COMPILED RULES
+#
+# ============================================================
+
+class Relation:
+    """ A set of tuples (of atom/integer tokens), with hash indexes
+    Indexes are made on first lookup, for whichever set of positions is asked for,
+    and kept up to date as tuples get added
+    """
+
+    def __init__(self, tuples=()):
+        self.tuples = set()
+        self.indexes = {}   # positions -> {values at positions -> [tuples]}
+        for t in tuples:
+            self.add(t)
+
+
+    def add(self, t):
+        " Adds tuple t, returns whether it was new "
+        if t in self.tuples:
+            return False
+
+        self.tuples.add(t)
+        for positions, index in self.indexes.items():
+            index.setdefault(tuple(t[i] for i in positions), []).append(t)
+        return True
+
+
+    def lookup(self, positions, key):
+        " Returns the tuples with values key at positions (all tuples, if no positions) "
+        if not positions:
+            return self.tuples
+
+        index = self.indexes.get(positions)
+        if index is None:
+            index = {}
+            for t in self.tuples:
+                index.setdefault(tuple(t[i] for i in positions), []).append(t)
+            self.indexes[positions] = index
+
+        return index.get(key, ())
+
+
+    def __len__(self):
+        return len(self.tuples)
+
+
+EMPTY = Relation()
+
+
+# Args (of heads & literals) are compiled to (isVar, value): value is a var's slot or a token
+
+def _compileArgs(term, where):
+    " Compiles the args of term, raising NotDatalog if any are compound "
+    args = []
+    for a in term.subterms:
+        if a.isVar():
+            args.append((True, a.slot))
+        elif len(a.subterms) == 0:
+            args.append((False, a.token))
+        else:
+            raise NotDatalog("compound term {} in {}".format(a, where))
+    return args
+
+
+class Literal:
+    """ A body literal, ready to join: which of its positions are already bound
+    when it's reached (and what to look them up with), and which ones bind vars
+    """
+
+    def __init__(self, pred, args, bound):
+        " bound is the set of var slots bound by earlier literals (gets updated) "
+        self.pred = pred
+        self.positions = []  # positions to look up on
+        self.key = []        # (isVar, value) for each of those
+        self.binds = []      # (position, slot): first occurrence of a var
+        self.checks = []     # (position, position): repeat of a var first bound in this literal
+
+        newVars = {} # slot -> position first bound at
+        for i, (isVar, v) in enumerate(args):
+            if not isVar or v in bound:
+                self.positions.append(i)
+                self.key.append((isVar, v))
+            elif v in newVars:
+                self.checks.append((i, newVars[v]))
+            else:
+                newVars[v] = i
+                self.binds.append((i, v))
+
+        self.positions = tuple(self.positions)
+        bound.update(newVars)
+
+
+class Comparison:
+    " A comparison builtin between (bound) vars and integers "
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+
+
+class CompiledRule:
+    """ A rule (or query) compiled for bottom-up joins
+    The body stays in source order: a comparison has to come after literals binding its
+    vars (else top-down could raise an error, or not, depending on how it's called)
+    """
+
+    def __init__(self, rule, where):
+        self.numVars = len(rule.varNames)
+        self.head = None if rule.head is None else _compileArgs(rule.head, where)
+
+        self.body = []
+        bound = set()
+        for goal in rule.body:
+            if goal.isVar():
+                raise NotDatalog("var goal {} in {}".format(goal, where))
+
+            key = goal.sym
+            if key in _SKIPPED_SYMS:
+                continue
+            if key in _NOT_DATALOG_SYMS:
+                raise NotDatalog("{} in {}".format(goal.shortname(), where))
+
+            args = _compileArgs(goal, where)
+            if key in _COMPARISONS_BY_SYM:
+                for isVar, v in args:
+                    if not isVar and not isinstance(v, int):
+                        raise NotDatalog("comparison on non-number {} in {}".format(v, where))
+                    if isVar and v not in bound:
+                        raise NotDatalog("comparison on {} before a literal binds it, in {}"
+                                .format(rule.varNames[v], where))
+                self.body.append(Comparison(_COMPARISONS_BY_SYM[key], args))
+            else:
+                self.body.append(Literal(key, args, bound))
+
+        # range restriction: every head var must get bound by the body
+        if self.head is not None:
+            for isVar, v in self.head:
+                if isVar and v not in bound:
+                    raise NotDatalog("head var {} not bound by the body, in {}"
+                            .format(rule.varNames[v], where))
+
+        self.bound = bound
+
+
+    def preds(self):
+        " Predicates read by the body "
+        return [lit.pred for lit in self.body if isinstance(lit, Literal)]
+
+
+    def join(self, relFor):
+        """ Joins the body literals left to right, relFor(i, pred) gives the Relation
+        for the i-th body entry. Returns list of var environments (lists by slot)
+        """
+
+        envs = [[None] * self.numVars]
+        for i, lit in enumerate(self.body):
+            if isinstance(lit, Comparison):
+                envs = [env for env in envs if _compare(lit, env)]
+                continue
+
+            rel = relFor(i, lit.pred)
+            out = []
+            for env in envs:
+                key = tuple(env[v] if isVar else v for isVar, v in lit.key)
+                for t in rel.lookup(lit.positions, key):
+                    if lit.checks and any(t[p] != t[q] for p, q in lit.checks):
+                        continue
+                    newEnv = env[:]
+                    for p, v in lit.binds:
+                        newEnv[v] = t[p]
+                    out.append(newEnv)
+            envs = out
+
+            if not envs:
+                break
+
+        return envs
+
+
+    def headTuple(self, env):
+        return tuple(env[v] if isVar else v for isVar, v in self.head)
+
+
+def _compare(comp, env):
+    values = [env[v] if isVar else v for isVar, v in comp.args]
+    for v in values:
+        if not isinstance(v, int):
+            raise DatalogError("{} is not a number".format(v))
+    return comp.op(*values)
+
+
+# ============================================================
+#
+#                         EVALUATOR
+#
+# ============================================================
+
+class Evaluator:
+    """ Bottom-up evaluator over a program's rules
+    Relations get computed the first time a query needs them, then kept
+    (the program never changes)
+    """
+
+    def __init__(self, rules, predIndex):
+        """ predIndex maps name/arity symbols to the positions of their rules in rules
+        (as jpl.Program's): rules only get looked at once their predicate's needed,
+        so ones still in a cache (progcache.LazyRules) don't get decoded up front
+        """
+        self.rules = rules
+        self.predIndex = predIndex
+        # (LazyRules can read facts' args without rebuilding them)
+        factArgs = getattr(rules, "factArgs", None)
+        self.factArgs = factArgs if factArgs is not None else lambda i: _factArgs(rules[i])
+
+        self.relations = {} # name/arity symbol -> Relation, for every predicate evaluated so far
+        self.compiled = {}  # name/arity symbol -> [CompiledRule]
+        self.facts = {}     # name/arity symbol -> [tuple], for its facts on atoms/numbers
+
+
+    def _compilePred(self, pred):
+        """ Compiles (and caches) the rules for pred, raising NotDatalog if one isn't
+        (facts on just atoms and numbers don't need compiling: they go in self.facts)
+        """
+        if pred not in self.compiled:
+            where = "{}/{}".format(*cls.symbolName(pred))
+            compiled, facts = [], []
+            for i in self.predIndex.get(pred, []):
+                t = self.factArgs(i)
+                if t is None:
+                    compiled.append(CompiledRule(self.rules[i], where))
+                else:
+                    facts.append(t)
+            self.compiled[pred] = compiled
+            self.facts[pred] = facts
+        return self.compiled[pred]
+
+
+    def _components(self, roots):
+        """ Returns the strongly connected components of the predicates reachable from roots
+        (that aren't evaluated yet), dependencies first (Tarjan's algorithm, iteratively)
+        """
+
+        index, low = {}, {}
+        onStack, stack = set(), []
+        components = []
+
+        for root in roots:
+            if root in index or root in self.relations:
+                continue
+
+            # each frame is (pred, iterator over its dependencies)
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            onStack.add(root)
+            work = [(root, iter(self._deps(root)))]
+
+            while work:
+                pred, deps = work[-1]
+                for dep in deps:
+                    if dep in self.relations:
+                        continue
+                    if dep not in index:
+                        index[dep] = low[dep] = len(index)
+                        stack.append(dep)
+                        onStack.add(dep)
+                        work.append((dep, iter(self._deps(dep))))
+                        break
+                    if dep in onStack:
+                        low[pred] = min(low[pred], index[dep])
+                else:
+                    # done with pred's dependencies
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[pred])
+
+                    if low[pred] == index[pred]:
+                        component = []
+                        while True:
+                            p = stack.pop()
+                            onStack.discard(p)
+                            component.append(p)
+                            if p == pred:
+                                break
+                        components.append(component)
+
+        return components
+
+
+    def _deps(self, pred):
+        deps = []
+        for crule in self._compilePred(pred):
+            deps.extend(crule.preds())
+        return deps
+
+
+    def _evalComponent(self, component):
+        " Evaluates a group of mutually recursive predicates to a fixpoint, semi-naively "
+
+        inComponent = set(component)
+        full = {p: Relation() for p in component}
+        old = {p: Relation() for p in component} # full as of the start of the round
+        rules = [(p, crule) for p in component for crule in self._compilePred(p)]
+
+        def fullRel(i, pred):
+            if pred in inComponent:
+                return full[pred]
+            return self.relations.get(pred, EMPTY)
+
+        # First round: everything (facts, and rules over lower components)
+        delta = {p: Relation(self.facts[p]) for p in component}
+        for p, crule in rules:
+            for env in crule.join(fullRel):
+                t = crule.headTuple(env)
+                if t not in full[p].tuples:
+                    delta[p].add(t)
+        for p in component:
+            for t in delta[p].tuples:
+                full[p].add(t)
+
+        # Later rounds: only derivations using at least one new tuple. Entry i reads the
+        # delta, entries before it the old relations, entries after it the full ones: so
+        # each derivation only gets made for the first of its literals to read a new tuple
+        while any(len(d) for d in delta.values()):
+            newDelta = {p: Relation() for p in component}
+            for p, crule in rules:
+                for i, lit in enumerate(crule.body):
+                    if not isinstance(lit, Literal) or lit.pred not in inComponent:
+                        continue
+                    if not len(delta[lit.pred]):
+                        continue
+
+                    def relFor(j, pred, i=i):
+                        if pred not in inComponent or j > i:
+                            return fullRel(j, pred)
+                        return delta[pred] if j == i else old[pred]
+
+                    for env in crule.join(relFor):
+                        t = crule.headTuple(env)
+                        if t not in full[p].tuples:
+                            newDelta[p].add(t)
+
+            for p in component:
+                for t in delta[p].tuples:
+                    old[p].add(t)
+                for t in newDelta[p].tuples:
+                    full[p].add(t)
+            delta = newDelta
+
+        self.relations.update(full)
+
+
+    def query(self, queryRule):
+        """ Answers queryRule (body only), returning a sorted list of answers,
+        each a list of (var name, value term), like Rule.boundVars()
+        Raises NotDatalog if the query or a predicate it needs isn't Datalog
+        """
+
+        crule = CompiledRule(queryRule, "query")
+
+        # Make sure everything the query reads is Datalog, before doing any work
+        roots = crule.preds()
+        components = self._components(roots)
+        for component in components:
+            self._evalComponent(component)
+
+        envs = crule.join(lambda i, pred: self.relations.get(pred, EMPTY))
+
+        # answers on the named query vars, without duplicates
+        shown = [slot for slot, name in enumerate(queryRule.varNames)
+                if name != "_" and slot in crule.bound]
+        answers = {tuple(env[s] for s in shown) for env in envs}
+
+        return [[(queryRule.varNames[s], cls.Functor(v, [])) for s, v in zip(shown, answer)]
+                for answer in sorted(answers, key=_sortKey)]
+
+
+def _factArgs(rule):
+    " Tokens of rule's head args, if it's a fact whose args are all atoms or numbers, else None "
+    if rule.body:
+        return None
+    args = rule.head.subterms
+    if any(a.isVar() or a.subterms for a in args):
+        return None
+    return tuple(a.token for a in args)
+
+
+def _sortKey(answer):
+    " Sorts answers: integers before atoms "
+    return tuple((1, v) if isinstance(v, str) else (0, v) for v in answer)
@@ -3,12 +3,32 @@
 
 # (python3)
 import clause as cls
+import datalog
+import profiler
+import progcache
+import share
+import wam
+import argparse
+import itertools
+import json
+import mmap
+import multiprocessing
+import operator
+import os
 import readline
 import sys
+import time
 
 VERSION = 0.2
 VERBOSE = False
 
+# Engines (how TakeStep matches rule heads against goals)
+ENGINE_TREE = "tree"          # copy the rule, then walk term trees in cls._tryUnify
+ENGINE_COMPILED = "compiled"  # run precompiled head instructions (wam.py), no copying
+ENGINE_DATALOG = "datalog"    # evaluate bottom-up (datalog.py) when the query allows, else tree
+ENGINE_SHARED = "shared"      # structure sharing (share.py): rule instances are just binding frames
+ENGINES = [ENGINE_TREE, ENGINE_COMPILED, ENGINE_DATALOG, ENGINE_SHARED]
+
 """
 Interpreter for jan prolog
 
@@ -16,12 +36,10 @@ Uses rules/terms/unification from clause.py
 
 TODO:
 - Add a way to run a single query (from cmd line? from func?) (for testing)
-- Add some tests
 
 TODO-EVENTUAL:
 - Integrity check, all vars in step stack/rule stack should only be bound thru vars
   also within the stack
-- Indexing: let Program do some smart filtering
 
 """
 
@@ -38,42 +56,221 @@ def dprint(*args):
 
 
 class Program:
-    " Small abstraction around a list of rules"
+    """ Small abstraction around a list of rules
+    Keeps an index of the rules, keyed on predicate name/arity, and on
+    the principal functor of the first argument (first-argument indexing)
+    (name/arity keys are symbols, see cls.symbolId)
+    """
 
-    def __init__(self, rules):
+    def __init__(self, rules, engine=ENGINE_TREE, directives=(), index=None):
+        " index is (predIndex, varIndex, argIndex) if already built (see progcache.py) "
+        assert engine in ENGINES, "ERROR: unknown engine '{}'".format(engine)
         self.rules = rules
-        
+        self.engine = engine
+        self.directives = list(directives)
+
+        if index is None:
+            self._buildIndex()
+        else:
+            self.allRules = list(range(len(rules)))
+            self.predIndex, self.varIndex, self.argIndex = index
+
+        # Tabling (see TABLING below): which predicates are tabled, and their answer tables
+        self.tabled = set()     # symbol ids (name/arity)
+        self.tables = {}        # cls.variantKey of call -> Table
+        self.tableStack = []    # Tables being filled in, outermost first
+        self.answersAdded = 0   # running count of answers added to any table
+        self.incompleteReads = 0 # running count of reads from tables still being filled
+
+        # Running counts over every query on this program (see outerInterp)
+        self.steps = 0          # steps attempted (TakeStep calls, including retries)
+        self.inferences = 0     # of those, ones that made progress (logical inferences)
+
+        # a profiler.Profiler to report steps to, or None (off)
+        self.profiler = None
+
+        # time.monotonic() after which outerInterp gives up with QueryTimeout, or None (see solve)
+        self.deadline = None
+
+        # self.steps from which outerInterp gives up with StepLimit, or None (see _runTask)
+        self.stepLimit = None
+
+        # an OrParallel or AndParallel to answer top-down queries with, or None (see queryAnswers)
+        self.parallel = None
+
+        for d in directives:
+            self._runDirective(d)
+
+        # clauses are what getMatchingRule hands out: either the rules themselves,
+        # or their compiled forms (same order, so the same indexes apply)
+        if engine == ENGINE_COMPILED:
+            self.clauses = wam.compileRules(rules)
+        else:
+            self.clauses = rules
+
+        # bottom-up evaluator, for Datalog queries
+        self.datalog = datalog.Evaluator(rules, self.predIndex) if engine == ENGINE_DATALOG else None
+
+
+    def _buildIndex(self):
+        """ Builds rule indexes (all of them are lists of positions into self.rules,
+        kept in program order, so answer order is unchanged by indexing):
+
+        predIndex:  name/arity -> every rule for that predicate
+        varIndex:   name/arity -> rules whose first arg is a var (match any first arg)
+        argIndex:   name/arity -> {first-arg name/arity -> rules that could match it}
+        """
+
+        self.allRules = list(range(len(self.rules)))
+        self.predIndex = {}
+        self.varIndex = {}
+        self.argIndex = {}
+
+        for i, rule in enumerate(self.rules):
+            head = rule.head
+            pred = head.sym
+            self.predIndex.setdefault(pred, []).append(i)
+
+            if len(head.subterms) == 0:
+                continue
+
+            varRules = self.varIndex.setdefault(pred, [])
+            keyed = self.argIndex.setdefault(pred, {})
+            first = head.subterms[0]
+
+            if first.isVar():
+                # var first arg can match anything: goes in every bucket
+                varRules.append(i)
+                for bucket in keyed.values():
+                    bucket.append(i)
+            else:
+                key = first.sym
+                if key not in keyed:
+                    keyed[key] = list(varRules) # earlier var-first-arg rules come first
+                keyed[key].append(i)
+
+
+    def _candidates(self, goal):
+        " Returns list of positions of rules whose head could match goal "
+
+        if goal.isVar():
+            goal = goal.deref()
+            if goal.isVar(): # unbound goal can match any rule
+                return self.allRules
+
+        pred = goal.sym
+        if pred not in self.predIndex:
+            return []
+
+        if len(goal.subterms) == 0:
+            return self.predIndex[pred]
+
+        first = goal.subterms[0]
+        if first.isVar():
+            first = first.deref()
+            if first.isVar(): # unbound first arg: fall back to whole predicate
+                return self.predIndex[pred]
+
+        return self.argIndex[pred].get(first.sym, self.varIndex[pred])
+
+
+    def _runDirective(self, directive):
+        " Handles a ':- GOAL.' directive (a Rule with no head) from the source "
+
+        goal = directive.body[0]
+        if goal.token == "table":
+            for spec in goal.subterms:
+                self.tabled.add(cls.symbolId(*_parseSpec(spec)))
+            return
+
+        raise cls.ParseError("ERROR: unknown directive {}".format(goal))
+
 
     @classmethod
-    def ParseString(_class, s):
-        strm = cls.ParseStream(s)
+    def ParseString(_class, s, engine=ENGINE_TREE):
+        " Parses a program from a string (or a bytes-like object of utf-8 source) "
+        return _class.FromRules(cls.iterRules(cls.ParseStream(s)), engine)
 
-        rules = []
-        while True:
-            rule = cls._parseRule(strm)
-            if rule is None:
-                break
 
-            rules.append(rule)
+    @classmethod
+    def ParseFile(_class, fname, engine=ENGINE_TREE):
+        """ Parses a program from a file
+        The file is mmap'd and parsed in place, instead of read into one big string
+        """
+        with open(fname, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0: # (can't mmap an empty file)
+                return _class.ParseString("", engine)
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+                return _class.ParseString(source, engine)
 
-        return Program(rules)
+
+    @classmethod
+    def Load(_class, fname, engine=ENGINE_TREE, useCache=True):
+        """ Parses a program from a file, going through its precompiled cache (progcache.py):
+        if the cache is there and matches the source, it's used instead of parsing,
+        else the file gets parsed and the cache (re)written
+        """
+        if not useCache:
+            return _class.ParseFile(fname, engine)
+
+        sourceHash = progcache.hashSource(fname)
+        cached = progcache.read(fname, sourceHash)
+        if cached is not None:
+            dprint("Loaded {} from cache".format(fname))
+            rules, directives, index = cached
+            return Program(rules, engine, directives, index)
+
+        prog = _class.ParseFile(fname, engine)
+        progcache.write(fname, prog.rules, prog.directives,
+                (prog.predIndex, prog.varIndex, prog.argIndex), sourceHash)
+        return prog
+
+
+    @classmethod
+    def FromRules(_class, rules, engine=ENGINE_TREE):
+        " Makes a program from an iterable of parsed rules (and headless directives) "
+        clauses = []
+        directives = []
+        for rule in rules:
+            if rule.head is None:
+                directives.append(rule)
+            else:
+                clauses.append(rule)
+
+        return Program(clauses, engine, directives)
+
+
+    def solve(self, query, limit=None, timeout=None):
+        """ Returns a generator of the answers to query (a string), one dict per answer:
+        var name -> its binding, copied out (see solveQuery). Parses query right away,
+        so can raise cls.ParseError. Stops after limit answers, if given. timeout is in
+        seconds: past that, the generator raises QueryTimeout (a PrologError)
+        """
+        return solveQuery(self, parseQuery(query), limit, timeout)
 
     
-    def getRule(self, bookmark = None):
+    def getMatchingRule(self, goal, bookmark = None):
         """ Returns (rule, bookmark).
-        Calling getRule with the same bookmark will yield the next rule
+        (rule is a cls.Rule, or a wam.CompiledRule for ENGINE_COMPILED)
+        Only yields rules which could match goal: by indexing, then cls.couldUnify on the head
+        Calling getMatchingRule with the same goal and bookmark will yield the next rule
         When no more available, returns (None, bookmark)
         """
-        #TODO: all indexing fits in here, if we ever decide to add that
 
         if bookmark is None:
             bookmark = 0
 
-        if bookmark >= len(self.rules):
-            return (None, bookmark)
+        candidates = self._candidates(goal)
+        while bookmark < len(candidates):
+            rule = self.clauses[candidates[bookmark]]
+            bookmark += 1
 
-        #bookmark will be the index of the next rule to return
-        return (self.rules[bookmark], bookmark + 1)
+            #cheap check against the original rule, so we only copy rules that might match
+            if cls.couldUnify(rule.head, goal):
+                return (rule, bookmark)
+
+        return (None, bookmark)
 
 
     def __repr__(self):
@@ -84,56 +281,545 @@ class Program:
         return msg
 
 
+class GoalCell:
+    """ One cell of an immutable linked list of goals (None is the empty list)
+    Steps share the tail of their parent's goal list instead of copying it:
+    pushing a rule body is O(body length), popping the first goal is O(1)
+
+    Each goal also remembers its cut barrier: the choice point a '!' in that goal
+    cuts back to (the last choice before the step that pushed the rule body)
+    """
+    __slots__ = ("goal", "next", "barrier")
+
+    def __init__(self, goal, next, barrier=None):
+        self.goal = goal
+        self.next = next
+        self.barrier = barrier
+
+
+def pushGoals(goals, rest, barrier=None):
+    " Returns goal list with (python list) goals in front of goal list rest "
+    for g in reversed(goals):
+        rest = GoalCell(g, rest, barrier)
+    return rest
+
+
+def iterGoals(cell):
+    " Iterates over the goals in a goal list "
+    while cell is not None:
+        yield cell.goal
+        cell = cell.next
+
+
+
 class ExecutionStep:
     """ Represents last completed step in the execution:
 
     Holds past:
-    - What was the previous step before this one
+    - What was the previous step before this one (that's still kept around):
+      if this step is a choice point, that's its parent (which we retry from)
+      Else it's the nearest choice point: deterministic steps are dropped, since
+      backtracking never needs to revisit them (last-call optimization, of sorts)
 
     Holds what happened in current step:
     - which clause did we just use?
-    - which bindings did we just make?
+    - where was the trail before we made this step's bindings? (trailMark)
     
     Holds state:
-    - what is our current list of goals
+    - what is our current list of goals (GoalCells, None when there are none left)
+
+    Holds aggregates over the chain of steps (computed once, at construction):
+    - depth: how many steps back to the first step
+    - trail: the cls.Trail shared by every step of this execution
+    - lastChoice: most recent step (maybe this one) which has other rules left to try
 
     """
 
-    def __init__(self, prevStep, currRule, ruleIndex, bindingsMade, goalList):
-        self.prevStep = prevStep #is None for first query
+    def __init__(self, prevStep, currRule, ruleIndex, trailMark, goalList, isChoice=True):
+        " prevStep is the step we came from, isChoice if there are alternatives to this step "
         self.rule = currRule
         self.ruleIndex = ruleIndex #used as "Bookmark" into Program
-        self.bindings = bindingsMade
+        self.trailMark = trailMark
         self.goals = goalList
 
+        self.depth = 0 if prevStep is None else prevStep.depth + 1
+        self.trail = cls.Trail() if prevStep is None else prevStep.trail
 
-    def depth(self):
-        if self.prevStep is None:
-            return 0
+        if prevStep is None: # first step: nothing to retry
+            self.prevStep = None
+            self.lastChoice = None
+        elif isChoice:
+            self.prevStep = prevStep #is None for first query
+            self.lastChoice = self
         else:
-            return 1 + self.prevStep.depth()
+            self.prevStep = prevStep.lastChoice
+            self.lastChoice = prevStep.lastChoice
 
 
-    def __repr__(self):
+    def __repr__(self, trailEnd=None):
+        " (trailEnd is where the next step's bindings start, if there is one) "
+        bindings = self.trail.since(self.trailMark, trailEnd)
+
         msg = ""
-        msg += "<Step {}, ".format(self.depth())
+        msg += "<Step {}, ".format(self.depth)
         msg += "R{}, ".format(self.ruleIndex)
-        msg += "Goals: {}, ".format(self.goals)
-        msg += "Bindings: {}, ".format(self.bindings)
+        msg += "Goals: {}, ".format(list(iterGoals(self.goals)))
+        msg += "Bindings: [{}], ".format(", ".join(cls.bindingStr(b) for b in bindings))
 
 
         return msg
 
     def strAll(self):
-        " Returns a string of all levels to root "
+        " Returns a string of all levels to root (newest first)"
 
-        msg = ""
+        lines = []
+        step = self
+        trailEnd = None
+        while step is not None:
+            lines.append(step.__repr__(trailEnd) + "\n")
+            trailEnd = step.trailMark
+            step = step.prevStep
 
-        if self.prevStep is not None:
-            msg = self.prevStep.strAll()
+        return "".join(lines)
+
+
+
+# ============================================================
+#
+#                          BUILTINS
+#
+# ============================================================
+
+class PrologError(Exception):
+    " Runtime error while running a query (e.g. arithmetic on an unbound var) "
+    pass
+
+
+class QueryTimeout(PrologError):
+    " A query ran past its Program's deadline "
+    pass
+
+
+class StepLimit(PrologError):
+    " A query ran past its Program's stepLimit "
+    pass
+
+
+def _intDiv(a, b):
+    " Integer division, truncating towards zero "
+    q = abs(a) // abs(b)
+    return q if (a >= 0) == (b >= 0) else -q
+
+# name/arity -> python function on ints
+ARITH_FUNCS = {
+    ("+", 2): operator.add,
+    ("-", 2): operator.sub,
+    ("*", 2): operator.mul,
+    ("//", 2): _intDiv,
+    ("mod", 2): operator.mod,
+    ("min", 2): min,
+    ("max", 2): max,
+    ("-", 1): operator.neg,
+    ("abs", 1): abs,
+}
+_ARITH_BY_SYM = {cls.symbolId(*key): func for key, func in ARITH_FUNCS.items()}
+
+
+def evalArith(expr):
+    """ Evaluates an arithmetic expression (e.g. +(X, *(2, 3))) to a python int
+    Raises PrologError on unbound vars and non-arithmetic terms
+    """
+
+    # Postorder, with an explicit stack: (func, arity) entries apply func to the last arity values
+    values = []
+    stack = [expr]
+    while stack:
+        term = stack.pop()
+        if isinstance(term, tuple):
+            func, arity = term
+            args = values[len(values) - arity:]
+            del values[len(values) - arity:]
+            try:
+                values.append(func(*args))
+            except ZeroDivisionError:
+                raise PrologError("division by zero")
+            continue
+
+        if term.isVar():
+            term = term.deref()
+            if term.isVar():
+                raise PrologError("unbound variable {} in arithmetic".format(term.nameWithId()))
+
+        if term.isNumber():
+            values.append(term.token)
+            continue
+
+        func = _ARITH_BY_SYM.get(term.sym)
+        if func is None:
+            raise PrologError("{} is not an arithmetic function".format(term.shortname()))
+
+        stack.append((func, len(term.subterms)))
+        stack.extend(reversed(term.subterms))
+
+    return values[0]
+
+
+def _builtinIs(args, trail):
+    " is(X, Expr): X unifies with the value of Expr "
+    value = cls.Functor(evalArith(args[1]), [])
+    return cls._tryUnify(value, args[0], trail)
+
+
+def _builtinCompare(op):
+    " Makes a builtin comparing the values of two arithmetic expressions "
+    return lambda args, trail: op(evalArith(args[0]), evalArith(args[1]))
 
-        msg = str(self) +"\n" + msg
-        return msg
+
+# Builtin predicates: name/arity -> function(args, trail) returning success
+# (deterministic: each either succeeds once or fails, bindings go on trail)
+# These are checked before the program's rules, and take precedence over them
+BUILTINS = {
+    ("is", 2): _builtinIs,
+    ("<", 2): _builtinCompare(operator.lt),
+    (">", 2): _builtinCompare(operator.gt),
+    ("=<", 2): _builtinCompare(operator.le),
+    (">=", 2): _builtinCompare(operator.ge),
+    ("=:=", 2): _builtinCompare(operator.eq),
+    ("=\\=", 2): _builtinCompare(operator.ne),
+    ("true", 0): lambda args, trail: True,
+    ("fail", 0): lambda args, trail: False,
+    ("false", 0): lambda args, trail: False,
+}
+_BUILTINS_BY_SYM = {cls.symbolId(*key): func for key, func in BUILTINS.items()}
+
+
+def TakeBuiltinStep(currStep, goal, builtin):
+    """ Like TakeStep, but for a goal that's a builtin predicate
+    Returns new (deterministic) step, or None if builtin failed
+    """
+
+    trail = currStep.trail
+    mark = trail.mark()
+    lastChoice = currStep.lastChoice
+    trail.boundary = 0 if lastChoice is None else lastChoice.depth
+
+    if not builtin(goal.subterms, trail):
+        trail.undoTo(mark)
+        return None
+
+    return ExecutionStep(currStep,
+            None, None,
+            mark,
+            currStep.goals.next,
+            False)
+
+
+
+# ============================================================
+#
+#                     CONTROL CONSTRUCTS
+#
+# ============================================================
+
+# Control constructs are goals that rearrange the goal list or the choice points,
+# rather than matching rules. Like builtins, they take precedence over the program's rules
+#   !         cut: drops every choice point since the goal's barrier
+#   ,(A, B)   conjunction
+#   ;(A, B)   disjunction: a choice point, A first, then B
+#   ->(C, T)  if-then: C's first solution, then T (fails if C does)
+#   ;(->(C, T), E)  if-then-else: as above, else E if C fails
+#   \+(G)     negation as failure: succeeds (binding nothing) iff G fails
+#
+# Choice points made here have no rules: their ruleIndex is the branch to retry with
+
+CONTROL = {("!", 0), (",", 2), (";", 2), ("->", 2), ("\\+", 1)}
+
+_SYM_CUT = cls.symbolId("!", 0)
+_SYM_CONJ = cls.symbolId(",", 2)
+_SYM_DISJ = cls.symbolId(";", 2)
+_SYM_IF = cls.symbolId("->", 2)
+_SYM_NOT = cls.symbolId("\\+", 1)
+_CONTROL_SYMS = {cls.symbolId(*key) for key in CONTROL}
+
+_CUT = cls.Functor("!", [])
+_FAIL = cls.Functor("fail", [])
+
+
+def _cutTo(step, barrier):
+    " Makes step deterministic back to barrier (step is dropped on backtracking, as are choices since barrier)"
+    step.prevStep = barrier
+    step.lastChoice = barrier
+    return step
+
+
+def TakeControlStep(currStep, goal, startIndex = None):
+    """ Like TakeStep, but for a goal that's a control construct
+    startIndex is the branch to retry with (for choice points made here)
+    Returns new step, or None if there's nothing left to try
+    """
+
+    cell = currStep.goals
+    barrier = cell.barrier  # cuts in goal's subgoals are transparent: same barrier
+    lastChoice = currStep.lastChoice
+    rest = cell.next
+    mark = currStep.trail.mark()
+    key = goal.sym
+    args = goal.subterms
+    branch = 0 if startIndex is None else startIndex
+
+    if key == _SYM_CUT:
+        step = ExecutionStep(currStep, None, None, mark, rest, False)
+        return _cutTo(step, barrier)
+
+    if key == _SYM_CONJ:
+        return ExecutionStep(currStep, None, None, mark,
+                pushGoals(args, rest, barrier), False)
+
+    # Anything with an 'else' branch: first branch is a choice point, retried with branch 1
+    if key == _SYM_DISJ or key == _SYM_NOT:
+        if branch > 0: # retrying: last branch, so deterministic
+            if key == _SYM_DISJ:
+                rest = GoalCell(args[1], rest, barrier)
+            return ExecutionStep(currStep, None, None, mark, rest, False)
+
+        step = ExecutionStep(currStep, None, 1, mark, None, True)
+
+        cond = args[0]
+        if cond.isVar():
+            cond = cond.deref()
+
+        if key == _SYM_NOT:
+            # G (cuts local to G), then cut the else away, then fail
+            step.goals = GoalCell(args[0], GoalCell(_CUT, GoalCell(_FAIL, rest), lastChoice), step)
+        elif not cond.isVar() and cond.sym == _SYM_IF:
+            # C (cuts local to C), then cut the else away, then T
+            step.goals = GoalCell(cond.subterms[0],
+                    GoalCell(_CUT, GoalCell(cond.subterms[1], rest, barrier), lastChoice), step)
+        else:
+            step.goals = GoalCell(args[0], rest, barrier)
+        return step
+
+    # ("->", 2) with no else: no choice point needed, just cut away whatever C leaves
+    return ExecutionStep(currStep, None, None, mark,
+            GoalCell(args[0], GoalCell(_CUT, GoalCell(args[1], rest, barrier), lastChoice), lastChoice),
+            False)
+
+
+
+# ============================================================
+#
+#                          TABLING
+#
+# ============================================================
+
+# Predicates declared with ':- table name/arity.' are memoized: each call, up to
+# renaming of its vars (a variant, see cls.variantKey), gets a Table of its answers.
+#
+# The first time a call is made, its table is filled in by running the call against
+# the program's clauses, in a separate (nested) query. Recursive variant calls made
+# while that's going on don't recurse again: they just read the answers found so far.
+# The nested query is rerun until it turns up no new answers (a fixpoint), so
+# left recursion terminates, and each variant only gets evaluated once.
+#
+# Tables that read from a table further out that's still being filled in, can't be
+# completed on their own. They join the outer one's group of tables (its scc) and from
+# then on it (the "leader") drives them: each of its passes reruns each of them once, and
+# they're marked complete along with it. Calls to them in the meantime just read the
+# answers found so far, like recursive calls, so each table only gets filled in once.
+#
+# Calls to a complete table just read its answers, as a choice point over them.
+
+# Wraps a call in the nested query: resolve it against clauses, don't read its table
+TABLE_CLAUSES = ("$clauses", 1)
+_SYM_TABLE_CLAUSES = cls.symbolId(*TABLE_CLAUSES)
+
+
+class Table:
+    " Answer table for one tabled call (and all its variants) "
+
+    def __init__(self, key, call):
+        self.key = key
+        self.answers = []       # facts (Rules), whose heads are the answers, in the order found
+        self.answerKeys = set() # variantKeys of answers, to skip duplicates
+
+        # call is a resolved copy: head is the call itself, to read answers from
+        self.query = cls.Rule(call, [cls.Functor(TABLE_CLAUSES[0], [call])])
+
+        self.complete = False
+        self.evaluating = False
+        self.stackPos = None    # position on Program.tableStack while evaluating
+        self.leaderPos = None   # outermost tableStack position this table has read from
+        self.scc = []           # tables which get rerun and completed along with this one
+        self.leader = None      # table driving this one's fixpoint, once it's waiting on one
+
+
+    def addAnswer(self, term):
+        " Adds term to answers if it's new (not a variant of an old one), returns whether it was "
+        key = cls.variantKey(term)
+        if key in self.answerKeys:
+            return False
+
+        self.answerKeys.add(key)
+        self.answers.append(cls.Rule(cls.resolveCopy(term), []))
+        return True
+
+
+    def __repr__(self):
+        return "<Table {}: {} answers{}>".format(self.query.head,
+                len(self.answers), "" if self.complete else ", incomplete")
+
+
+def _parseSpec(spec):
+    " Parses a predicate indicator like foo/2 (an atom 'foo/2', or /(foo, 2)) into (name, arity) "
+
+    if spec.token == "/" and len(spec.subterms) == 2:
+        name, arity = spec.subterms[0].token, spec.subterms[1].token
+    else:
+        name, _, arity = str(spec.token).rpartition("/")
+
+    try:
+        return (name, int(arity))
+    except ValueError:
+        raise cls.ParseError("ERROR: bad predicate indicator {}, expected name/arity".format(spec))
+
+
+def getTable(prog, goal):
+    """ Returns the Table to read goal's answers from
+    Fills it in first if it's new (tables being filled in, or waiting on their leader,
+    are read as they are)
+    """
+
+    key = cls.variantKey(goal)
+    table = prog.tables.get(key)
+    if table is None:
+        table = Table(key, cls.resolveCopy(goal))
+        prog.tables[key] = table
+
+    if table.complete:
+        return table
+
+    if table.evaluating or table.leader is not None:
+        # recursive call: reads answers so far, so whoever's being filled in depends on it
+        # (and on whatever table is driving its fixpoint)
+        prog.incompleteReads += 1
+        pos = table.stackPos if table.evaluating else table.leader.stackPos
+        top = prog.tableStack[-1]
+        top.leaderPos = min(top.leaderPos, pos)
+        return table
+
+    _fillTable(prog, table)
+    return table
+
+
+def _runTablePass(prog, table):
+    " Runs table's call against the program's clauses once, adding any new answers "
+
+    query = table.query.copy()
+    state = makeFirstStep(query)
+    while True:
+        state = outerInterp(state, prog)
+        if state is None:
+            break
+        if table.addAnswer(query.head):
+            prog.answersAdded += 1
+
+
+def _fillTable(prog, table):
+    """ Reruns table's call against the program's clauses until no new answers turn up,
+    along with one pass of each table waiting on it (its scc) each time round
+    """
+
+    stack = prog.tableStack
+    table.evaluating = True
+    table.stackPos = table.leaderPos = len(stack)
+    stack.append(table)
+
+    try:
+        while True:
+            added, reads = prog.answersAdded, prog.incompleteReads
+
+            _runTablePass(prog, table)
+
+            # (scc can grow during a pass, as tables called from it turn out to depend on this one)
+            i = 0
+            while i < len(table.scc):
+                _runTablePass(prog, table.scc[i])
+                i += 1
+
+            dprint("Table {}: pass done".format(table))
+
+            # Done if nothing new turned up, or if nothing read a partial table (so nothing could)
+            if prog.answersAdded == added or prog.incompleteReads == reads:
+                break
+
+    except BaseException:
+        # abandoned partway (e.g. PrologError): forget the partial tables
+        stack.pop()
+        table.evaluating = False
+        for t in [table] + table.scc:
+            t.leader = None
+            prog.tables.pop(t.key, None)
+        raise
+
+    stack.pop()
+    table.evaluating = False
+
+    if table.leaderPos >= table.stackPos:
+        # doesn't depend on anything further out: it's done, along with whatever depended on it
+        for t in [table] + table.scc:
+            t.complete = True
+            t.leader = None
+        table.scc = []
+    else:
+        # depends on a table further out: that one (the leader) drives it from now on,
+        # a pass per pass of its own, and completes it along with itself
+        outer = stack[-1]
+        outer.leaderPos = min(outer.leaderPos, table.leaderPos)
+        outer.scc.append(table)
+        outer.scc.extend(table.scc)
+        for t in [table] + table.scc:
+            t.leader = outer
+        table.scc = []
+
+
+def TakeTableStep(currStep, prog, goal, startIndex = None):
+    """ Like TakeStep, but for a call to a tabled predicate: unifies goal with its answers
+    startIndex is the position of the next answer to try
+    """
+
+    if startIndex is None:
+        table = getTable(prog, goal)
+        startIndex = 0
+    else: # retrying: table was already set up on the first try
+        table = prog.tables[cls.variantKey(goal)]
+
+    trail = currStep.trail
+    mark = trail.mark()
+    lastChoice = currStep.lastChoice
+    detBoundary = 0 if lastChoice is None else lastChoice.depth
+
+    answers = table.answers
+    index = startIndex
+    while index < len(answers):
+        answer = answers[index]
+        index += 1
+
+        # incomplete tables can still grow, so keep a choice point to read more later
+        isChoice = index < len(answers) or not table.complete
+        trail.boundary = currStep.depth + 1 if isChoice else detBoundary
+
+        aCopy = answer.copy()
+        aCopy.setInstanceId(currStep.depth + 1)
+        if cls._tryUnify(aCopy.head, goal, trail):
+            return ExecutionStep(currStep,
+                    aCopy, index,
+                    mark,
+                    currStep.goals.next,
+                    isChoice)
+
+        trail.undoTo(mark)
+
+    return None
 
 
 
@@ -146,11 +832,38 @@ def TakeStep(currStep, prog, startIndex = None):
     """
 
     #Get our goal clause
-    assert len(currStep.goals) > 0, "ERROR: must only TakeStep when goals avaiable"
-    firstGoal = currStep.goals[0]
+    assert currStep.goals is not None, "ERROR: must only TakeStep when goals avaiable"
+    firstGoal = currStep.goals.goal
+
+    # Builtins get dispatched before looking at any rules
+    goal = firstGoal.deref() if firstGoal.isVar() else firstGoal
+    if not goal.isVar():
+        key = goal.sym
+        if key in _CONTROL_SYMS:
+            return TakeControlStep(currStep, goal, startIndex)
+
+        builtin = _BUILTINS_BY_SYM.get(key)
+        if builtin is not None:
+            return TakeBuiltinStep(currStep, goal, builtin)
+
+        # Tabled goals read answers from their table, except when filling it in
+        if key == _SYM_TABLE_CLAUSES:
+            firstGoal = goal.subterms[0]
+        elif key in prog.tabled:
+            return TakeTableStep(currStep, prog, goal, startIndex)
+
+    # Bindings go on the trail from here
+    trail = currStep.trail
+    mark = trail.mark()
+
+    # Vars at least as new as the last choice point get thrown away when we backtrack to it,
+    # so they never need trailing (0 if no choice point: only the query's vars get trailed)
+    lastChoice = currStep.lastChoice
+    detBoundary = 0 if lastChoice is None else lastChoice.depth
+    prof = prog.profiler
     
     #Find a matching head clause
-    tryRule, index = prog.getRule(startIndex) #get rule, and index to continue from
+    tryRule, index = prog.getMatchingRule(firstGoal, startIndex) #get rule, and index to continue from
 
     # === Loop over rules in the program until one works or we run out
     while True:
@@ -160,22 +873,41 @@ def TakeStep(currStep, prog, startIndex = None):
         if tryRule is None:
             return None
 
+        # Look ahead for the next rule (before binding anything, so the goal's as the retry will see it)
+        # If there's none, the new step won't be a choice point
+        nextRule, nextIndex = prog.getMatchingRule(firstGoal, index)
+        if nextRule is not None:
+            trail.boundary = currStep.depth + 1 # only the new rule instance is newer
+        else:
+            trail.boundary = detBoundary
+
         #see if we unify with tryclause
-        rCopy = tryRule.copy()
-        rCopy.setInstanceId(currStep.depth() + 1)
+        if prog.engine == ENGINE_COMPILED:
+            # match without copying: rCopy only gets the instantiated body
+            rCopy, succ = tryRule.unifyHead(firstGoal, currStep.depth + 1, trail)
+        elif prog.engine == ENGINE_SHARED:
+            # match without copying: rCopy is just a frame of bindings, its body reads the rule's
+            rCopy, succ = share.unifyHead(tryRule, firstGoal, currStep.depth + 1, trail)
+        else:
+            rCopy = tryRule.copy()
+            rCopy.setInstanceId(currStep.depth + 1)
+
+            succ = cls._tryUnify(rCopy.head, firstGoal, trail)
+
+        if prof is not None:
+            prof.headUnify(firstGoal, succ)
 
-        succ, bindings = cls._tryUnify(rCopy.head, firstGoal)
         if succ:
             break
 
         # == unification failed, undo bindings
-        for b in reversed(bindings):
-            b[0].unbind() #unbind the variable
+        # (if this was the last rule, we'll backtrack past whatever didn't get trailed anyway)
+        trail.undoTo(mark)
         #TODO: destroy rule somehow?
 
 
-        # Get next rule to continue from
-        tryRule, index = prog.getRule(index)
+        # Continue with the next rule
+        tryRule, index = nextRule, nextIndex
 
 
 
@@ -185,14 +917,20 @@ def TakeStep(currStep, prog, startIndex = None):
     #print("Succeeded with rule:", tryRule)
     #print(tryRule.body)
 
-    newGoals = list(rCopy.body)
-    remainingGoals = currStep.goals[1:]
+    # new goals are the body, in front of the rest of the current goals (shared, not copied)
+    # a '!' in the body cuts back to the last choice from before this step
+    goals = pushGoals(rCopy.body, currStep.goals.next, currStep.lastChoice)
 
-    # need to create new step: store rule, index, update goal list
+    # need to create new step: store rule, index (pointing right at the next rule), update goal list
+    isChoice = nextRule is not None
     newStep = ExecutionStep(currStep, 
-            rCopy, index,
-            bindings,
-            newGoals + remainingGoals)
+            rCopy, nextIndex - 1 if isChoice else nextIndex,
+            mark,
+            goals,
+            isChoice)
+
+    if VERBOSE:
+        dprint("Step {}: {}".format(newStep.depth, ", ".join(cls.bindingStr(b) for b in trail.since(mark))))
 
     return newStep
 
@@ -204,7 +942,8 @@ def outerInterp(state, prog):
     Repeatedly tries to take a step until we run out of goals (answer)
     or until we run out of valid rules to try
 
-    Pushes a new step whenever possible, pops if a step runs out of options.
+    Pushes a new step whenever possible, backtracks to the last choice point
+    if a step runs out of options.
 
     Returns next answer (as ExecutionStep), or None if all answers exhausted
     Should be repeatedly called with the state obj it returned from the last invocation
@@ -214,38 +953,53 @@ def outerInterp(state, prog):
     # Update this each time we push/pop
     # If takeStep picks a dead-end, it will pop immediately and update the bookmark
 
+    prof = prog.profiler
+    deadline = prog.deadline
+    stepLimit = prog.stepLimit
+
     while True:
         # If we ever have an empty state (i.e. popped query), return None
         if state is None:
             return None
 
-        # If we have empty goallist, it's from a prev answer, so need to pop
-        if len(state.goals) == 0:
-            # Pop: store bookmark to continue from & destroy the step
-            bookmark = state.ruleIndex
-            state = rewindStep(state)
+        if deadline is not None and time.monotonic() > deadline:
+            raise QueryTimeout("query timed out")
+        if stepLimit is not None and prog.steps >= stepLimit:
+            raise StepLimit("query ran past its step limit")
+
+        # If we have empty goallist, it's from a prev answer, so need to backtrack
+        if state.goals is None:
+            state, bookmark = backtrack(state)
             continue
 
         # ======= THERE IS YET WORK TO BE DONE
 
         # Try to make progress towards one of our goals
-        nextState = TakeStep(state, prog, bookmark)
-
-        # If no way to make progress forward, need to retry the currentStep
+        if prof is None:
+            nextState = TakeStep(state, prog, bookmark)
+        else:
+            prof.stepStart(state, bookmark)
+            nextState = None
+            try:
+                nextState = TakeStep(state, prog, bookmark)
+            finally:
+                # (close the step even if it raised, so the profiler's open stack stays balanced)
+                prof.stepEnd(nextState)
+        prog.steps += 1
+
+        # If no way to make progress forward, need to retry the last choice point
         if nextState is None:
-
-            #We're instead retrying the current step, so load its bookmark and pop stack
-            bookmark = state.ruleIndex
-            state = rewindStep(state)
+            state, bookmark = backtrack(state)
             continue
         
 
         #ELSE: we successfully took a step and made progress
+        prog.inferences += 1
         state = nextState
         bookmark = None #start from beginning for the next step
 
         #check if it's an answer (we return here, and discard on reentry)
-        if len(state.goals) == 0:
+        if state.goals is None:
             return state
 
         
@@ -268,19 +1022,33 @@ def makeFirstStep(queryRule):
     step = ExecutionStep(
             None,             # No Prev step
             queryRule, None,  # Rule, no bookmark index
-            [],               # No bindings
-            queryRule.body    # Goal list is just body
+            0,                # No bindings (fresh trail)
+            pushGoals(queryRule.body, None) # Goal list is just body
             );
     return step
 
 
+def backtrack(step):
+    """ Undoes bindings back to (and including) step's last choice point.
+    Returns (step to retry from, bookmark to retry with), or (None, None) if no choices remain
+    Deterministic steps in between are skipped entirely
+    """
+
+    choice = step.lastChoice
+    if choice is None:
+        step.trail.undoTo(0)
+        return (None, None)
+
+    step.trail.undoTo(choice.trailMark)
+    return (choice.prevStep, choice.ruleIndex)
+
+
 def rewindStep(step):
     " Undoes bindings, returns the previous step"
 
     assert step is not None, "Don't rewind empty step"
 
-    for b in reversed(step.bindings):
-        b[0].unbind()
+    step.trail.undoTo(step.trailMark)
 
     return step.prevStep
 
@@ -289,20 +1057,153 @@ def parseQuery(querystring):
     " Parses out a query from the string. Throws on error "
     strm = cls.ParseStream("goal :-" + querystring)
     rule = cls._parseRule(strm)
-    cls._chomp(strm)
     strm.assertNext(None)
     return rule
 
 
+def topDownAnswers(program, queryRule):
+    " Yields the bindings (as from Rule.boundVars) for each answer to queryRule, by outerInterp "
+
+    curr = makeFirstStep(queryRule)
+    while True:
+        curr = outerInterp(curr, program)
+        if curr is None:
+            return
+
+        if VERBOSE: # (don't build the string unless we'll print it)
+            dprint(curr.strAll())
+
+        yield queryRule.boundVars()
+
+
+def solveQuery(program, queryRule, limit=None, timeout=None):
+    """ Generator behind Program.solve: yields a dict for each answer to queryRule, of its
+    bound vars' bindings copied out with cls.resolveCopy (fresh _G vars for whatever's
+    unbound), so answers stay valid as the search moves on and don't hold onto it
+    Stops after limit answers (if not None); raises QueryTimeout once timeout seconds are up
+    Closing it early (or letting it go) drops the search, undoing its bindings
+    """
+
+    def copyOut(bindings):
+        varMap = {}
+        return {k: cls.resolveCopy(v, varMap) for k, v in bindings}
+
+    if limit is not None and limit <= 0:
+        return
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # Datalog: all answers are found up front, so the timeout can only stop us between them
+    if program.datalog is not None:
+        try:
+            answers = program.datalog.query(queryRule)
+        except datalog.NotDatalog:
+            pass
+        else:
+            for count, bindings in enumerate(answers, 1):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise QueryTimeout("query timed out")
+                yield copyOut(bindings)
+                if count == limit:
+                    return
+            return
+
+    # In parallel (answers come copied out already): workers can't be stopped in the middle
+    # of a task, so the timeout only gets checked between answers, and by the parent's search
+    if program.parallel is not None:
+        answers = program.parallel.answers(queryRule, limit)
+        try:
+            while True:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise QueryTimeout("query timed out")
+
+                outerDeadline, program.deadline = program.deadline, deadline
+                try:
+                    bindings = next(answers, None)
+                finally:
+                    program.deadline = outerDeadline
+
+                if bindings is None:
+                    return
+                yield dict(bindings)
+        finally:
+            answers.close() # (stops the workers, if they're still going)
+
+    curr = makeFirstStep(queryRule)
+    count = 0
+    try:
+        while True:
+            # (only set while we're running: other queries can run between our answers)
+            outerDeadline, program.deadline = program.deadline, deadline
+            try:
+                nextStep = outerInterp(curr, program)
+            finally:
+                program.deadline = outerDeadline
+
+            if nextStep is None:
+                curr = None
+                return
+            curr = nextStep
+
+            yield copyOut(queryRule.boundVars())
+            count += 1
+            if count == limit:
+                return
+    finally:
+        # stopped before running out: unbind the query's vars, and let go of the steps
+        if curr is not None:
+            curr.trail.undoTo(0)
+            curr = None
+
+
+def queryAnswers(program, queryRule, onFallback=None, limit=None):
+    """ Returns an iterator over the answers to queryRule (bindings, as from Rule.boundVars)
+    Datalog queries are answered bottom-up if program's engine is ENGINE_DATALOG, anything else
+    top-down: in that case onFallback (if given) is called with the datalog.NotDatalog saying why
+    Top-down is in parallel if program has an OrParallel or AndParallel: limit (the most
+    answers the caller will take, if it knows) lets them stop early
+    Can raise datalog.DatalogError, and PrologError while iterating
+    """
+
+    if program.datalog is not None:
+        try:
+            return iter(program.datalog.query(queryRule))
+        except datalog.NotDatalog as e:
+            if onFallback is not None:
+                onFallback(e)
+
+    if program.parallel is not None:
+        return program.parallel.answers(queryRule, limit)
+
+    return topDownAnswers(program, queryRule)
+
+
 # =====
 
-def interactiveInterp(program):
-    "Prints a prompt and responds to user queries"
+def reportProfile(program, queryStr, sortBy="time", jsonFile=None):
+    """ Prints the report of program's profiler (for the query just run), sorted by sortBy
+    With jsonFile, appends it there instead, as one line of JSON (with the query)
+    """
 
-    def printBindings():
+    prof = program.profiler
+    if jsonFile is None:
+        print(prof.report(sortBy))
+        print("")
+        return
+
+    with open(jsonFile, "a") as f:
+        f.write(json.dumps({"query": queryStr.strip(), "profile": prof.toDict(sortBy)}) + "\n")
+
+
+def interactiveInterp(program, profileSort="time", profileJson=None):
+    """ Prints a prompt and responds to user queries
+    If program has a profiler, each query gets profiled: see reportProfile for the arguments
+    """
+
+    def printBindings(bindings):
         " print all bindings, then stop on the last one (no \\n) "
         lines = []
-        for k,v in queryRule.bindings.items():
+        for k,v in bindings:
             lines.append("  {} = {}".format(k, v))
 
         print("\n".join(lines), end='')
@@ -324,13 +1225,25 @@ def interactiveInterp(program):
 
 
         # === Ok, we got one:
-        curr = makeFirstStep(queryRule)
+        if program.profiler is not None:
+            program.profiler.reset()
+
+        try:
+            answers = queryAnswers(program, queryRule,
+                    lambda e: print("(not Datalog: {}, answering top-down)".format(e)))
+        except datalog.DatalogError as e:
+            print("ERROR: {}".format(e))
+            continue
 
         # === Loop over each answer, until exhausted or user satisfied
         while True:
-            nextStep = outerInterp(curr, program)
+            try:
+                bindings = next(answers, None)
+            except PrologError as e:
+                print("ERROR: {}".format(e))
+                break
 
-            if nextStep is None:
+            if bindings is None:
                 print("no")
                 break
 
@@ -338,10 +1251,8 @@ def interactiveInterp(program):
             #= If we made some variable bindings: show them
             #= Then ask if user wants more answers
             done = True
-            if len(queryRule.bindings)>0:
-                printBindings()
-                #print(queryRule.body) #TEMP?
-                dprint(nextStep.strAll())
+            if len(bindings)>0:
+                printBindings(bindings)
                 
                 #= Check if user wants more answers
                 response = input()
@@ -353,9 +1264,621 @@ def interactiveInterp(program):
                 break #break out to query shell
 
             # Else continue with rest of answer
-            curr = nextStep
             print("")
 
+        if program.profiler is not None:
+            reportProfile(program, queryStr, profileSort, profileJson)
+
+
+
+
+# ============================================================
+#
+#                        OR-PARALLELISM
+#
+# ============================================================
+
+# The parent process starts searching a query's tree as usual (outerInterp, more or less),
+# but hands subtrees off to worker processes instead of searching them itself: once it's
+# a few choice points deep, each step it takes becomes a task, and it backtracks as if
+# the subtree had failed. Tasks are named by their root step's path from the query's first
+# step (the bookmark each step was taken with, see TakeStep). Workers, each with its own
+# copy of the program, replay a task's path to get to its root step, then search only that
+# subtree with outerInterp: the root is cut loose from the steps before it, so
+# backtracking stops there. Whatever the parent doesn't hand off it searches itself:
+# answers it finds go in between the tasks, and past a step budget it stops splitting,
+# to carry on with the rest of the search after the tasks' answers.
+#
+# Steps are deterministic (given the program), so replaying a path always gets to the
+# same step, and the answers of the tasks (and the parent's), in order, are the query's
+# answers in order.
+#
+# Except for cuts: a '!' cutting back past a task's root would prune what's after it.
+# Cuts from clauses called within a subtree only ever cut back within it, so the only
+# ones that can escape are in the goals already waiting when its root step is made:
+# steps with any of those (_mayCut) don't get handed off, the parent steps on past them.
+# Nor do steps below tabled goals: each worker fills in its own tables, in whatever
+# order it needs them, so paths through them couldn't be replayed.
+#
+# Queries are sent to the workers, and answers back, encoded like the program cache
+# (progcache.encodeRules), since symbol ids only mean something in their own process.
+
+SPLIT_MAX_DEPTH = 8         # most choice points deep to look for tasks
+SPLIT_TASKS_PER_WORKER = 4  # split until there are this many tasks per worker (load balancing)
+SPLIT_MAX_STEPS = 10000     # most steps the parent takes splitting a query
+
+
+def _mayCut(goal):
+    """ Whether running goal could run a '!' with goal's own cut barrier: if goal is one,
+    or one turns up in it through control constructs (which are transparent to cut),
+    or it's an unbound var (which might be bound to one by the time it's run)
+    """
+
+    stack = [goal]
+    while stack:
+        term = stack.pop()
+        if term.isVar():
+            term = term.deref()
+            if term.isVar():
+                return True
+
+        if term.sym == _SYM_CUT:
+            return True
+        if term.sym in _CONTROL_SYMS:
+            stack.extend(term.subterms)
+
+    return False
+
+
+def _cutContained(step):
+    " Whether no goal waiting in (just made) step can cut back past it, see _mayCut "
+    return not any(_mayCut(g) for g in iterGoals(step.goals))
+
+
+def _copyAnswer(queryRule):
+    " queryRule's bindings (as from Rule.boundVars), copied out of the search "
+    varMap = {}
+    return [(k, cls.resolveCopy(v, varMap)) for k, v in queryRule.boundVars()]
+
+
+class Split:
+    """ A query's search tree, split up for OrParallel: parts, in order, are each one of
+    - ("task", path): a subtree to hand off, path being a list of bookmarks from the first step
+    - ("answer", bindings): an answer the parent found, copied out
+    - ("error", PrologError): one the parent ran into (nothing comes after it)
+    then rest, if not None, is a step to carry on the search from (with outerInterp)
+    """
+
+    def __init__(self, parts, rest, deeper):
+        self.parts = parts
+        self.rest = rest
+        self.deeper = deeper    # whether splitting deeper could give more tasks
+
+    def tasks(self):
+        return [path for kind, path in self.parts if kind == "task"]
+
+
+def _splitSearch(prog, queryRule, depth, budget):
+    """ Searches queryRule's tree like outerInterp, but hands off the subtree of each step
+    depth or more choice points deep (when it can, see OR-PARALLELISM). Returns a Split
+    budget is [steps left]: once it runs out, the rest of the search is left for later
+    """
+
+    # Each step we make: (its path, as (parent's path, bookmark) pairs, choice points deep,
+    # whether it's below a tabled goal)
+    info = {}
+
+    parts = []
+    deeper = False
+    state = makeFirstStep(queryRule)
+    info[state] = (None, 0, False)
+    bookmark = None
+
+    while True:
+        if state is None:
+            return Split(parts, None, deeper)
+
+        if state.goals is None:
+            state, bookmark = backtrack(state)
+            continue
+
+        # (only stop where outerInterp can carry on from: just after a step)
+        if budget[0] <= 0 and bookmark is None:
+            return Split(parts, state, deeper)
+
+        path, choices, tabled = info[state]
+        goal = state.goals.goal.deref() if state.goals.goal.isVar() else state.goals.goal
+
+        budget[0] -= 1
+        prog.steps += 1
+        try:
+            nextState = TakeStep(state, prog, bookmark)
+        except PrologError as e:
+            parts.append(("error", e))
+            state.trail.undoTo(0) # (like finishing the search would)
+            return Split(parts, None, deeper)
+
+        if nextState is None:
+            state, bookmark = backtrack(state)
+            continue
+
+        prog.inferences += 1
+        branched = bookmark is not None or nextState.lastChoice is nextState
+        info[nextState] = ((path, bookmark), choices + branched,
+                tabled or (not goal.isVar() and goal.sym in prog.tabled))
+        state, bookmark = nextState, None
+
+        if state.goals is None:
+            parts.append(("answer", _copyAnswer(queryRule)))
+            continue
+
+        if branched and choices + 1 >= depth and not info[state][2] and _cutContained(state):
+            deeper = True
+            parts.append(("task", _pathList(info[state][0])))
+            state, bookmark = backtrack(state)
+
+
+def _pathList(path):
+    " (parent's path, bookmark) pairs as a list of bookmarks "
+    bookmarks = []
+    while path is not None:
+        path, bookmark = path
+        bookmarks.append(bookmark)
+    bookmarks.reverse()
+    return bookmarks
+
+
+def splitQuery(prog, queryRule, minTasks):
+    """ Splits queryRule's search tree into tasks (returns a Split), deeper and deeper until
+    there are at least minTasks of them (or there can't be, or it's taking too long)
+    Leaves queryRule bound as Split.rest left it
+    """
+
+    budget = [SPLIT_MAX_STEPS]
+    for depth in range(1, SPLIT_MAX_DEPTH + 1):
+        split = _splitSearch(prog, queryRule, depth, budget)
+        if (len(split.tasks()) >= minTasks or not split.deeper
+                or split.rest is not None or depth == SPLIT_MAX_DEPTH):
+            return split
+
+        # (the search finished, so queryRule's unbound again)
+        dprint("Split {} deep: {} tasks, trying deeper".format(depth, len(split.tasks())))
+
+
+# === Worker processes
+
+_workerProgram = None  # each worker's own copy of the Program
+
+
+def _initWorker(fname, source, engine, useCache):
+    " Pool initializer: loads the program (from file fname, or else source text) "
+    global _workerProgram
+    if fname is None:
+        _workerProgram = Program.ParseString(source, engine)
+    else:
+        _workerProgram = Program.Load(fname, engine, useCache)
+
+
+def _runTask(task):
+    """ Finds the answers in one subtree of a query (in a worker)
+    task is (query encoded by progcache.encodeRules, path to the subtree's root, limit,
+    most steps to take searching it, or None)
+    Returns (answers' values as encoded Rules, answers' var names, steps, inferences, error):
+    error is the PrologError that ended the search (after those answers), or None.
+    A StepLimit means the search didn't get to the end
+    """
+
+    prog = _workerProgram
+    encodedQuery, path, limit, maxSteps = task
+    queryRule = progcache.decodeRules(encodedQuery)[0]
+    steps, inferences = prog.steps, prog.inferences
+
+    # Replay the path down to the root...
+    state = makeFirstStep(queryRule)
+    for bookmark in path:
+        prog.steps += 1
+        state = TakeStep(state, prog, bookmark)
+        assert state is not None, "ERROR: task path didn't replay"
+        prog.inferences += 1
+
+    # ...and make it look like the first step, so nothing before it gets retried
+    state.prevStep = None
+    state.lastChoice = None
+
+    answers = []
+    names = []
+
+    def addAnswer():
+        " copies the answer out, as the body of a Rule (so it gets encoded with its vars) "
+        bindings = queryRule.boundVars()
+        varMap = {}
+        answers.append(cls.Rule(None, [cls.resolveCopy(v, varMap) for _, v in bindings]))
+        names.append([k for k, _ in bindings])
+
+    error = None
+    if state.goals is None: # the root's an answer itself (and the only one)
+        addAnswer()
+    else:
+        prog.stepLimit = None if maxSteps is None else prog.steps + maxSteps
+        try:
+            while limit is None or len(answers) < limit:
+                state = outerInterp(state, prog)
+                if state is None:
+                    break
+                addAnswer()
+        except PrologError as e: # (sent back with the answers before it, not instead of them)
+            error = e
+        finally:
+            prog.stepLimit = None
+
+    return (progcache.encodeRules(answers), names,
+            prog.steps - steps, prog.inferences - inferences, error)
+
+
+def _nextResult(prog, results):
+    """ The next result from results (a pool's imap), or StopIteration. Like outerInterp,
+    gives up with QueryTimeout once prog's deadline is past, rather than waiting on
+    workers that are still searching
+    """
+    if prog.deadline is None:
+        return next(results)
+    try:
+        return results.next(max(0.0, prog.deadline - time.monotonic()))
+    except multiprocessing.TimeoutError:
+        raise QueryTimeout("query timed out") from None
+
+
+class _Workers:
+    """ A pool of worker processes for a program, each with its own copy of it: loaded from
+    fname (through its cache, if useCache), or parsed from source. The pool is only started
+    when first needed
+    """
+
+    def __init__(self, program, workers=None, fname=None, source=None, useCache=True):
+        assert (fname is None) != (source is None), "ERROR: need one of fname or source"
+        self.program = program
+        self.workers = workers or os.cpu_count() or 1
+        self.loadArgs = (fname, source, program.engine, useCache)
+        self.pool = None
+
+
+    def _getPool(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, _initWorker, self.loadArgs)
+        return self.pool
+
+
+    def _discard(self, pool):
+        " Stops pool's workers where they are (e.g. still searching for answers nobody wants) "
+        pool.terminate()
+        pool.join()
+        if self.pool is pool:
+            self.pool = None
+
+
+    def close(self):
+        if self.pool is not None:
+            self._discard(self.pool)
+
+
+class OrParallel(_Workers):
+    """ Answers a program's queries OR-parallel (see OR-PARALLELISM), on a pool of workers
+    (see _Workers). With ordered, answers come back in the order they would sequentially,
+    else as tasks finish
+    """
+
+    def __init__(self, program, workers=None, ordered=True, fname=None, source=None, useCache=True):
+        _Workers.__init__(self, program, workers, fname, source, useCache)
+        self.ordered = ordered
+
+
+    def answers(self, queryRule, limit=None):
+        """ Yields the bindings for each answer to queryRule (as from Rule.boundVars), up to
+        limit of them if given, copied out of the search (see _copyAnswer): unbound vars in
+        them are named _G0, _G1, ... per answer
+        """
+
+        prog = self.program
+        split = splitQuery(prog, queryRule, self.workers * SPLIT_TASKS_PER_WORKER)
+        tasks = split.tasks()
+        dprint("Split into {} tasks".format(len(tasks)))
+
+        pool = None
+        results = iter(())
+        if tasks:
+            query = progcache.encodeRules([queryRule])
+            pool = self._getPool()
+            run = pool.imap if self.ordered else pool.imap_unordered
+            results = run(_runTask, [(query, path, limit, None) for path in tasks])
+
+        pending = [len(tasks)]
+
+        def taskAnswers():
+            """ the answers of the next task to finish (the next one in order, if ordered),
+            and the error that ended it (or None)
+            """
+            encoded, names, steps, inferences, error = _nextResult(prog, results)
+            pending[0] -= 1
+            prog.steps += steps
+            prog.inferences += inferences
+            return ([list(zip(n, a.body)) for n, a in zip(names, progcache.decodeRules(encoded))],
+                    error)
+
+        # Unordered, the parent's answers come first, then the tasks' as they finish
+        parts = split.parts
+        if not self.ordered:
+            parts = ([p for p in parts if p[0] == "answer"] + [p for p in parts if p[0] == "task"]
+                    + [p for p in parts if p[0] == "error"])
+
+        count = 0
+        state = split.rest
+        try:
+            for kind, value in parts:
+                if kind == "error":
+                    raise value
+
+                answers, error = taskAnswers() if kind == "task" else ([value], None)
+                for bindings in answers:
+                    if count == limit:
+                        return
+                    count += 1
+                    yield bindings
+                if error is not None:
+                    raise error
+
+            # then whatever the parent didn't get to
+            while state is not None and count != limit:
+                state = outerInterp(state, prog)
+                if state is None:
+                    break
+                count += 1
+                yield _copyAnswer(queryRule)
+
+        finally:
+            if pending[0] > 0: # (stopped early, or a task raised)
+                self._discard(pool)
+            if state is not None: # (unbind the query, like backtracking all the way would)
+                state.trail.undoTo(0)
+
+
+
+# ============================================================
+#
+#                        AND-PARALLELISM
+#
+# ============================================================
+
+# Goals waiting in a step that share no unbound vars (not even through other goals) are
+# independent: each one's answers are the same whatever the others bind, so the step's
+# answers are every combination of theirs. Searched sequentially, the goals after the first
+# get solved all over again for each answer before them. Instead, each group of connected
+# goals becomes a query of its own, solved once by a worker, and the parent puts their
+# answers together: the cross product, first group's answers outermost.
+#
+# The parent looks for such a step starting from the query's first step (i.e. the query's
+# own goals), and steps on as long as there's only one way to go (e.g. into the body of
+# the only clause matching): past a choice point, each alternative's goals would need
+# grouping again. Steps with goals that could cut (_mayCut) don't get split, since a cut
+# in one group would prune the others. Queries without such a step just run sequentially.
+#
+# Combining the groups' answers like nested loops over them would (_groupProduct) gives
+# the answers a sequential search would (jpl's goals only bind vars), in the same order as
+# long as each group's goals are next to each other in the step. Errors come out the same
+# way too: a group's error only matters once every group before it has had an answer, and
+# once a group has no answers at all, nothing after it does. So the parent takes the
+# groups' results in order as they come in, and stops (stopping the workers) at the first
+# group without answers.
+#
+# Every group has to be searched to the end before its answers can be combined, though,
+# where sequentially the first answers come out one at a time. So queries with a limit
+# run sequentially, as do ones with a group that doesn't finish within AND_GROUP_MAX_STEPS,
+# or has more than AND_GROUP_MAX_ANSWERS answers (e.g. infinitely many): the parent starts
+# the query over by itself.
+#
+# Groups get sent to the workers like OrParallel's tasks: as queries of their own, with
+# an empty path (see _runTask).
+
+AND_MAX_STEPS = 1000            # most steps the parent takes looking for independent goals
+AND_GROUP_MAX_STEPS = 200000    # most steps a worker takes on a group, before giving up on it
+AND_GROUP_MAX_ANSWERS = 1000    # most answers a group can have (else: give up on it too)
+
+
+def _unboundVarKeys(term):
+    " The (cls._varKey) keys of the unbound vars in term, following bindings "
+
+    keys = set()
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if term.isVar():
+            term = term.deref()
+            if term.isVar():
+                keys.add(cls._varKey(term))
+                continue
+        if not term.ground:
+            stack.extend(term.subterms)
+
+    return keys
+
+
+def independentGroups(goals):
+    """ Splits goals (a list) into groups connected by shared unbound vars: returns lists of
+    indexes into goals, in order of their first goals. Goals with no unbound vars go in
+    the first group with any (they're usually quick checks, not worth a worker of their own)
+    Returns [] if any goal could cut
+    """
+
+    if any(_mayCut(g) for g in goals):
+        return []
+
+    # Union-find over goal indexes: goals sharing a var end up under the same root
+    parent = list(range(len(goals)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owner = {}      # var key -> first goal it's in
+    groundGoals = []
+    for i, goal in enumerate(goals):
+        keys = _unboundVarKeys(goal)
+        if not keys:
+            groundGoals.append(i)
+        for key in keys:
+            parent[root(owner.setdefault(key, i))] = root(i)
+
+    if groundGoals:
+        first = min(owner.values()) if owner else groundGoals[0]
+        for i in groundGoals:
+            parent[root(i)] = root(first)
+
+    groups = {} # (in order of each root's first goal)
+    for i in range(len(goals)):
+        groups.setdefault(root(i), []).append(i)
+    return list(groups.values())
+
+
+def _findIndependent(prog, queryRule):
+    """ Steps queryRule's search along while it doesn't branch, until a step with independent
+    goals. Returns (that step, its goals, their groups), or None if there isn't one (within
+    AND_MAX_STEPS), in which case queryRule is left unbound
+    """
+
+    state = makeFirstStep(queryRule)
+    for _ in range(AND_MAX_STEPS):
+        if state.goals is None: # (an answer already: nothing left to split)
+            break
+
+        goals = list(iterGoals(state.goals))
+        groups = independentGroups(goals)
+        if len(groups) > 1:
+            return state, goals, groups
+
+        prog.steps += 1
+        try:
+            nextState = TakeStep(state, prog, None)
+        except PrologError: # (leave it to the sequential search to raise)
+            break
+        if nextState is None:
+            break
+
+        prog.inferences += 1
+        state = nextState
+        if state.lastChoice is state: # (a choice point: can't go on without branching)
+            break
+
+    state.trail.undoTo(0)
+    return None
+
+
+def _groupProduct(groups):
+    """ Yields every combination of one answer from each group (first group's outermost), as
+    nested loops over them would: groups are (answers, error) pairs, and running out of a
+    group's answers raises its error, if it has one
+    """
+
+    if not groups:
+        yield ()
+        return
+
+    answers, error = groups[0]
+    for answer in answers:
+        for rest in _groupProduct(groups[1:]):
+            yield (answer,) + rest
+    if error is not None:
+        raise error
+
+
+def _sequentialAnswers(prog, queryRule, limit=None):
+    " topDownAnswers, up to limit of them, copied out like the parallel ones "
+    for _ in itertools.islice(topDownAnswers(prog, queryRule), limit):
+        yield _copyAnswer(queryRule)
+
+
+class AndParallel(_Workers):
+    """ Answers a program's queries AND-parallel (see AND-PARALLELISM), on a pool of workers
+    (see _Workers)
+    """
+
+    def answers(self, queryRule, limit=None):
+        """ Yields the bindings for each answer to queryRule (as from Rule.boundVars), up to
+        limit of them if given, copied out of the search like OrParallel's
+        """
+
+        prog = self.program
+        found = None if limit is not None else _findIndependent(prog, queryRule)
+        if found is None:
+            dprint("No independent goals")
+            yield from _sequentialAnswers(prog, queryRule, limit)
+            return
+
+        state, goals, groups = found
+        dprint("Split into {} independent groups".format(len(groups)))
+
+        # Copy the query's bindings and the goals out of the search (sharing their vars),
+        # into one rule: each group's query is its goals, over all of that rule's vars
+        bound = [b is not None for b in queryRule.bindings]
+        varMap = {}
+        snapshot = [cls.resolveCopy(cls.Var(name, slot, queryRule), varMap)
+                for slot, name in enumerate(queryRule.varNames)]
+        snapshot.extend(cls.resolveCopy(g, varMap) for g in goals)
+        state.trail.undoTo(0)
+        combined = cls.Rule(None, snapshot)
+
+        tasks = []
+        for group in groups:
+            groupRule = cls.Rule.Instance(combined.varNames)
+            groupRule.body = [combined.body[len(bound) + i] for i in group]
+            tasks.append((progcache.encodeRules([groupRule]), [], AND_GROUP_MAX_ANSWERS + 1,
+                    AND_GROUP_MAX_STEPS))
+
+        pool = self._getPool()
+        results = pool.imap(_runTask, tasks)
+        pending = len(tasks)
+        try:
+            # Each group's (answers, error), in order, up to the first without answers
+            received = []
+            while pending > 0:
+                encoded, names, steps, inferences, error = _nextResult(prog, results)
+                pending -= 1
+                prog.steps += steps
+                prog.inferences += inferences
+
+                # (too big to wait for: go sequential)
+                if isinstance(error, StepLimit) or len(names) > AND_GROUP_MAX_ANSWERS:
+                    dprint("Group {} didn't finish, running sequentially".format(len(received)))
+                    self._discard(pool)
+                    pending = 0
+                    yield from _sequentialAnswers(prog, queryRule)
+                    return
+
+                received.append(([list(zip(n, a.body))
+                        for n, a in zip(names, progcache.decodeRules(encoded))], error))
+                if not received[-1][0]:
+                    break
+
+            # Each combination binds combined's vars to one answer from each group
+            slots = {name: slot for slot, name in enumerate(combined.varNames)}
+            for combination in _groupProduct(received):
+                for bindings in combination:
+                    for name, value in bindings:
+                        combined.bindings[slots[name]] = value
+
+                varMap = {}
+                answer = []
+                for slot, name in enumerate(queryRule.varNames):
+                    value = combined.body[slot]
+                    if bound[slot] or not value.isVar() or combined.bindings[value.slot] is not None:
+                        answer.append((name, cls.resolveCopy(value, varMap)))
+
+                combined.bindings = [None] * len(combined.varNames)
+                yield answer
+
+        finally:
+            if pending > 0: # (stopped early, e.g. at a group without answers)
+                self._discard(pool)
 
 
 
@@ -417,7 +1940,7 @@ def testFullInterp(program, querystring):
     firstStep = makeFirstStep(queryRule)
 
     def printBindings():
-        for k,v in queryRule.bindings.items():
+        for k,v in queryRule.boundVars():
             print("{} = {}".format(k, v))
 
 
@@ -444,27 +1967,292 @@ def testFullInterp(program, querystring):
 # ============================================================
 
 
-def runFile(fname):
+def crossCheck(program, querystring, reference=None, inOrder=False):
+    """ Answers query the way program would (queryAnswers: e.g. bottom-up, with the datalog
+    engine, or in parallel), and by plain top-down search (topDownAnswers) on reference, or
+    program itself. Returns how they differ, as lines (see compareAnswers): [] if they found
+    the same answers (in the same order too, if inOrder and they weren't found bottom-up)
+    Top-down has to terminate, of course
+    """
+
+    bottomUp = [program.datalog is not None]
+
+    def onFallback(e):
+        bottomUp[0] = False
+
+    found = collectAnswers(lambda: queryAnswers(program, parseQuery(querystring), onFallback))
+    expected = collectAnswers(lambda: topDownAnswers(reference or program, parseQuery(querystring)))
+    return compareAnswers(found, expected, asSets=bottomUp[0], inOrder=inOrder and not bottomUp[0])
+
+
+def runInteractive(prog, profileSort=None, profileJson=None):
+    """ Runs interactiveInterp on prog
+    Each query gets profiled if profileSort (how to sort the report) or profileJson is given
+    """
+    if profileSort is not None or profileJson is not None:
+        prog.profiler = profiler.Profiler()
     try:
-        with open(fname) as f:
-            prog_text = f.read()
-    except:
-        print("Failed to read file '{}'".format(fname))
+        interactiveInterp(prog, profileSort or "time", profileJson)
+    finally:
+        if prog.parallel is not None:
+            prog.parallel.close()
+
+
+def startParallel(prog, workers, ordered=True, fname=None, useCache=True, andParallel=False):
+    """ Makes prog answer queries OR-parallel (or AND-parallel, if andParallel) on workers
+    processes (0: one per CPU), if workers isn't None. Workers load fname, or the demo program
+    if it's None
+    """
+    if workers is None:
+        return
+    source = DEMO_PROGRAM if fname is None else None
+    if andParallel:
+        prog.parallel = AndParallel(prog, workers or None, fname, source, useCache)
+    else:
+        prog.parallel = OrParallel(prog, workers or None, ordered, fname, source, useCache)
+
+
+def bindingsDict(bindings):
+    " bindings (as from Rule.boundVars) as a json-able dict: name -> term, printed like the prompt does "
+    return {k: str(v) for k, v in bindings}
+
+
+def answerKey(bindings):
+    """ A hashable key for an answer (bindings, as from Rule.boundVars), equal for answers that
+    are the same up to renaming their unbound vars: whether they're still in the search,
+    or copied out of it (with context-less vars, like OrParallel's)
+    """
+
+    key = []
+    varNums = {}
+    for name, value in bindings:
+        key.append(name)
+        stack = [value]
+        while stack:
+            t = stack.pop()
+            if t.isVar():
+                if t.context is not None:
+                    t = t.deref()
+                if t.isVar():
+                    varKey = id(t) if t.context is None else cls._varKey(t)
+                    key.append((varNums.setdefault(varKey, len(varNums)),))
+                    continue
+
+            key.append(t.sym)
+            stack.extend(reversed(t.subterms))
+
+    return tuple(key)
+
+
+def answerStr(bindings):
+    return ", ".join("{} = {}".format(k, v) for k, v in bindings) or "yes"
+
+
+def collectAnswers(makeAnswers):
+    """ Runs the answers from makeAnswers() (an iterator over bindings) to the end
+    Returns ([(answerKey, answerStr) of each], message of the error that ended them, or None)
+    """
+    answers = []
+    try:
+        for bindings in makeAnswers():
+            answers.append((answerKey(bindings), answerStr(bindings)))
+    except (PrologError, datalog.DatalogError) as e:
+        return answers, str(e)
+    return answers, None
+
+
+def compareAnswers(found, expected, asSets=False, inOrder=False):
+    """ Compares two results of collectAnswers: returns lines saying how found differs from
+    expected, [] if it doesn't. Answers are compared as multisets, or as sets if asSets
+    (e.g. bottom-up, where each answer comes out once), or as lists if inOrder,
+    and the errors by their messages
+    """
+
+    def counts(answers):
+        table = {}
+        for key, text in answers:
+            n, _ = table.get(key, (0, text))
+            table[key] = (1 if asSets else n + 1, text)
+        return table
+
+    foundCounts, expectedCounts = counts(found[0]), counts(expected[0])
+    lines = []
+    for key in foundCounts.keys() | expectedCounts.keys():
+        n, text = foundCounts.get(key, (0, None))
+        m, text2 = expectedCounts.get(key, (0, None))
+        if n != m:
+            lines.append("{} x{}, expected x{}".format(text or text2, n, m))
+    lines.sort()
+
+    if inOrder and not lines:
+        for i, ((key, text), (key2, text2)) in enumerate(zip(found[0], expected[0]), 1):
+            if key != key2:
+                lines.append("answer {} is {}, expected {}".format(i, text, text2))
+                break
+
+    if found[1] != expected[1]:
+        lines.append("error: {}, expected: {}".format(found[1], expected[1]))
+    return lines
+
+
+def runBatch(program, queries, out, limit=None, profileSort="time", crossCheck=False,
+        profileJson=None):
+    """ Runs each query (lines of text: blank ones and % comments are skipped) on program,
+    without prompting, writing the results to out as JSON lines. For each query that's
+    - one {"line", "answer"} per answer (up to limit of them, if given): answer maps var names
+      to their bindings, as bindingsDict
+    - then a summary {"line", "query", "answers", "exhausted", "steps", "inferences", "seconds"}:
+      how many answers, whether there were no more (i.e. limit wasn't hit), steps/inferences
+      taken and time spent finding them. Plus "error" if the query didn't parse or hit an error
+      (answers found before then were still written), and "profile" if program has a profiler
+      (unless profileJson is given: then it's appended there instead, as by reportProfile)
+    With crossCheck, each query is run again by plain top-down search (topDownAnswers, after the
+    stats are taken), and the summary gets "crossCheck": how the answers differed (as from
+    compareAnswers, [] if they didn't). Needs all the answers, so isn't for use with limit
+    Returns how many queries had errors (or, cross-checking, differences)
+    """
+
+    def write(obj):
+        out.write(json.dumps(obj) + "\n")
+
+    errors = 0
+    for lineNo, queryStr in enumerate(queries, 1):
+        queryStr = queryStr.strip()
+        if not queryStr or queryStr.startswith("%"):
+            continue
+
+        summary = {"line": lineNo, "query": queryStr, "answers": 0, "exhausted": False}
+        if program.profiler is not None:
+            program.profiler.reset()
+        steps, inferences = program.steps, program.inferences
+        seconds = 0.0
+        found = []          # (answerKey, answerStr) of each answer, when cross-checking
+        bottomUp = [program.datalog is not None]
+        queryRule = None    # (stays None if the query doesn't parse)
+        queryError = None   # what ended the query
+
+        def onFallback(e):
+            bottomUp[0] = False
+
+        try:
+            start = time.perf_counter()
+            queryRule = parseQuery(queryStr)
+            answers = queryAnswers(program, queryRule, onFallback, limit)
+
+            # (time only finding answers, not writing them out)
+            while limit is None or summary["answers"] < limit:
+                bindings = next(answers, None)
+                if bindings is None:
+                    summary["exhausted"] = True
+                    break
+                seconds += time.perf_counter() - start
+
+                summary["answers"] += 1
+                if crossCheck:
+                    found.append((answerKey(bindings), answerStr(bindings)))
+                write({"line": lineNo, "answer": bindingsDict(bindings)})
+                start = time.perf_counter()
+
+        except cls.ParseError as e:
+            summary["error"] = str(e)
+            errors += 1
+        except (datalog.DatalogError, PrologError) as e:
+            summary["error"] = queryError = str(e)
+            errors += 1
+
+        seconds += time.perf_counter() - start
+        summary.update(steps=program.steps - steps, inferences=program.inferences - inferences,
+                seconds=seconds)
+        if program.profiler is not None:
+            if profileJson is None:
+                summary["profile"] = program.profiler.toDict(profileSort)
+            else:
+                reportProfile(program, queryStr, profileSort, profileJson)
+
+        if crossCheck and queryRule is not None:
+            expected = collectAnswers(lambda: topDownAnswers(program, parseQuery(queryStr)))
+            summary["crossCheck"] = compareAnswers((found, queryError), expected, bottomUp[0])
+            if summary["crossCheck"] and "error" not in summary:
+                errors += 1
+
+        write(summary)
+        out.flush()
+
+    return errors
+
+
+def loadProgram(fname, engine=ENGINE_TREE, useCache=True):
+    """ Program.Load, or the demo program if fname is None
+    Prints what went wrong & exits if it can't read or parse it (for the entry points)
+    """
+    try:
+        if fname is None:
+            return Program.ParseString(DEMO_PROGRAM, engine)
+        return Program.Load(fname, engine, useCache)
+    except OSError:
+        print("Failed to read file '{}'".format(fname), file=sys.stderr)
+        exit(1)
+    except cls.ParseError as e:
+        print("Failed to parse program", file=sys.stderr)
+        print(e, file=sys.stderr)
         exit(1)
 
+
+def runQueries(fname, queryFile, engine=ENGINE_TREE, useCache=True, limit=None, profileSort=None,
+        workers=None, ordered=True, andParallel=False, crossCheck=False, profileJson=None):
+    """ Batch mode: loads fname (once), then runs the queries in queryFile ("-" for stdin)
+    on it with runBatch, writing JSON lines to stdout. Exits with 1 if any query had an error
+    Queries get profiled if profileSort (what to sort the predicates by) or profileJson is
+    given (see runBatch), run in parallel if workers is (see startParallel), and cross-checked
+    if crossCheck
+    """
+
+    prog = loadProgram(fname, engine, useCache)
+    if profileSort is not None or profileJson is not None:
+        prog.profiler = profiler.Profiler()
+    startParallel(prog, workers, ordered, fname, useCache, andParallel)
+
+    if queryFile == "-":
+        queries = sys.stdin
+    else:
+        try:
+            queries = open(queryFile)
+        except OSError:
+            print("Failed to read file '{}'".format(queryFile), file=sys.stderr)
+            exit(1)
+
+    try:
+        with queries:
+            errors = runBatch(prog, queries, sys.stdout, limit, profileSort or "time", crossCheck,
+                    profileJson)
+    finally:
+        if prog.parallel is not None:
+            prog.parallel.close()
+
+    if errors:
+        exit(1)
+
+
+def runFile(fname, engine=ENGINE_TREE, useCache=True, profileSort=None, profileJson=None,
+        workers=None, ordered=True, andParallel=False):
     print("=== JPL {} ===". format(VERSION))
-    print("Loaded program from {}".format(fname))
 
     try:
-        prog = Program.ParseString(prog_text)
+        prog = Program.Load(fname, engine, useCache)
+    except OSError:
+        print("Failed to read file '{}'".format(fname))
+        exit(1)
     except cls.ParseError as e:
         print("Failed to parse program")
         print(e)
         return
 
-    interactiveInterp(prog)
+    print("Loaded program from {}".format(fname))
+    startParallel(prog, workers, ordered, fname, useCache, andParallel)
+    runInteractive(prog, profileSort, profileJson)
 
-def runDemo():
+def runDemo(engine=ENGINE_TREE, profileSort=None, profileJson=None, workers=None, ordered=True,
+        andParallel=False):
     print("=== JPL {} ===". format(VERSION))
     print("Running demo program:")
     for line in DEMO_PROGRAM.splitlines():
@@ -472,13 +2260,14 @@ def runDemo():
     print()
 
     try:
-        prog = Program.ParseString(DEMO_PROGRAM)
+        prog = Program.ParseString(DEMO_PROGRAM, engine)
     except cls.ParseError as e:
         print("Failed to parse program")
         print(e)
         return
 
-    interactiveInterp(prog)
+    startParallel(prog, workers, ordered, andParallel=andParallel)
+    runInteractive(prog, profileSort, profileJson)
 
 DEMO_PROGRAM = """
 true.
@@ -488,34 +2277,70 @@ bar(a).
 bar(b).
 % Try running `foo(X).`, or just `X.`
 % Some notes: there is no 'occurs' check: Try not to make infinite recursion
-% There are also no integers or things
+% Integers work with is/2 and comparisons, e.g. `is(X, +(1, 2)).`
 """
 
 
-def printUsage():
-    s = """
-    Usage: {} [-h] [FILE]
-    - With no args: runs a demo program
-    - With an arg: tries to load a prolog program from file
-    """
-    print(s)
-    exit(1);
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+            description="JPL: interpreter for a very simple dialect of prolog")
+    parser.add_argument("-?", action="help", help=argparse.SUPPRESS)
+    parser.add_argument("file", nargs="?",
+            help="prolog program to load (with no file: runs a demo program)")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINE_TREE,
+            help="how rule heads are matched: '{}' copies rules and unifies term trees, "
+                 "'{}' runs precompiled head instructions, "
+                 "'{}' evaluates Datalog queries bottom-up (others like '{}'), "
+                 "'{}' shares rules' terms between instances instead of copying them "
+                 "(default: %(default)s)"
+                 .format(ENGINE_TREE, ENGINE_COMPILED, ENGINE_DATALOG, ENGINE_TREE, ENGINE_SHARED))
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+            help="always parse the file, don't read or write its precompiled cache (FILE.jplc)")
+    parser.add_argument("--profile", action="store_true",
+            help="after each query, print per-predicate counts of calls, redos, head unification "
+                 "attempts & successes, and time")
+    parser.add_argument("--profile-sort", choices=profiler.SORT_KEYS, default="time",
+            help="what to sort the --profile report by (default: %(default)s)")
+    parser.add_argument("--profile-json", metavar="FILE",
+            help="profile each query (like --profile), appending the results to FILE as JSON lines")
+    parser.add_argument("--batch", metavar="QUERIES",
+            help="don't prompt: run each query in the file QUERIES ('-' for stdin, one per line), "
+                 "writing answers & per-query stats to stdout as JSON lines")
+    parser.add_argument("--limit", type=int, metavar="N",
+            help="with --batch: stop each query after its first N answers (default: all of them)")
+    parser.add_argument("--cross-check", action="store_true",
+            help="with --batch: run each query again by plain top-down search, and report "
+                 "whether the answers differ (e.g. bottom-up with '{}', or with --parallel)"
+                 .format(ENGINE_DATALOG))
+    parser.add_argument("--parallel", type=int, metavar="N",
+            help="answer top-down queries OR-parallel, on N worker processes (0: one per CPU)")
+    parser.add_argument("--unordered", dest="ordered", action="store_false",
+            help="with --parallel: give answers as workers find them, not in sequential order")
+    parser.add_argument("--and-parallel", action="store_true",
+            help="with --parallel: instead, solve independent goals (ones sharing no unbound "
+                 "variables) at the same time, combining their answers")
+
+    args = parser.parse_args(argv)
+    if args.cross_check and (args.batch is None or args.limit is not None):
+        parser.error("--cross-check needs --batch, and all the answers (no --limit)")
+    return args
 
 def main():
     " Main entry point for normal operation "
 
-    num_args = len(sys.argv) - 1
-    
-    if num_args == 0:
-        runDemo()
-    elif num_args > 1:
-        printUsage()
-    elif sys.argv[1] in ["-h", "--help", "-?"]:
-        printUsage()
+    args = parseArgs(sys.argv[1:])
 
+    profileSort = args.profile_sort if args.profile else None
+    if args.batch is not None:
+        runQueries(args.file, args.batch, args.engine, args.cache, args.limit,
+                args.profile_sort if args.profile or args.profile_json else None,
+                args.parallel, args.ordered, args.and_parallel, args.cross_check, args.profile_json)
+    elif args.file is None:
+        runDemo(args.engine, profileSort, args.profile_json, args.parallel, args.ordered,
+                args.and_parallel)
     else: #1 arg: treat as a file
-        fname = sys.argv[1]
-        runFile(fname)
+        runFile(args.file, args.engine, args.cache, profileSort, args.profile_json,
+                args.parallel, args.ordered, args.and_parallel)
 
 
 
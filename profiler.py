@@ -0,0 +1,132 @@
+# (python3)
+import clause as cls
+import json
+import time
+
+
+"""
+Profiling for jpl queries: where do the steps (and the time) go?
+
+Set a Program's profiler to a Profiler to turn it on (it's None, i.e. off, by default):
+outerInterp and TakeStep then report each step to it, and it keeps, per predicate (name/arity):
+- calls:     steps taken on a goal for the first time
+- redos:     steps retrying a goal from its choice point (backtracking into the predicate)
+- attempts:  rule heads tried against its goals (after indexing & the couldUnify pre-check)
+- unified:   of those, how many unified
+- time:      seconds spent in those steps (head matching, builtins: not the predicate's
+             subgoals, which get steps of their own. Tabled calls include filling their table)
+plus the deepest step reached overall
+
+Low attempts/unified ratios point at predicates that'd benefit from better indexing,
+lots of redos of the same calls at ones that could be tabled.
+"""
+
+
+class PredStats:
+    " Counts for one predicate "
+    __slots__ = ("calls", "redos", "attempts", "unified", "time")
+
+    def __init__(self):
+        self.calls = 0
+        self.redos = 0
+        self.attempts = 0
+        self.unified = 0
+        self.time = 0.0
+
+    def toDict(self):
+        return {k: getattr(self, k) for k in PredStats.__slots__}
+
+
+SORT_KEYS = list(PredStats.__slots__)
+
+# Unbound var goals (which can match any rule) get counted under this name
+VAR_GOAL = "(var)"
+
+
+class Profiler:
+    " Collects PredStats for the steps of a program's queries (see the module docstring) "
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        " Forgets everything so far "
+        self.stats = {}     # sym (or VAR_GOAL) -> PredStats
+        self.maxDepth = 0
+        self.steps = 0
+        self.open = []      # (stats, start time) of steps in progress (tabling nests them)
+
+
+    def _statsFor(self, goal):
+        if goal.isVar():
+            goal = goal.deref()
+        key = VAR_GOAL if goal.isVar() else goal.sym
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = PredStats()
+        return stats
+
+
+    # === Hooks (called by jpl.outerInterp & jpl.TakeStep)
+
+    def stepStart(self, state, bookmark):
+        " A step is about to be taken on state's first goal (retrying it if bookmark isn't None) "
+        stats = self._statsFor(state.goals.goal)
+        if bookmark is None:
+            stats.calls += 1
+        else:
+            stats.redos += 1
+        self.open.append((stats, time.perf_counter()))
+
+
+    def stepEnd(self, newState):
+        " The step started last is done: newState is the step made, or None if there was none "
+        stats, start = self.open.pop()
+        stats.time += time.perf_counter() - start
+        self.steps += 1
+        if newState is not None and newState.depth > self.maxDepth:
+            self.maxDepth = newState.depth
+
+
+    def headUnify(self, goal, success):
+        " A rule head was tried against goal "
+        stats = self._statsFor(goal)
+        stats.attempts += 1
+        if success:
+            stats.unified += 1
+
+
+    # === Reporting
+
+    def _sortedNames(self, sortBy):
+        names = [(VAR_GOAL if key == VAR_GOAL else "{}/{}".format(*cls.symbolName(key)), stats)
+                for key, stats in self.stats.items()]
+        names.sort(key=lambda item: (-getattr(item[1], sortBy), item[0]))
+        return names
+
+
+    def report(self, sortBy="time"):
+        " Returns a table of every predicate's stats (as a string), biggest sortBy first "
+        assert sortBy in SORT_KEYS, "ERROR: can't sort by '{}'".format(sortBy)
+
+        lines = ["{:<24} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+                "predicate", "calls", "redos", "attempts", "unified", "time")]
+        for name, s in self._sortedNames(sortBy):
+            lines.append("{:<24} {:>9} {:>9} {:>9} {:>9} {:>9.4f}s".format(
+                    name, s.calls, s.redos, s.attempts, s.unified, s.time))
+        lines.append("{} steps, max depth {}".format(self.steps, self.maxDepth))
+        return "\n".join(lines)
+
+
+    def toDict(self, sortBy="time"):
+        " Everything collected, as a json-able dict (predicates in the report's order) "
+        return {
+            "steps": self.steps,
+            "maxDepth": self.maxDepth,
+            "predicates": [dict(predicate=name, **s.toDict()) for name, s in self._sortedNames(sortBy)],
+        }
+
+
+    def toJSON(self, sortBy="time"):
+        return json.dumps(self.toDict(sortBy))
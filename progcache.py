@@ -0,0 +1,397 @@
+# (python3)
+import clause as cls
+import array
+import hashlib
+import marshal
+import os
+
+
+"""
+Precompiled program cache for jpl (like python's .pyc files)
+
+Parsing a big program from source takes a while, so once a file has been parsed,
+its rules get written out in a compact binary form next to it (foo.jpl -> foo.jplc),
+along with a hash of the source. Next time, if the source hash still matches,
+the rules are rebuilt straight from the cache, without any parsing.
+
+Cache contents (marshal'd):
+- functors: every functor's (name, arity) once each (numbers too), and every var name
+- code: every rule's terms, flattened into one array of ints, in postorder
+  (so they can be rebuilt bottom-up, with a stack):
+    var:     -1 - slot
+    functor: its index in functors (after its subterms)
+  plus where each rule's code starts, its var names (as indexes), and whether it has a head
+  (arrays are stored as raw bytes, so loading them is just a copy)
+- the program's indexes (see jpl.Program._buildIndex), so they don't get rebuilt
+
+Symbol ids (cls.symbolId) are only good for the process that made them, so the cache
+refers to functors by their index in the cache's own table instead: loading interns
+each of them once (numbers aren't interned), and remaps the indexes' keys to the symbols.
+
+Rules are only rebuilt from the code the first time they're looked at (LazyRules),
+so loading a big fact base doesn't cost anything for the facts a query never touches.
+Rebuilt atoms are shared between all the rules, instead of one object each.
+
+Used by jpl.Program.Load
+"""
+
+
+MAGIC = b"JPLC"
+FORMAT_VERSION = 2
+
+CACHE_SUFFIX = "c"
+
+
+def cachePath(fname):
+    " Where the cache for source file fname goes "
+    return fname + CACHE_SUFFIX
+
+
+def hashSource(fname):
+    " Hash of the contents of source file fname "
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
+
+
+# ============================================================
+#
+#                         ENCODING
+#
+# ============================================================
+
+class _Symbols:
+    " Functors (name/arity) and var names used by the cached rules, each numbered once "
+
+    def __init__(self):
+        self.functors = []
+        self.functorIds = {}
+        self.names = []
+        self.nameIds = {}
+
+
+    def functor(self, token, arity):
+        " Index of token/arity (keeping ints apart from strings like '1') "
+        key = (type(token), token, arity)
+        fid = self.functorIds.get(key)
+        if fid is None:
+            fid = self.functorIds[key] = len(self.functors)
+            self.functors.append((token, arity))
+        return fid
+
+
+    def name(self, name):
+        " Index of var name "
+        nid = self.nameIds.get(name)
+        if nid is None:
+            nid = self.nameIds[name] = len(self.names)
+            self.names.append(name)
+        return nid
+
+
+class _Encoder:
+    " Flattens rules into one array of ints, numbering the functors they use in symbols "
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+
+        self.code = array.array("i")
+        self.starts = array.array("i")   # rule -> where its code starts in code
+        self.varStarts = array.array("i") # rule -> where its var names start in varSyms
+        self.varSyms = array.array("i")
+        self.hasHead = array.array("b")
+
+
+    def rule(self, rule):
+        " Appends a Rule (or headless directive) "
+        self.starts.append(len(self.code))
+        self.varStarts.append(len(self.varSyms))
+        self.hasHead.append(rule.head is not None)
+
+        terms = list(rule.body) if rule.head is None else [rule.head] + rule.body
+        code = self.code
+        symbols = self.symbols
+        for term in terms:
+            # postorder: a functor is pushed again (as its index) to be emitted after its subterms
+            stack = [term]
+            while stack:
+                t = stack.pop()
+                if isinstance(t, int):
+                    code.append(t)
+                elif t.isVar():
+                    code.append(-1 - t.slot)
+                else:
+                    stack.append(symbols.functor(t.token, len(t.subterms)))
+                    stack.extend(reversed(t.subterms))
+
+        self.varSyms.extend(symbols.name(name) for name in rule.varNames)
+
+
+    def finish(self):
+        " Returns the encoded rules, as a dict of marshal-able things "
+        self.starts.append(len(self.code))
+        self.varStarts.append(len(self.varSyms))
+        return {
+            "code": self.code.tobytes(),
+            "starts": self.starts.tobytes(),
+            "varStarts": self.varStarts.tobytes(),
+            "varSyms": self.varSyms.tobytes(),
+            "hasHead": self.hasHead.tobytes(),
+        }
+
+
+def encodeRules(rules):
+    """ Returns rules (or headless directives) as one marshal-able value, with names instead of
+    this process's symbol ids: for sending them to another process (see jpl.OrParallel)
+    """
+    symbols = _Symbols()
+    enc = _Encoder(symbols)
+    for r in rules:
+        enc.rule(r)
+    return (enc.finish(), symbols.functors, symbols.names)
+
+
+def encodeProgram(rules, directives, index, sourceHash):
+    """ Returns bytes for the cache of a program
+    index is (predIndex, varIndex, argIndex), as built by jpl.Program
+    """
+
+    symbols = _Symbols()
+    ruleEnc = _Encoder(symbols)
+    for r in rules:
+        ruleEnc.rule(r)
+
+    directiveEnc = _Encoder(symbols)
+    for d in directives:
+        directiveEnc.rule(d)
+
+    # index keys are symbols: store them as functor indexes
+    def fid(sym):
+        return symbols.functor(*cls.symbolName(sym))
+
+    predIndex, varIndex, argIndex = index
+    payload = {
+        "rules": ruleEnc.finish(),
+        "directives": directiveEnc.finish(),
+        "index": (
+            {fid(p): rs for p, rs in predIndex.items()},
+            {fid(p): rs for p, rs in varIndex.items()},
+            {fid(p): {fid(k): rs for k, rs in keyed.items()} for p, keyed in argIndex.items()},
+        ),
+        "functors": symbols.functors,
+        "names": symbols.names,
+    }
+
+    return MAGIC + marshal.dumps((FORMAT_VERSION, sourceHash, payload))
+
+
+# ============================================================
+#
+#                         DECODING
+#
+# ============================================================
+
+def _intArray(data):
+    a = array.array("i")
+    a.frombytes(data)
+    return a
+
+
+class LazyRules:
+    """ Read-only list of the rules in a cache, each rebuilt the first time it's accessed
+    (jpl.Program only ever indexes into its rules, or iterates over them)
+    """
+
+    def __init__(self, encoded, functors, syms, names):
+        """ functors are the cache's (name, arity)s, syms maps their indexes to symbols,
+        names maps the cache's var name indexes to names
+        """
+        self.functors = functors
+        self.syms = syms
+        self.names = names
+        self.code = _intArray(encoded["code"])
+        self.starts = _intArray(encoded["starts"])
+        self.varStarts = _intArray(encoded["varStarts"])
+        self.varSyms = _intArray(encoded["varSyms"])
+        self.hasHead = encoded["hasHead"]
+
+        self.atoms = {} # functor index -> shared atom
+        self.rules = [None] * (len(self.starts) - 1)
+
+
+    def __len__(self):
+        return len(self.rules)
+
+
+    def __getitem__(self, i):
+        rule = self.rules[i]
+        if rule is None:
+            rule = self.rules[i] = self._decode(i)
+        return rule
+
+
+    def __iter__(self):
+        for i in range(len(self.rules)):
+            yield self[i]
+
+
+    def factArgs(self, i):
+        """ Returns the tokens of rule i's head args, if it's a fact whose args are all atoms
+        or numbers (else None), read straight from the code without rebuilding the rule
+        (for datalog.Evaluator, which only needs them as a tuple)
+        """
+        if not self.hasHead[i]:
+            return None
+
+        code = self.code
+        functors = self.functors
+        start = self.starts[i]
+        end = self.starts[i + 1]
+
+        # all flat means the last functor is the head, with every other entry one of its args
+        if functors[code[end - 1]][1] != end - start - 1:
+            return None
+        args = []
+        for pos in range(start, end - 1):
+            x = code[pos]
+            if x < 0:
+                return None
+            token, arity = functors[x]
+            if arity != 0:
+                return None
+            args.append(token)
+        return tuple(args)
+
+
+    def _decode(self, i):
+        " Rebuilds rule i "
+
+        syms = self.syms
+        functors = self.functors
+        atoms = self.atoms
+        code = self.code
+
+        # vars go straight into the rule's context, with their slots (like Rule.copy)
+        varSyms = self.varSyms[self.varStarts[i]:self.varStarts[i + 1]]
+        rule = cls.Rule.Instance([self.names[s] for s in varSyms])
+        ruleVars = [cls.Var(name, slot, rule) for slot, name in enumerate(rule.varNames)]
+
+        # Rebuild bottom-up: each functor takes its subterms off the end of terms
+        terms = []
+        pos = self.starts[i]
+        end = self.starts[i + 1]
+        while pos < end:
+            x = code[pos]
+            pos += 1
+            if x < 0:
+                terms.append(ruleVars[-1 - x])
+                continue
+
+            sym = syms[x]
+            token, arity = functors[x]
+            if arity == 0:
+                atom = atoms.get(x)
+                if atom is None:
+                    atom = atoms[x] = cls.Functor(token, [], sym)
+                    atom.ground = True
+                terms.append(atom)
+            else:
+                args = terms[-arity:]
+                del terms[-arity:]
+                f = cls.Functor(token, args, sym)
+                f.ground = all(not a.isVar() and a.ground for a in args) # (as cls.markGround)
+                terms.append(f)
+
+        if self.hasHead[i]:
+            rule.head, rule.body = terms[0], terms[1:]
+        else:
+            rule.body = terms
+        return rule
+
+
+def decodeRules(data):
+    " Rebuilds the list of rules encoded by encodeRules "
+    encoded, functors, names = data
+    return list(LazyRules(encoded, functors, cls.symbolIds(functors), names))
+
+
+def decodeProgram(data, sourceHash):
+    """ Rebuilds (rules, directives, index) from cache bytes (rules being LazyRules)
+    Returns None if data isn't a cache (of this format) for a source with hash sourceHash
+    """
+
+    if not data.startswith(MAGIC):
+        return None
+
+    try:
+        version, cachedHash, payload = marshal.loads(data[len(MAGIC):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+    if version != FORMAT_VERSION or cachedHash != sourceHash:
+        return None
+
+    try:
+        return _decodePayload(payload)
+    except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+        # (it unmarshalled, but isn't laid out like a cache of ours: treat it as no cache)
+        return None
+
+
+def _decodePayload(payload):
+    " decodeProgram's work once the header checks out: can raise on a malformed payload "
+
+    # Intern every functor the cache uses, then remap the indexes' keys to the ids
+    functors = payload["functors"]
+    syms = cls.symbolIds(functors)
+    names = payload["names"]
+
+    predIndex, varIndex, argIndex = payload["index"]
+    index = (
+        {syms[p]: rs for p, rs in predIndex.items()},
+        {syms[p]: rs for p, rs in varIndex.items()},
+        {syms[p]: {syms[k]: rs for k, rs in keyed.items()} for p, keyed in argIndex.items()},
+    )
+
+    rules = LazyRules(payload["rules"], functors, syms, names)
+    directives = list(LazyRules(payload["directives"], functors, syms, names))
+    return (rules, directives, index)
+
+
+# ============================================================
+#
+#                       READING/WRITING
+#
+# ============================================================
+
+def read(fname, sourceHash):
+    " Returns (rules, directives, index) from the cache for source fname, or None if there's no valid one "
+    try:
+        with open(cachePath(fname), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    return decodeProgram(data, sourceHash)
+
+
+def write(fname, rules, directives, index, sourceHash):
+    """ Writes the cache for source fname. Returns whether it worked
+    (not being able to write it, e.g. in a read-only directory, isn't an error)
+    """
+
+    path = cachePath(fname)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(encodeProgram(rules, directives, index, sourceHash))
+        os.replace(tmp, path) # so nobody reads a half-written cache
+        return True
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
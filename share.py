@@ -0,0 +1,192 @@
+# (python3)
+import clause as cls
+
+
+"""
+Structure-sharing clause instances for jpl
+
+Instead of copying a rule for each attempt, a rule instance is just the source rule
+plus an environment frame: a cls.Rule.Instance holding one binding per var slot,
+and no terms of its own. The source rule's terms (its "skeletons") are never copied:
+a skeleton var means "slot N of whatever frame the skeleton is read in".
+
+Head unification walks (skeleton, frame) pairs directly against the goal, so nothing
+gets built to match a head. Terms only need a frame-bound form when they escape
+into a binding, or into the goal list:
+- a skeleton var becomes a Var with the frame as its context (like Rule.copy's vars)
+- a ground skeleton is shared as is (see cls.markGround)
+- any other skeleton becomes a Molecule: (skeleton, frame), no copying
+
+Molecules behave like Functors to the rest of jpl (builtins, control constructs,
+tabling, printing): their subterms get made (as above) the first time they're needed.
+
+Used by jpl.Program when its engine is ENGINE_SHARED
+"""
+
+
+class Molecule(cls.Term):
+    " A non-ground skeleton functor, read in a frame (a cls.Rule whose bindings its vars use) "
+    __slots__ = ("skel", "frame", "_subterms")
+
+    def __init__(self, skel, frame):
+        self.skel = skel
+        self.frame = frame
+        self._subterms = None
+
+    @property
+    def token(self):
+        return self.skel.token
+
+    @property
+    def sym(self):
+        return self.skel.sym
+
+    @property
+    def ground(self):
+        return False # (ground skeletons never get wrapped)
+
+    @property
+    def subterms(self):
+        " Frame-bound subterms (made on first use, then kept: they never change) "
+        if self._subterms is None:
+            frame = self.frame
+            self._subterms = [inFrame(s, frame) for s in self.skel.subterms]
+        return self._subterms
+
+
+    def shortname(self):
+        return self.skel.shortname()
+
+    def safeStr(self, verbose=cls.VERBOSE, depth=10):
+        return cls._termStr(self, verbose, depth)
+
+    def __repr__(self):
+        return self.safeStr()
+
+
+def inFrame(skel, frame):
+    " Returns a term standing for skel read in frame (see above: Var, shared ground term or Molecule) "
+    if skel.isVar():
+        return cls.Var(skel.token, skel.slot, frame)
+    if skel.ground:
+        return skel
+    return Molecule(skel, frame)
+
+
+# ============================================================
+#
+#                        UNIFICATION
+#
+# ============================================================
+
+# Terms are handled as pairs (term, frame): frame is None for ordinary terms
+# (Functors, Molecules, Vars with their own context), else term is a skeleton read in frame
+
+def _resolve(term, frame):
+    """ Dereferences (term, frame): follows bindings until a functor or an unbound var
+    Returns a pair again (frame is None unless term is a skeleton)
+    """
+
+    while True:
+        if frame is not None:
+            if not term.isVar():
+                return (term, None if term.ground else frame)
+            binding = frame.bindings[term.slot]
+            if binding is None:
+                return (term, frame) # unbound slot in frame
+            term, frame = binding, None
+
+        elif term.isVar():
+            binding = term.context.bindings[term.slot]
+            if binding is None:
+                return (term, None)
+            term = binding
+
+        elif isinstance(term, Molecule):
+            term, frame = term.skel, term.frame
+
+        else:
+            return (term, None)
+
+
+def _bind(var, frame, value, trail):
+    " Binds (unbound) var, read in frame (or None), to term value "
+    if frame is None:
+        trail.bind(var, value)
+    elif frame.instanceId >= trail.boundary:
+        frame.bindings[var.slot] = value # too new to need trailing: no Var needed either
+    else:
+        trail.bind(cls.Var(var.token, var.slot, frame), value)
+
+
+def unify(t1, f1, t2, f2, trail):
+    """ Unifies (t1, f1) with (t2, f2), like cls._tryUnify (t1 being the newer term)
+    Returns success, bindings made are pushed onto trail (or made in place on new frames)
+    Doesn't attempt to undo
+    """
+
+    stack = [t1, f1, t2, f2] # quadruples, flattened
+    while stack:
+        f2 = stack.pop()
+        t2 = stack.pop()
+        f1 = stack.pop()
+        t1 = stack.pop()
+
+        t1, f1 = _resolve(t1, f1)
+        t2, f2 = _resolve(t2, f2)
+        v1, v2 = t1.isVar(), t2.isVar()
+
+        if not v1 and not v2: # both functors
+            if t1 is t2 and f1 is f2:
+                continue
+            if t1.sym != t2.sym:
+                return False
+
+            s1, s2 = t1.subterms, t2.subterms
+            for i in reversed(range(len(s1))):
+                stack.append(s1[i])
+                stack.append(f1)
+                stack.append(s2[i])
+                stack.append(f2)
+            continue
+
+        # '_' matches anything, without binding
+        if t1.token == "_" or t2.token == "_":
+            continue
+
+        if v1 and v2:
+            # the same var (in whatever form) is already unified with itself
+            c1 = t1.context if f1 is None else f1
+            c2 = t2.context if f2 is None else f2
+            if c1 is c2 and t1.slot == t2.slot:
+                continue
+
+        # bind newer to older when both are vars (like cls._tryUnify)
+        if v1:
+            _bind(t1, f1, t2 if f2 is None else inFrame(t2, f2), trail)
+        else:
+            _bind(t2, f2, t1 if f1 is None else inFrame(t1, f1), trail)
+
+    return True
+
+
+# ============================================================
+#
+#                       RULE INSTANCES
+#
+# ============================================================
+
+def unifyHead(rule, goal, instanceId, trail):
+    """ Matches rule's head against goal, in a new frame for rule
+    Returns (frame, success), like wam.CompiledRule.unifyHead: on success,
+    frame.body holds the rule's body goals, read in frame (nothing's copied)
+    """
+
+    frame = cls.Rule.Instance(rule.varNames)
+    frame.setInstanceId(instanceId)
+
+    if not unify(rule.head, frame, goal, None, trail):
+        return (frame, False)
+
+    frame.body = [inFrame(b, frame) for b in rule.body]
+    return (frame, True)
@@ -0,0 +1,103 @@
+import io
+import jpl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+" Batch mode (--batch): JSON lines per answer, a summary per query, and the exit status "
+
+
+SOURCE = """
+item(a). item(b). item(c).
+double(X, Y) :- is(Y, *(X, 2)).
+"""
+
+QUERIES = """% a comment, then a blank line
+
+item(X).
+double(3, Y).
+double(Z, Y).
+item(
+item(d).
+"""
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def runBatch(queries, limit=None, **kwargs):
+    " Returns (error count, output lines as parsed JSON) "
+    out = io.StringIO()
+    errors = jpl.runBatch(jpl.Program.ParseString(SOURCE), io.StringIO(queries), out, limit, **kwargs)
+    return (errors, [json.loads(line) for line in out.getvalue().splitlines()])
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_output(self):
+        errors, lines = runBatch(QUERIES)
+        self.assertEqual(errors, 2)
+
+        summaries = [l for l in lines if "query" in l]
+        self.assertEqual([s["line"] for s in summaries], [3, 4, 5, 6, 7])
+
+        # answers come before their query's summary, one line each
+        self.assertEqual(lines[:4], [
+                {"line": 3, "answer": {"X": "a"}},
+                {"line": 3, "answer": {"X": "b"}},
+                {"line": 3, "answer": {"X": "c"}},
+                summaries[0]])
+        self.assertEqual(lines[4], {"line": 4, "answer": {"Y": "6"}})
+
+        for s in summaries:
+            self.assertEqual(set(s) - {"error"},
+                    {"line", "query", "answers", "exhausted", "steps", "inferences", "seconds"})
+            self.assertIsInstance(s["seconds"], float)
+
+        items, double, unbound, bad, none = summaries
+        self.assertEqual((items["query"], items["answers"], items["exhausted"]), ("item(X).", 3, True))
+        self.assertEqual((items["steps"], items["inferences"]), (3, 3))
+        self.assertNotIn("error", items)
+
+        self.assertEqual(double["answers"], 1)
+        self.assertIn("error", unbound)         # is/2 on an unbound var
+        self.assertEqual(unbound["answers"], 0)
+        self.assertIn("error", bad)             # doesn't parse
+        self.assertEqual((none["answers"], none["exhausted"]), (0, True))
+        self.assertNotIn("error", none)
+
+    def test_limit(self):
+        errors, lines = runBatch("item(X).\n", limit=2)
+        self.assertEqual([l["answer"]["X"] for l in lines[:-1]], ["a", "b"])
+        self.assertEqual((lines[-1]["answers"], lines[-1]["exhausted"]), (2, False))
+
+        # (stopping at the limit, it doesn't look for more)
+        errors, lines = runBatch("item(X).\n", limit=3)
+        self.assertEqual((lines[-1]["answers"], lines[-1]["exhausted"]), (3, False))
+
+    def test_exitStatus(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        fname = os.path.join(tmp, "prog.jpl")
+        with open(fname, "w") as f:
+            f.write(SOURCE)
+
+        def run(queries):
+            return subprocess.run([sys.executable, "jpl.py", fname, "--no-cache", "--batch", "-"],
+                    input=queries, cwd=REPO, capture_output=True, text=True)
+
+        ok = run("item(X).\n")
+        self.assertEqual(ok.returncode, 0)
+        self.assertEqual(len(ok.stdout.splitlines()), 4)
+
+        failed = run("item(X).\ndouble(Z, Y).\n")
+        self.assertEqual(failed.returncode, 1)
+        self.assertIn("error", json.loads(failed.stdout.splitlines()[-1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
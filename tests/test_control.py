@@ -0,0 +1,83 @@
+import jpl
+import unittest
+
+
+" Cut, if-then-else, disjunction and negation as failure: which answers come out, in order "
+
+
+SOURCE = """
+item(a). item(b). item(c).
+
+firstItem(X) :- item(X), !.
+
+% cut commits to the clause: later clauses aren't tried
+kind(X, small) :- =<(X, 2), !.
+kind(_, big).
+
+% cut in a callee doesn't cut the caller's choices
+both(X, Y) :- item(X), firstItem(Y).
+
+maxOf(A, B, M) :- ( >=(A, B) -> =(M, A) ; =(M, B) ).
+
+% the condition only gets its first solution, the branches all of theirs
+pick(X) :- ( item(Y) -> ( =(X, Y) ; =(X, other) ) ; =(X, none) ).
+
+noItems(X) :- ( item(X) -> fail ; true ).
+onlyThen(X) :- ( item(X) -> true ).
+
+notItem(X) :- \\+ item(X).
+
+% cut inside \\+ or an if-then-else condition is local to it
+localCut(X) :- item(X), \\+ ( item(Y), !, =(Y, X) ).
+condCut(X) :- ( ( item(Y), ! ) -> =(X, Y) ; =(X, none) ).
+
+=(X, X).
+"""
+
+
+class ControlTest(unittest.TestCase):
+
+    def answers(self, query, engine=jpl.ENGINE_TREE):
+        prog = jpl.Program.ParseString(SOURCE, engine)
+        return [jpl.answerStr(b) for b in jpl.topDownAnswers(prog, jpl.parseQuery(query))]
+
+    def assertAnswers(self, query, expected):
+        " Same answers, in the same order, on every top-down engine "
+        for engine in [jpl.ENGINE_TREE, jpl.ENGINE_COMPILED, jpl.ENGINE_SHARED]:
+            with self.subTest(engine=engine, query=query):
+                self.assertEqual(self.answers(query, engine), expected)
+
+    def test_cut(self):
+        self.assertAnswers("firstItem(X).", ["X = a"])
+        self.assertAnswers("kind(1, K).", ["K = small"])
+        self.assertAnswers("kind(3, K).", ["K = big"])
+        self.assertAnswers("item(X), !.", ["X = a"])
+
+    def test_cutIsLocalToClause(self):
+        self.assertAnswers("both(X, Y).", ["X = a, Y = a", "X = b, Y = a", "X = c, Y = a"])
+
+    def test_disjunction(self):
+        self.assertAnswers("( =(X, 1) ; =(X, 2) ; item(X) ).",
+                ["X = 1", "X = 2", "X = a", "X = b", "X = c"])
+
+    def test_ifThenElse(self):
+        self.assertAnswers("maxOf(3, 5, M).", ["M = 5"])
+        self.assertAnswers("maxOf(7, 5, M).", ["M = 7"])
+        self.assertAnswers("pick(X).", ["X = a", "X = other"])
+        self.assertAnswers("noItems(X).", [])
+        self.assertAnswers("noItems(z).", ["yes"])
+        self.assertAnswers("onlyThen(X).", ["X = a"])
+        self.assertAnswers("onlyThen(z).", [])
+
+    def test_negation(self):
+        self.assertAnswers("notItem(z).", ["yes"])
+        self.assertAnswers("notItem(a).", [])
+        self.assertAnswers("\\+ \\+ =(X, a).", ["yes"]) # (binds nothing)
+
+    def test_localCuts(self):
+        self.assertAnswers("localCut(X).", ["X = b", "X = c"])
+        self.assertAnswers("condCut(X).", ["X = a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
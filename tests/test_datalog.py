@@ -0,0 +1,87 @@
+import datalog
+import jpl
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+
+" Bottom-up (datalog engine) evaluation: same answers as top-down, each derived once "
+
+
+def chain(n):
+    " Source of an n edge chain 0 -> 1 -> ... -> n "
+    return "".join("edge({}, {}).\n".format(i, i + 1) for i in range(n))
+
+
+def answers(prog, query):
+    return sorted(jpl.answerStr(b) for b in jpl.queryAnswers(prog, jpl.parseQuery(query)))
+
+
+class DatalogTest(unittest.TestCase):
+
+    def test_semiNaive(self):
+        " Each fact is derived once for each way there is of deriving it, no more "
+        n = 20
+        prog = jpl.Program.ParseString(chain(n) +
+                "path(X, Y) :- edge(X, Y).\n"
+                "path(X, Y) :- path(X, Z), path(Z, Y).\n", jpl.ENGINE_DATALOG)
+
+        with mock.patch.object(datalog.CompiledRule, "headTuple", autospec=True,
+                side_effect=datalog.CompiledRule.headTuple) as headTuple:
+            found = answers(prog, "path(X, Y).")
+
+        self.assertEqual(len(found), n * (n + 1) // 2)
+        # each path once from its edge, then once per midpoint (X < Z < Y)
+        # (facts go straight into their relations)
+        self.assertEqual(headTuple.call_count, n + math.comb(n + 1, 3))
+
+    def test_sameAsTopDown(self):
+        source = (":- table path/2.\n" + chain(6) + "edge(6, 0).\n"
+                "path(X, Y) :- edge(X, Y).\n"
+                "path(X, Y) :- path(X, Z), edge(Z, Y).\n"
+                "near(X, Y) :- path(X, Y), =<(Y, X).\n")
+        for query in ["path(X, Y).", "path(3, Y).", "near(X, Y).", "path(X, X)."]:
+            with self.subTest(query=query):
+                self.assertEqual(answers(jpl.Program.ParseString(source, jpl.ENGINE_DATALOG), query),
+                        answers(jpl.Program.ParseString(source), query))
+
+    def test_comparisonOrder(self):
+        " A comparison before the literal binding its var is left to top-down, errors and all "
+        source = "num(1).\nnum(5).\nsmall(X) :- <(X, 3), num(X).\n"
+        prog = jpl.Program.ParseString(source, jpl.ENGINE_DATALOG)
+        with self.assertRaises(datalog.NotDatalog):
+            prog.datalog.query(jpl.parseQuery("small(X)."))
+
+        self.assertEqual(answers(prog, "small(1)."), ["yes"])
+        with self.assertRaises(jpl.PrologError):
+            answers(prog, "small(X).")
+
+        # after the literal, it's answered bottom-up
+        prog = jpl.Program.ParseString("num(1).\nnum(5).\nsmall(X) :- num(X), <(X, 3).\n",
+                jpl.ENGINE_DATALOG)
+        self.assertEqual(len(prog.datalog.query(jpl.parseQuery("small(X)."))), 1)
+        self.assertEqual(answers(prog, "small(X)."), ["X = 1"])
+
+    def test_cachedFacts(self):
+        " Facts read straight from the cache give the same relations as parsed ones "
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        fname = os.path.join(tmp, "facts.jpl")
+        with open(fname, "w") as f:
+            f.write(chain(5) + "edge(-1, 0).\nedge(A, A) :- edge(A, 1).\nother(x, f(y)).\n"
+                    "path(X, Y) :- edge(X, Y).\npath(X, Y) :- path(X, Z), edge(Z, Y).\n")
+
+        parsed = jpl.Program.Load(fname, jpl.ENGINE_DATALOG) # (writes the cache)
+        cached = jpl.Program.Load(fname, jpl.ENGINE_DATALOG)
+        self.assertIsNone(cached.rules.rules[0]) # not decoded yet
+        for query in ["path(X, Y).", "path(-1, Y)."]:
+            with self.subTest(query=query):
+                self.assertEqual(answers(cached, query), answers(parsed, query))
+        self.assertEqual(answers(cached, "other(x, Y)."), ["Y = f(y)"]) # (top-down)
+
+
+if __name__ == "__main__":
+    unittest.main()
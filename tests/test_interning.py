@@ -0,0 +1,52 @@
+import clause as cls
+import jpl
+import os
+import shutil
+import tempfile
+import unittest
+
+
+" Symbol interning: names get ids, numbers don't (so arithmetic can't grow the table) "
+
+
+COUNT = "count(0).\ncount(N) :- >(N, 0), is(M, -(N, 1)), count(M).\n"
+
+
+class InterningTest(unittest.TestCase):
+
+    def test_numbersNotInterned(self):
+        prog = jpl.Program.ParseString(COUNT)
+        before = len(cls.symbolNames)
+        self.assertEqual(list(prog.solve("count(5000).")), [{}])
+        self.assertLessEqual(len(cls.symbolNames) - before, 1) # (just the query's own 'goal')
+
+    def test_numberSymbols(self):
+        self.assertEqual(cls.Functor(3, []).sym, cls.Functor(3, []).sym)
+        self.assertNotEqual(cls.Functor(3, []).sym, cls.Functor(4, []).sym)
+        self.assertNotEqual(cls.Functor(3, []).sym, cls.Functor("3", []).sym)
+        self.assertEqual(cls.symbolName(cls.Functor(-7, []).sym), (-7, 0))
+        self.assertEqual(cls.symbolName(cls.symbolId("foo", 2)), ("foo", 2))
+
+    def test_numbersUnifyByValue(self):
+        prog = jpl.Program.ParseString("n(1, one).\nn(2, two).\nn(X, many) :- >(X, 2).\n")
+        self.assertEqual([str(a["N"]) for a in prog.solve("is(X, +(1, 1)), n(X, N).")], ["two"])
+        self.assertEqual([str(a["N"]) for a in prog.solve("n(3, N).")], ["many"])
+        self.assertEqual(list(prog.solve("n(1, two).")), [])
+
+    def test_cachedNumbers(self):
+        " Clauses indexed on numbers still match once they're loaded from the cache "
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        fname = os.path.join(tmp, "n.jpl")
+        with open(fname, "w") as f:
+            f.write("n(1, one).\nn(2, two).\nn(-3, minusThree).\n")
+
+        for engine in jpl.ENGINES:
+            jpl.Program.Load(fname, engine) # (writes the cache the first time)
+            prog = jpl.Program.Load(fname, engine)
+            self.assertEqual([str(a["N"]) for a in prog.solve("n(2, N).")], ["two"])
+            self.assertEqual([str(a["X"]) for a in prog.solve("n(X, minusThree).")], ["-3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
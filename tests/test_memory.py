@@ -0,0 +1,49 @@
+import jpl
+import tracemalloc
+import unittest
+
+
+" Deterministic loops run in constant memory, on every engine "
+
+
+SOURCE = """
+count(0).
+count(N) :- >(N, 0), is(M, -(N, 1)), count(M).
+
+countIf(N) :- ( =:=(N, 0) -> true ; is(M, -(N, 1)), countIf(M) ).
+
+countCut(0) :- !.
+countCut(N) :- is(M, -(N, 1)), countCut(M).
+"""
+
+LOOPS = ["count", "countIf", "countCut"]
+
+
+def peakMemory(engine, query):
+    " Peak memory (bytes) taken by answering query, and its answers "
+    prog = jpl.Program.ParseString(SOURCE, engine)
+    tracemalloc.start()
+    try:
+        answers = list(prog.solve(query))
+        return (tracemalloc.get_traced_memory()[1], answers)
+    finally:
+        tracemalloc.stop()
+
+
+class MemoryTest(unittest.TestCase):
+
+    def test_deterministicLoops(self):
+        for engine in jpl.ENGINES:
+            for loop in LOOPS:
+                with self.subTest(engine=engine, loop=loop):
+                    small, answers = peakMemory(engine, "{}(500).".format(loop))
+                    self.assertEqual(answers, [{}])
+                    big, answers = peakMemory(engine, "{}(5000).".format(loop))
+                    self.assertEqual(answers, [{}])
+
+                    # (some growth is just garbage waiting for the cycle collector: keeping
+                    # anything per iteration, e.g. a rule instance, would take ~50 bytes+)
+                    self.assertLess(big - small, 256 * 1024)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import itertools
+import jpl
+import unittest
+
+
+" OR- and AND-parallel answers: the same as a sequential search's "
+
+
+SOURCE = """
+item(1). item(2). item(3). item(4).
+pair(X, Y) :- item(X), item(Y).
+triple(X, Y, Z) :- item(X), item(Y), item(Z).
+
+firstItem(X) :- item(X), !.
+smallPair(X, Y) :- pair(X, Y), <(X, Y), !.
+
+% an error partway through: check(3, 3) has an answer, then hits is/2 on an atom
+check(X, X).
+check(X, Y) :- =:=(X, 3), =:=(Y, 3), is(Z, +(foo, 1)).
+=(X, X).
+"""
+
+
+def sequential(query, limit=None):
+    " collectAnswers for query (up to limit answers), by plain top-down search "
+    prog = jpl.Program.ParseString(SOURCE)
+    return jpl.collectAnswers(lambda: itertools.islice(
+            jpl.queryAnswers(prog, jpl.parseQuery(query), limit=limit), limit))
+
+
+def parallel(query, andParallel=False, ordered=True, limit=None):
+    " collectAnswers for query (up to limit answers), answered in parallel, and the program it ran on "
+    prog = jpl.Program.ParseString(SOURCE)
+    if andParallel:
+        prog.parallel = jpl.AndParallel(prog, 2, source=SOURCE)
+    else:
+        prog.parallel = jpl.OrParallel(prog, 2, ordered, source=SOURCE)
+    try:
+        return (jpl.collectAnswers(lambda: itertools.islice(
+            jpl.queryAnswers(prog, jpl.parseQuery(query), limit=limit), limit)),
+                prog)
+    finally:
+        prog.parallel.close()
+
+
+class OrParallelTest(unittest.TestCase):
+
+    def assertSame(self, query, ordered=True, limit=None):
+        found, prog = parallel(query, ordered=ordered, limit=limit)
+        expected = sequential(query, limit)
+        self.assertEqual(jpl.compareAnswers(found, expected, inOrder=ordered), [])
+        return found, prog
+
+    def test_ordered(self):
+        found, prog = self.assertSame("triple(X, Y, Z).")
+        self.assertEqual(len(found[0]), 64)
+        # (it did get split up)
+        self.assertGreater(len(jpl.splitQuery(prog, jpl.parseQuery("triple(X, Y, Z)."), 8).tasks()), 1)
+
+    def test_unordered(self):
+        found, _ = self.assertSame("triple(X, Y, Z).", ordered=False)
+        self.assertEqual(len(found[0]), 64)
+
+    def test_limit(self):
+        found, _ = self.assertSame("triple(X, Y, Z).", limit=10)
+        self.assertEqual(len(found[0]), 10)
+
+    def test_cuts(self):
+        " Answers pruned by cuts stay pruned, and steps a cut could reach past aren't handed off "
+        for query in ["pair(X, Y), !.", "item(X), firstItem(Y), pair(Y, Z).", "smallPair(X, Y).",
+                "( item(X), item(Y), ! ; =(X, 0), =(Y, 0) )."]:
+            with self.subTest(query=query):
+                self.assertSame(query)
+                self.assertSame(query, ordered=False)
+
+        prog = jpl.Program.ParseString(SOURCE)
+        self.assertEqual(jpl.splitQuery(prog, jpl.parseQuery("pair(X, Y), !."), 8).tasks(), [])
+
+    def test_errorKeepsAnswers(self):
+        " A task's answers from before its error still come out, and then the error "
+        found, _ = self.assertSame("pair(X, Y), check(X, Y).")
+        self.assertEqual([text for _, text in found[0]], ["X = 1, Y = 1", "X = 2, Y = 2", "X = 3, Y = 3"])
+        self.assertIsNotNone(found[1])
+
+
+class AndParallelTest(unittest.TestCase):
+
+    def test_independent(self):
+        query = "item(X), pair(Y, Z)."
+        found, prog = parallel(query, andParallel=True)
+        self.assertEqual(jpl.compareAnswers(found, sequential(query), inOrder=True), [])
+        self.assertEqual(len(found[0]), 64)
+        self.assertEqual(len(jpl._findIndependent(prog, jpl.parseQuery(query))[2]), 2)
+
+    def test_sequentialFallback(self):
+        " Queries without independent goals are answered by a sequential search, on no workers "
+        for query in ["pair(X, Y), =(X, Y).", "item(X), item(Y), <(X, Y)."]:
+            with self.subTest(query=query):
+                prog = jpl.Program.ParseString(SOURCE)
+                self.assertIsNone(jpl._findIndependent(prog, jpl.parseQuery(query)))
+
+                found, prog = parallel(query, andParallel=True)
+                self.assertEqual(jpl.compareAnswers(found, sequential(query), inOrder=True), [])
+                self.assertIsNone(prog.parallel.pool)
+
+    def test_error(self):
+        query = "item(W), pair(X, Y), check(X, Y)."
+        found, _ = parallel(query, andParallel=True)
+        self.assertEqual(jpl.compareAnswers(found, sequential(query), inOrder=True), [])
+        self.assertIsNotNone(found[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
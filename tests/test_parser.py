@@ -0,0 +1,58 @@
+import clause as cls
+import jpl
+import unittest
+
+
+" Parsing: control operators tokenize the same whatever the spacing "
+
+
+def body(query):
+    return [str(g) for g in jpl.parseQuery(query).body]
+
+
+class ParserTest(unittest.TestCase):
+
+    def test_ifThenElseSpacing(self):
+        expected = [";(->(c, t), e)"]
+        for query in ["( c -> t ; e ).", "(c->t;e).", "( c->t ; e ).", "(c ->t; e)."]:
+            with self.subTest(query=query):
+                self.assertEqual(body(query), expected)
+
+    def test_negationSpacing(self):
+        for query in ["\\+ a.", "\\+a.", "\\+(a)."]:
+            with self.subTest(query=query):
+                self.assertEqual(body(query), ["\\+(a)"])
+
+    def test_operatorsAsNames(self):
+        " As a functor's name, or where a term is expected, they're atoms "
+        self.assertEqual(body("=(X, ->(a, b))."), ["=(X, ->(a, b))"])
+        self.assertEqual(body("=(X, f(->, \\+))."), ["=(X, f(->, \\+))"])
+        self.assertEqual(body("( c ->(t) )."), ["->(c, t)"])
+
+    def test_otherNames(self):
+        " Names that just contain '-', '>' or '\\' are still one identifier "
+        self.assertEqual(body("f(=<, >=, =\\=, a-b, -3, >>)."), ["f(=<, >=, =\\=, a-b, -3, >>)"])
+
+    def test_colon(self):
+        " ':' is only part of a name in `=:=`, and never runs into a ':-' "
+        self.assertEqual(body("=:=(X, 1), =\\=(X, 2)."), ["=:=(X, 1)", "=\\=(X, 2)"])
+        rule, = jpl.Program.ParseString("p(a):-q(a).").rules
+        self.assertEqual((str(rule.head), [str(g) for g in rule.body]), ("p(a)", ["q(a)"]))
+        for query in ["p(a:b).", "foo:bar.", "=(X, :)."]:
+            with self.subTest(query=query):
+                with self.assertRaises(cls.ParseError):
+                    body(query)
+
+    def test_ambiguous(self):
+        " '->' inside what would have been a name isn't one: it's an operator, or an error "
+        with self.assertRaises(cls.ParseError):
+            body("=(X, a->b).")
+
+    def test_answers(self):
+        prog = jpl.Program.ParseString("=(X, X).\nmaxOf(A, B, M) :- (>=(A, B)->=(M, A);=(M, B)).\n")
+        self.assertEqual([str(a["M"]) for a in prog.solve("maxOf(2, 5, M).")], ["5"])
+        self.assertEqual([str(a["M"]) for a in prog.solve("maxOf(7, 5, M).")], ["7"])
+
+
+if __name__ == "__main__":
+    unittest.main()
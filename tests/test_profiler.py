@@ -0,0 +1,64 @@
+import jpl
+import profiler
+import unittest
+
+
+" Profiler: per-predicate calls, redos, head attempts and unifications "
+
+
+SOURCE = """
+item(a). item(b). item(c).
+p(X) :- item(X).
+same(X, X).
+"""
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prog = jpl.Program.ParseString(SOURCE)
+        self.prog.profiler = profiler.Profiler()
+
+    def predicates(self):
+        " The profile so far, as {predicate: stats} without the (timing dependent) times "
+        report = self.prog.profiler.toDict()
+        return {p["predicate"]: {k: v for k, v in p.items() if k not in ("predicate", "time")}
+                for p in report["predicates"]}
+
+    def test_callsAndRedos(self):
+        answers = list(self.prog.solve("p(X)."))
+        self.assertEqual([str(a["X"]) for a in answers], ["a", "b", "c"])
+        self.assertEqual(self.predicates(), {
+            "p/1":    dict(calls=1, redos=0, attempts=1, unified=1),
+            "item/1": dict(calls=1, redos=2, attempts=3, unified=3),
+        })
+        report = self.prog.profiler.toDict()
+        self.assertEqual(report["steps"], 4)
+        self.assertEqual(report["maxDepth"], 2)
+
+    def test_failedUnification(self):
+        # (same/2's head passes the couldUnify pre-check, but X can't be both a and b)
+        self.assertEqual(list(self.prog.solve("same(a, b).")), [])
+        self.assertEqual(self.predicates(), {"same/2": dict(calls=1, redos=0, attempts=1, unified=0)})
+
+    def test_toDictSorted(self):
+        list(self.prog.solve("p(X)."))
+        names = [p["predicate"] for p in self.prog.profiler.toDict("redos")["predicates"]]
+        self.assertEqual(names, ["item/1", "p/1"])
+        self.assertRaises(AssertionError, self.prog.profiler.report, "nonsense")
+
+    def test_reset(self):
+        list(self.prog.solve("p(X)."))
+        self.prog.profiler.reset()
+        self.assertEqual(self.prog.profiler.toDict(), {"steps": 0, "maxDepth": 0, "predicates": []})
+
+    def test_errorClosesStep(self):
+        with self.assertRaises(jpl.PrologError):
+            list(self.prog.solve("p(X), is(Z, +(foo, 1))."))
+        self.assertEqual(self.prog.profiler.open, [])
+        self.assertEqual(self.prog.profiler.steps, 3)
+        self.assertEqual(self.predicates()["is/2"], dict(calls=1, redos=0, attempts=0, unified=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
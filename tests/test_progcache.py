@@ -0,0 +1,84 @@
+import jpl
+import marshal
+import os
+import progcache
+import shutil
+import tempfile
+import unittest
+
+
+" The precompiled program cache (.jplc): reused while the source matches, rebuilt when it doesn't "
+
+
+class ProgCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.fname = os.path.join(self.dir, "prog.jpl")
+
+    def writeSource(self, source):
+        with open(self.fname, "w") as f:
+            f.write(source)
+
+    def answers(self, query, **kwargs):
+        prog = jpl.Program.Load(self.fname, **kwargs)
+        return sorted(jpl.answerStr(b) for b in jpl.topDownAnswers(prog, jpl.parseQuery(query)))
+
+    def test_writesAndReuses(self):
+        self.writeSource("likes(a, b).\nlikes(b, c).\n")
+        self.assertEqual(self.answers("likes(a, X)."), ["X = b"])
+        self.assertTrue(os.path.exists(progcache.cachePath(self.fname)))
+
+        sourceHash = progcache.hashSource(self.fname)
+        self.assertIsNotNone(progcache.read(self.fname, sourceHash))
+        self.assertEqual(self.answers("likes(a, X)."), ["X = b"])
+
+    def test_invalidatedBySourceChange(self):
+        self.writeSource("likes(a, b).\n")
+        self.assertEqual(self.answers("likes(a, X)."), ["X = b"])
+        oldHash = progcache.hashSource(self.fname)
+
+        self.writeSource("likes(a, c).\nlikes(a, d).\n")
+        self.assertIsNone(progcache.read(self.fname, progcache.hashSource(self.fname)))
+        self.assertEqual(self.answers("likes(a, X)."), ["X = c", "X = d"])
+
+        # rewritten for the new source, the old one's no longer valid
+        self.assertIsNotNone(progcache.read(self.fname, progcache.hashSource(self.fname)))
+        self.assertIsNone(progcache.read(self.fname, oldHash))
+
+    def test_badCacheIgnored(self):
+        self.writeSource("likes(a, b).\n")
+        with open(progcache.cachePath(self.fname), "wb") as f:
+            f.write(b"JPLC not really a cache")
+        self.assertEqual(self.answers("likes(a, X)."), ["X = b"])
+
+        # payloads that unmarshal, with the right version & hash, but aren't laid out like a cache
+        base = {"functors": [], "names": [], "index": ({}, {}, {}), "rules": {}, "directives": {}}
+        for payload in [{}, dict(base, index=({0: [0]}, {}, {})), dict(base, index=None), []]:
+            with self.subTest(payload=payload):
+                with open(progcache.cachePath(self.fname), "wb") as f:
+                    f.write(progcache.MAGIC + marshal.dumps(
+                            (progcache.FORMAT_VERSION, progcache.hashSource(self.fname), payload)))
+                self.assertEqual(self.answers("likes(a, X)."), ["X = b"])
+
+    def test_noCache(self):
+        self.writeSource("likes(a, b).\n")
+        self.assertEqual(self.answers("likes(a, X).", useCache=False), ["X = b"])
+        self.assertFalse(os.path.exists(progcache.cachePath(self.fname)))
+
+    def test_sameProgram(self):
+        " Rules and directives rebuilt from the cache are the ones parsed from the source "
+        self.writeSource(":- table path/2.\n"
+                "edge(1, 2). edge(2, 3).\n"
+                "path(X, Y) :- path(X, Z), edge(Z, Y).\n"
+                "path(X, Y) :- edge(X, Y).\n")
+        parsed = jpl.Program.Load(self.fname)
+        cached = jpl.Program.Load(self.fname)
+        self.assertEqual([str(r) for r in cached.rules], [str(r) for r in parsed.rules])
+        self.assertEqual(cached.tabled, parsed.tabled)
+        self.assertEqual(self.answers("path(1, Y)."), ["Y = 2", "Y = 3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
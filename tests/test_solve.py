@@ -0,0 +1,96 @@
+import gc
+import jpl
+import profiler
+import unittest
+import weakref
+
+
+" Program.solve: answers as a generator, with a limit, a timeout, and early closing "
+
+
+SOURCE = """
+item(a). item(b). item(c).
+pair(X, Y) :- item(X), item(Y).
+loop(X) :- loop(X).
+count(N) :- is(M, +(N, 1)), count(M).
+"""
+
+
+class StepRecorder(profiler.Profiler):
+    " Keeps weak references to every step it sees "
+
+    def reset(self):
+        super().reset()
+        self.seen = []
+
+    def stepStart(self, step, bookmark):
+        self.seen.append(weakref.ref(step))
+        super().stepStart(step, bookmark)
+
+
+class SolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prog = jpl.Program.ParseString(SOURCE)
+
+    def test_answers(self):
+        answers = list(self.prog.solve("pair(a, Y)."))
+        self.assertEqual([str(a["Y"]) for a in answers], ["a", "b", "c"])
+
+    def test_answersCopiedOut(self):
+        " Earlier answers keep their values as the search moves on "
+        solutions = self.prog.solve("pair(X, Y).")
+        first = next(solutions)
+        rest = list(solutions)
+        self.assertEqual((str(first["X"]), str(first["Y"])), ("a", "a"))
+        self.assertEqual(len(rest), 8)
+
+    def test_limit(self):
+        self.assertEqual(len(list(self.prog.solve("pair(X, Y).", limit=4))), 4)
+        self.assertEqual(len(list(self.prog.solve("pair(X, Y).", limit=20))), 9)
+        self.assertEqual(list(self.prog.solve("pair(X, Y).", limit=0)), [])
+
+    def test_timeout(self):
+        for query in ["loop(a).", "count(0)."]:
+            with self.subTest(query=query):
+                with self.assertRaises(jpl.QueryTimeout):
+                    list(self.prog.solve(query, timeout=0.2))
+
+        # the deadline's only for that query
+        self.assertIsNone(self.prog.deadline)
+        self.assertEqual(len(list(self.prog.solve("item(X)."))), 3)
+
+    def test_timeoutAfterAnswers(self):
+        " Answers before the timeout still come out "
+        solutions = self.prog.solve("( item(X) ; loop(X) ).", timeout=0.2)
+        self.assertEqual([str(next(solutions)["X"]) for _ in range(3)], ["a", "b", "c"])
+        with self.assertRaises(jpl.QueryTimeout):
+            next(solutions)
+
+    def test_closeEarly(self):
+        " Closing the generator undoes the query's bindings and lets go of its steps "
+        self.prog.profiler = recorder = StepRecorder()
+        queryRule = jpl.parseQuery("pair(X, Y).")
+        solutions = jpl.solveQuery(self.prog, queryRule)
+        next(solutions)
+        self.assertEqual(len(queryRule.boundVars()), 2)
+
+        solutions.close()
+        self.assertEqual(queryRule.boundVars(), [])
+
+        gc.collect()
+        self.assertTrue(recorder.seen)
+        self.assertEqual([ref for ref in recorder.seen if ref() is not None], [])
+
+    def test_dropEarly(self):
+        " Same for a generator that's just let go of "
+        queryRule = jpl.parseQuery("pair(X, Y).")
+        solutions = jpl.solveQuery(self.prog, queryRule)
+        next(solutions)
+        del solutions
+        gc.collect()
+        self.assertEqual(queryRule.boundVars(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import jpl
+import time
+import unittest
+
+
+" Tabling: answers, and termination on left-recursive, non-linear and mutual recursion "
+
+
+def cycle(n):
+    " Source of an n node cycle n0 -> n1 -> ... -> n0 "
+    return "".join("edge(n{}, n{}).\n".format(i, (i + 1) % n) for i in range(n))
+
+
+def answers(prog, query):
+    return sorted(jpl.answerStr(b) for b in jpl.topDownAnswers(prog, jpl.parseQuery(query)))
+
+
+class TablingTest(unittest.TestCase):
+
+    def assertSameAsDatalog(self, source, query):
+        " Checks the tabled answers to query are the bottom-up ones "
+        prog = jpl.Program.ParseString(source)
+        self.assertEqual(answers(prog, query),
+                answers(jpl.Program.ParseString(source, jpl.ENGINE_DATALOG), query))
+        return prog
+
+    def test_leftRecursion(self):
+        prog = jpl.Program.ParseString(":- table path/2.\n" + cycle(4) +
+                "path(X, Y) :- path(X, Z), edge(Z, Y).\n"
+                "path(X, Y) :- edge(X, Y).\n")
+        self.assertEqual(answers(prog, "path(n0, Y)."),
+                ["Y = n0", "Y = n1", "Y = n2", "Y = n3"])
+
+    def test_doublyRecursive(self):
+        source = (":- table path/2.\n" + cycle(8) +
+                "path(X, Y) :- path(X, Z), path(Z, Y).\n"
+                "path(X, Y) :- edge(X, Y).\n")
+        start = time.monotonic()
+        self.assertSameAsDatalog(source, "path(n0, Y).")
+        self.assertSameAsDatalog(source, "path(X, Y).")
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_doublyRecursiveGrowth(self):
+        " Steps grow polynomially with the cycle's length, not exponentially "
+        def steps(n):
+            prog = jpl.Program.ParseString(":- table path/2.\n" + cycle(n) +
+                    "path(X, Y) :- path(X, Z), path(Z, Y).\n"
+                    "path(X, Y) :- edge(X, Y).\n")
+            self.assertEqual(len(answers(prog, "path(n0, Y).")), n)
+            return prog.steps
+
+        self.assertLess(steps(8), 16 * steps(4))
+
+    def test_mutualRecursion(self):
+        source = (":- table p/2, q/2, r/2.\n" + cycle(3) +
+                "p(X, Y) :- q(X, Z), r(Z, Y).\n"
+                "p(X, Y) :- edge(X, Y).\n"
+                "q(X, Y) :- r(X, Z), p(Z, Y).\n"
+                "q(X, Y) :- edge(X, Y).\n"
+                "r(X, Y) :- p(X, Z), q(Z, Y).\n"
+                "r(X, Y) :- edge(X, Y).\n")
+        start = time.monotonic()
+        self.assertSameAsDatalog(source, "p(X, Y).")
+        self.assertSameAsDatalog(source, "q(n1, Y).")
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_engines(self):
+        " Left and mutual recursion terminate, with the same answers, on every top-down engine "
+        source = (":- table path/2, p/2, q/2.\n" + cycle(5) +
+                "path(X, Y) :- path(X, Z), edge(Z, Y).\n"
+                "path(X, Y) :- edge(X, Y).\n"
+                "p(X, Y) :- q(X, Z), edge(Z, Y).\n"
+                "p(X, Y) :- edge(X, Y).\n"
+                "q(X, Y) :- p(X, Z), edge(Z, Y).\n")
+        expected = {query: answers(jpl.Program.ParseString(source, jpl.ENGINE_DATALOG), query)
+                for query in ["path(n1, Y).", "p(X, Y).", "q(n0, Y)."]}
+        self.assertEqual(len(expected["p(X, Y)."]), 25) # (odd length paths: all of them on a 5 cycle)
+
+        for engine in [jpl.ENGINE_TREE, jpl.ENGINE_COMPILED, jpl.ENGINE_SHARED]:
+            for query, want in expected.items():
+                with self.subTest(engine=engine, query=query):
+                    self.assertEqual(answers(jpl.Program.ParseString(source, engine), query), want)
+
+    def test_tablesComplete(self):
+        " Every table an evaluation touched ends up complete, with nothing left on the stack "
+        prog = jpl.Program.ParseString(":- table path/2.\n" + cycle(5) +
+                "path(X, Y) :- path(X, Z), path(Z, Y).\n"
+                "path(X, Y) :- edge(X, Y).\n")
+        answers(prog, "path(n0, Y).")
+        self.assertEqual(prog.tableStack, [])
+        self.assertTrue(all(t.complete for t in prog.tables.values()))
+
+    def test_testProgram(self):
+        prog = jpl.Program.Load("test_progs/tabling.jpl", useCache=False)
+        self.assertEqual(answers(prog, "fib(30, F)."), ["F = 832040"])
+        self.assertEqual(answers(prog, "path(d, Y)."), ["Y = e"])
+        self.assertEqual(answers(prog, "sameGen(d, Y)."), ["Y = d", "Y = e", "Y = f"])
+
+
+if __name__ == "__main__":
+    unittest.main()
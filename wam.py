@@ -0,0 +1,225 @@
+# (python3)
+import clause as cls
+
+
+"""
+Compiled clauses for jpl (loosely WAM-style)
+
+Instead of copying a whole Rule and then unifying the copy's head against the goal,
+the head of each rule is compiled once into a flat list of get_* instructions,
+plus a count of the variables in the rule (registers are just the rule's var slots).
+
+Head matching then runs these instructions directly against the goal:
+- The first occurrence of a head var just stores the goal subterm it lines up with
+  into a register (no new Var, no binding)
+- Only when the goal has an unbound var where the head has a structure do we build
+  (part of) the head, from the original rule's terms ("write mode")
+- The body is only instantiated (with the registers filled in) once the head matched
+- Ground (var-free) compound subterms of the head are matched as a whole, by one
+  instruction: bound to as they are if the goal has a var there (never copied)
+
+Used by jpl.Program when its engine is ENGINE_COMPILED
+"""
+
+
+# ============================================================
+#
+#                       INSTRUCTIONS
+#
+# ============================================================
+
+# Each instruction is a tuple (opcode, args...)
+# They consume goal subterms from a stack, in preorder over the head
+
+GET_STRUCT = 0  # (GET_STRUCT, sym, arity, skip, template)
+                #   match a functor, then its args are pushed for the next instructions
+                #   in write mode, builds template & skips the next `skip` instructions
+GET_VAR    = 1  # (GET_VAR, reg)   first occurrence of a var: reg <= subterm
+GET_VAL    = 2  # (GET_VAL, reg)   later occurrence of a var: unify reg with subterm
+GET_VOID   = 3  # (GET_VOID,)      '_': matches anything, ignore subterm
+GET_GROUND = 4  # (GET_GROUND, term)  ground compound: unify subterm with the (shared) term
+
+OPNAMES = ["get_structure", "get_variable", "get_value", "get_void", "get_ground"]
+
+
+class CompiledRule:
+    " A Rule compiled to head-matching instructions + a register count "
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.head = rule.head # kept for cheap pre-checks (cls.couldUnify)
+        self.body = rule.body
+
+        self.numVars = len(rule.varNames)
+        self.seen = set() # slots we've already emitted a GET_VAR for
+        self.code = []
+        self._compileTerm(rule.head)
+        del self.seen
+
+
+    def _compileTerm(self, term):
+        " Appends instructions matching term (preorder, using an explicit stack) "
+
+        stack = [term]
+        while stack:
+            term = stack.pop()
+
+            # int marks the end of a struct's children: patch in its skip
+            if isinstance(term, int):
+                start = term
+                instr = self.code[start]
+                skip = len(self.code) - start - 1
+                self.code[start] = (GET_STRUCT, instr[1], instr[2], skip, instr[4])
+                continue
+
+            if term.isVar():
+                if term.token == "_":
+                    self.code.append((GET_VOID,))
+                elif term.slot in self.seen:
+                    self.code.append((GET_VAL, term.slot))
+                else:
+                    self.seen.add(term.slot)
+                    self.code.append((GET_VAR, term.slot))
+                continue
+
+            if term.ground and term.subterms:
+                self.code.append((GET_GROUND, term))
+                continue
+
+            # Functor: emit struct, then its children, then patch
+            stack.append(len(self.code))
+            self.code.append((GET_STRUCT, term.sym, len(term.subterms), None, term))
+            stack.extend(reversed(term.subterms))
+
+
+    def unifyHead(self, goal, instanceId, trail):
+        """ Runs head instructions against goal
+        Returns (instance, success), bindings made are pushed onto trail
+        On success, instance is a fresh Rule holding the instantiated body
+        Like cls._tryUnify, doesn't undo bindings on failure
+        """
+
+        regs = [None] * self.numVars
+        inst = cls.Rule.Instance(self.rule.varNames)
+        inst.setInstanceId(instanceId)
+
+        stack = [goal]
+        code = self.code
+        pc = 0
+        while pc < len(code):
+            instr = code[pc]
+            op = instr[0]
+            term = stack.pop()
+            pc += 1
+
+            if op == GET_VAR:
+                # (deref'd, so the instance doesn't hold onto the goal's chain of bindings)
+                if term.isVar():
+                    term = term.deref()
+                # '_' never gets bound, so the head var can't just alias it: needs its own
+                if term.isVar() and term.token == "_":
+                    term = cls.Var(self.rule.varNames[instr[1]], instr[1], inst)
+                regs[instr[1]] = term
+
+            elif op == GET_VAL:
+                if not cls._tryUnify(regs[instr[1]], term, trail):
+                    return (inst, False)
+
+            elif op == GET_STRUCT:
+                if term.isVar():
+                    term = term.deref()
+
+                if term.isVar(): # write mode: build the structure & bind to it
+                    built = _build(instr[4], regs, inst)
+                    pc += instr[3]
+                    if term.token != "_":
+                        trail.bind(term, built)
+                    continue
+
+                # read mode
+                if term.sym != instr[1]:
+                    return (inst, False)
+                stack.extend(reversed(term.subterms))
+
+            elif op == GET_GROUND:
+                if not cls._tryUnify(instr[1], term, trail):
+                    return (inst, False)
+
+            # GET_VOID: nothing to do
+
+
+        # Head matched: instantiate body
+        inst.body = [_build(b, regs, inst) for b in self.body]
+        return (inst, True)
+
+
+    def __repr__(self):
+        msg = "<Compiled {} ({} vars):\n".format(self.head.shortname(), self.numVars)
+        for instr in self.code:
+            op = instr[0]
+            args = instr[1:]
+            if op == GET_STRUCT:
+                args = ["{}/{}".format(*cls.symbolName(instr[1])), instr[3]]
+            msg += "  {} {}\n".format(OPNAMES[op], ", ".join(str(a) for a in args))
+        return msg + ">"
+
+
+def _build(template, regs, inst):
+    """ Instantiates a term from the source rule, filling in vars from regs (by slot)
+    Vars without a register value yet get created fresh, with inst as their context
+    """
+
+    if template.isVar():
+        reg = template.slot
+        if regs[reg] is None:
+            regs[reg] = cls.Var(template.token, reg, inst)
+        return regs[reg]
+
+    if template.ground: # (shared, like in cls.Functor.copy)
+        return template
+
+    # Same scheme as cls.Functor.copy: copy subterm lists, then fill them in
+    top = cls.Functor(template.token, template.subterms, template.sym)
+    stack = [top]
+    while stack:
+        subs = stack.pop().subterms
+        for i in range(len(subs)):
+            s = subs[i]
+            if s.isVar():
+                reg = s.slot
+                if regs[reg] is None:
+                    regs[reg] = cls.Var(s.token, reg, inst)
+                subs[i] = regs[reg]
+            elif not s.ground:
+                subs[i] = cls.Functor(s.token, s.subterms, s.sym)
+                stack.append(subs[i])
+
+    return top
+
+
+class CompiledRules:
+    """ Read-only list of compiled rules, each compiled the first time it's accessed
+    (so a big program, e.g. loaded from progcache, doesn't get compiled all up front)
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.compiled = [None] * len(rules)
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def __getitem__(self, i):
+        crule = self.compiled[i]
+        if crule is None:
+            crule = self.compiled[i] = CompiledRule(self.rules[i])
+        return crule
+
+    def __iter__(self):
+        for i in range(len(self.compiled)):
+            yield self[i]
+
+
+def compileRules(rules):
+    " Compiles a list of rules (lazily, see CompiledRules) "
+    return CompiledRules(rules)